@@ -12,6 +12,8 @@ from scipy import interpolate
 from astropy import constants as const
 import astropy.units as u
 from scipy.optimize import fsolve
+from scipy.integrate import cumtrapz
+from posteriors.profiling import profiled
 
 
 
@@ -112,6 +114,7 @@ class Cosmo(object):
         else:
             return 4*np.pi*FlatLambdaCDM(H0=H0, Om0=Om,).differential_comoving_volume(z).to(self.dist_unit**3/u.sr).value
 
+    @profiled
     def log_dV_dz(self, z, H0, Om0, w0):
         res =  np.log(4*np.pi)+3*np.log(self.clight)-3*np.log(H0)+2*np.log(self.uu(z, Om0, w0))-np.log(self.E(z, Om0, w0))
         if self.dist_unit==u.Gpc:
@@ -136,6 +139,7 @@ class Cosmo(object):
         return (self.sPrime(z, Xi0, n)*self.uu(z, Om, w0)+self.s(z, Xi0, n)/self.E(z, Om, w0))*(self.clight/H0)
 
 
+    @profiled
     def log_ddL_dz(self, z, H0, Om0, w0, Xi0, n, dL=None):
         if self.dist_unit==u.Gpc: # and dL is not None:
             H0*=1e03
@@ -159,6 +163,7 @@ class Cosmo(object):
         #    res -= 3*np.log(10)
         return res
 
+    @profiled
     def dLGW(self, z, H0, Om, w0, Xi0, n):
         '''                                                                                                          
         Modified GW luminosity distance in units set by self.dist_unit (default Mpc)                                                                           
@@ -180,14 +185,57 @@ class Cosmo(object):
         return Xi
 
 
+    ######################
+    # FUNCTIONS VECTORIZED OVER THE PARAMETERS
+    # Parameters can be arrays broadcastable with z, e.g. of shape (nLambdas, 1), to evaluate many values of Lambda at once.
+    # E(z) is written explicitly for flat wCDM without radiation, as in astropy with Tcmb0=0
+    ######################
+
+    def E_vec(self, z, Om, w0):
+        return np.sqrt(Om*(1+z)**3+(1-Om)*(1+z)**(3*(1+w0)))
+
+    def Xi_vec(self, z, Xi0, n):
+        return Xi0+(1-Xi0)/(1+z)**n
+
+    @profiled
+    def log_dV_dz_vec(self, z, dL, H0, Om0, w0, Xi0, n):
+        '''
+        Same as log_dV_dz, with the comoving distance obtained from the GW luminosity distance dL corresponding to z,
+        instead of the integral of 1/E(z)
+        '''
+        logdC = np.log(dL)-np.log1p(z)-np.log(self.Xi_vec(z, Xi0, n))
+        res = np.log(4*np.pi)+np.log(self.clight)-np.log(H0)+2*logdC-np.log(self.E_vec(z, Om0, w0))
+        if self.dist_unit==u.Gpc:
+            res -= 3*np.log(10)
+        return res
+
+    @profiled
+    def log_ddL_dz_vec(self, z, dL, H0, Om0, w0, Xi0, n):
+        '''
+        Same as log_ddL_dz with dL given
+        '''
+        if self.dist_unit==u.Gpc:
+            H0 = H0*1e03
+        Xi = self.Xi_vec(z, Xi0, n)
+        return np.log( dL/(1+z)*( 1-(n*(1-Xi0))/(Xi*(1+z)**n) )+self.clight*(1+z)*Xi/(H0*self.E_vec(z, Om0, w0)))
+
+
     ######################
     # SOLVERS FOR DISTANCE-REDSHIFT RELATION
     ######################
     
+    @profiled
     def z_from_dLGW_fast(self, r, H0, Om, w0, Xi0, n):
         '''
         Returns redshift for a given luminosity distance r (in Mpc by default). Vectorized
         '''
+        return self.z_from_dLGW_interpolator(H0, Om, w0, Xi0, n)(r)
+    
+    def z_from_dLGW_interpolator(self, H0, Om, w0, Xi0, n):
+        '''
+        Returns the interpolator used by z_from_dLGW_fast, so that it can be re-used 
+        for several arrays of distances with the same cosmology
+        '''
         if (Om==self.baseValues['Om']) & (w0==-1.):
             dLGrid = self.dLGridGlobals/H0*self.baseValues['H0']
         else:
@@ -197,7 +245,127 @@ class Cosmo(object):
                 cosmo = FlatwCDM(H0=H0, Om0=Om, w0=w0, )
             dLGrid = cosmo.luminosity_distance(self.zGridGlobals).to(self.dist_unit).value
         z2dL = interpolate.interp1d( dLGrid*self.Xi(self.zGridGlobals, Xi0, n), self.zGridGlobals, kind='cubic', bounds_error=False, fill_value=(0,np.NaN), assume_sorted=False)
-        return z2dL(r)
+        return z2dL
+
+    def grad_z_from_dLGW(self, z, dL, H0, Om, w0, Xi0, n, params=None):
+        '''
+        Derivatives of the redshift z(dL) wrt the cosmological parameters in params (default: all),
+        at fixed GW luminosity distance dL. Uses dz/dparam = - (d dL/dparam) / (d dL/dz) .
+        All the derivatives are analytic; for Om and w0 they involve the integrals in _uu_and_derivatives
+        '''
+        if params is None:
+            params=self.params
+        ddL_dz = np.exp(self.log_ddL_dz(z, H0, Om, w0, Xi0, n, dL=dL))
+        dLEM = dL/self.Xi(z, Xi0, n)
+        if 'Om' in params or 'w0' in params:
+            uu, duu_dOm, duu_dw0 = self._uu_and_derivatives(z, Om, w0)
+        
+        grads=[]
+        for param in params:
+            if param=='H0':
+                ddL = -dL/H0
+            elif param=='Xi0':
+                ddL = dLEM*(1-(1+z)**(-n))
+            elif param=='n':
+                ddL = -dLEM*(1-Xi0)*np.log1p(z)*(1+z)**(-n)
+            elif param=='Om':
+                ddL = dL*duu_dOm/uu
+            elif param=='w0':
+                ddL = dL*duu_dw0/uu
+            else:
+                raise ValueError('Unknown cosmological parameter %s' %param)
+            grads.append(-ddL/ddL_dz)
+        return np.array(grads)
+    
+    
+    ######################
+    # DERIVATIVES OF THE JACOBIANS
+    # wrt the cosmological parameters at fixed z (and dL), and wrt z at fixed parameters (and dL).
+    # 'z' can be passed in params together with the names of the cosmological parameters.
+    ######################
+    
+    def _dE(self, z, Om, w0):
+        '''
+        E(z) for flat wCDM without radiation, and its derivatives wrt Om, w0 and z
+        '''
+        a3, aw = (1+z)**3, (1+z)**(3*(1+w0))
+        E = np.sqrt(Om*a3+(1-Om)*aw)
+        return E, (a3-aw)/(2*E), 3*(1-Om)*aw*np.log1p(z)/(2*E), 3*(Om*a3+(1+w0)*(1-Om)*aw)/(2*E*(1+z))
+    
+    
+    def _uu_and_derivatives(self, z, Om, w0, res=5000):
+        '''
+        Dimensionless comoving distance and its derivatives wrt Om and w0 at fixed z,
+        i.e. the integrals of 1/E and of -(dE/dOm)/E^2, -(dE/dw0)/E^2 .
+        They are computed with the trapezoidal rule on a grid of res points up to the maximum of z, and interpolated
+        '''
+        zGrid = np.linspace(0, max(np.nanmax(z), 1e-03), res)
+        E, dE_dOm, dE_dw0, _ = self._dE(zGrid, Om, w0)
+        return [np.interp(z, zGrid, cumtrapz(f, zGrid, initial=0)) for f in (1/E, -dE_dOm/E**2, -dE_dw0/E**2)]
+    
+    
+    def grad_log_dV_dz(self, z, H0, Om0, w0, params=None):
+        '''
+        Derivatives of log_dV_dz wrt the parameters in params (cosmological parameters and/or 'z').
+        Returns array of shape (len(params), *z.shape)
+        '''
+        if params is None:
+            params=self.params
+        E, dE_dOm, dE_dw0, dE_dz = self._dE(z, Om0, w0)
+        if 'Om' in params or 'w0' in params or 'z' in params:
+            uu, duu_dOm, duu_dw0 = self._uu_and_derivatives(z, Om0, w0)
+        grads=[]
+        for param in params:
+            if param=='H0':
+                grads.append(np.full(np.shape(z), -3/H0))
+            elif param=='Om':
+                grads.append(2*duu_dOm/uu-dE_dOm/E)
+            elif param=='w0':
+                grads.append(2*duu_dw0/uu-dE_dw0/E)
+            elif param in ('Xi0', 'n'):
+                grads.append(np.zeros(np.shape(z)))
+            elif param=='z':
+                grads.append(2/(uu*E)-dE_dz/E)
+            else:
+                raise ValueError('Unknown parameter %s' %param)
+        return np.array(grads)
+    
+    
+    def grad_log_ddL_dz(self, z, dL, H0, Om0, w0, Xi0, n, params=None):
+        '''
+        Derivatives of log_ddL_dz with dL given, wrt the parameters in params (cosmological parameters and/or 'z'),
+        at fixed dL. Returns array of shape (len(params), *z.shape)
+        '''
+        if params is None:
+            params=self.params
+        H0u = H0*1e03 if self.dist_unit==u.Gpc else H0
+        E, dE_dOm, dE_dw0, dE_dz = self._dE(z, Om0, w0)
+        # log_ddL_dz = log(A+B), with A = dL/(1+z)*(1+f), f = -n(1-Xi0)/P, P = Xi*(1+z)^n and B = c(1+z)Xi/(H0 E)
+        zn = (1+z)**n
+        P = Xi0*zn+1-Xi0
+        Xi = P/zn
+        f = -n*(1-Xi0)/P
+        A = dL/(1+z)*(1+f)
+        B = self.clight*(1+z)*Xi/(H0u*E)
+        grads=[]
+        for param in params:
+            if param=='H0':
+                d = -B/H0
+            elif param=='Om':
+                d = -B*dE_dOm/E
+            elif param=='w0':
+                d = -B*dE_dw0/E
+            elif param=='Xi0':
+                d = dL/(1+z)*(n/P+n*(1-Xi0)*(zn-1)/P**2)+B*(1-1/zn)/Xi
+            elif param=='n':
+                d = dL/(1+z)*(-(1-Xi0)/P+n*(1-Xi0)*Xi0*zn*np.log1p(z)/P**2)-B*(1-Xi0)*np.log1p(z)/(zn*Xi)
+            elif param=='z':
+                d = -A/(1+z)+dL/(1+z)*n*(1-Xi0)*Xi0*n*zn/((1+z)*P**2)+B*(1/(1+z)-n*(1-Xi0)/(zn*(1+z)*Xi)-dE_dz/E)
+            else:
+                raise ValueError('Unknown parameter %s' %param)
+            grads.append(d/(A+B))
+        return np.array(grads)
+    
 
     def z_from_dLGW(self, dL_GW_val, H0, Om, w0, Xi0, n):
         '''Returns redshift for a given luminosity distance dL_GW_val (in Mpc by default)                                         '''
@@ -11,6 +11,7 @@ from scipy.integrate import cumtrapz
 from scipy.interpolate import interp1d
 import astropy.units as u
 import os
+import json
 
 
 class Data(ABC):
@@ -26,6 +27,154 @@ class Data(ABC):
     def get_theta(self):
         pass
     
+    
+    def _apply_condition(self, condition, verbose=True):
+        '''
+        For injections: keeps only the entries satisfying condition (e.g. the detected injections), 
+        and stores all per-injection arrays as contiguous arrays, so that the selection bias 
+        can be computed without masking. N_gen is not changed. 
+        condition can be a boolean mask or an array of indices (e.g. a permutation).
+        If the entries kept are a contiguous range (e.g. a threshold on injections sorted by snr), 
+        the arrays are sliced, so memory-mapped arrays (see _load_compact) are not copied.
+        After this, self.condition is True
+        '''
+        condition = np.asarray(condition)
+        if condition.ndim==0:
+            condition = np.full(self.m1z.shape, bool(condition))
+        idx = np.flatnonzero(condition) if condition.dtype==bool else condition
+        if idx.shape[0]==0 or (idx[-1]-idx[0]+1==idx.shape[0] and np.all(np.diff(idx)==1)):
+            take = slice(idx[0], idx[-1]+1) if idx.shape[0]>0 else slice(0, 0)
+        else:
+            take = idx
+            if isinstance(self.m1z, np.memmap):
+                print('Warning: applying the condition copies the memory-mapped injections in memory. Write the selected injections once with save_compact and load them instead')
+        for name in ('m1z', 'm2z', 'dL', 'log_weights_sel', 'weights_sel', 'snr_sel'):
+            arr = getattr(self, name, None)
+            if arr is not None:
+                setattr(self, name, arr[take] if isinstance(take, slice) else np.ascontiguousarray(arr[take]))
+        self.spins = [s[take] if isinstance(take, slice) else np.ascontiguousarray(s[take]) for s in self.spins]
+        self.condition = True
+        if verbose:
+            print('Keeping %s injections satisfying the selection condition' %self.m1z.shape[0])
+    
+    
+    def subset(self, indices):
+        '''
+        For events: returns a copy of the data with only the events with the given indices
+        (e.g. to compute the likelihood of some of the events, see sample.reweight.ChainReweighter).
+        All per-event arrays (first dimension Nobs), spins and the list of events are sliced;
+        the other attributes are shared with the original object
+        '''
+        indices = np.atleast_1d(np.asarray(indices))
+        res = self.__class__.__new__(self.__class__)
+        res.__dict__.update(self.__dict__)
+        for name, val in self.__dict__.items():
+            if isinstance(val, np.ndarray) and val.ndim>0 and val.shape[0]==self.Nobs:
+                setattr(res, name, val[indices])
+        res.spins = [s[indices] for s in self.spins]
+        # Nsamples is a list for LVC data
+        res.Nsamples = np.asarray(self.Nsamples)[indices]
+        res.logNsamples = np.log(res.Nsamples)
+        if getattr(self, 'events', None) is not None:
+            res.events = [self.events[i] for i in indices]
+        res.Nobs = indices.shape[0]
+        return res
+
+
+    def _save_columns(self, path, meta):
+        '''
+        Writes the per-injection columns to path, one .npy file per column, and meta.json with meta 
+        and the list of columns
+        '''
+        os.makedirs(path, exist_ok=True)
+        columns = []
+        for name in ('m1z', 'm2z', 'dL', 'log_weights_sel', 'snr_sel'):
+            arr = getattr(self, name, None)
+            if arr is not None:
+                np.save(os.path.join(path, name+'.npy'), np.ascontiguousarray(arr, dtype=np.float64))
+                columns.append(name)
+        for j, s in enumerate(self.spins):
+            np.save(os.path.join(path, 'spin_%s.npy' %j), np.ascontiguousarray(s, dtype=np.float64))
+        meta.update({'columns': columns, 'nSpins': len(self.spins), 'dist_unit': self.dist_unit.to_string()})
+        with open(os.path.join(path, 'meta.json'), 'w') as f:
+            json.dump(meta, f, indent=2)
+    
+    
+    def _load_columns(self, path):
+        '''
+        Memory-maps the per-injection columns written by _save_columns. Returns the content of meta.json
+        '''
+        with open(os.path.join(path, 'meta.json'), 'r') as f:
+            meta = json.load(f)
+        if u.Unit(meta['dist_unit'])!=self.dist_unit:
+            raise ValueError('Injections in %s are stored with distance unit %s' %(path, meta['dist_unit']))
+        for name in meta['columns']:
+            setattr(self, name, np.load(os.path.join(path, name+'.npy'), mmap_mode='r'))
+        self.spins = [np.load(os.path.join(path, 'spin_%s.npy' %j), mmap_mode='r') for j in range(meta['nSpins'])]
+        self.weights_sel = None
+        return meta
+    
+    
+    def save_compact(self, path):
+        '''
+        For injections: preprocessing step that writes the final detector-frame columns 
+        (m1z, m2z, dL, log_weights_sel, snr if present, spins) of the detected injections 
+        to an uncompressed store in the directory path, with one .npy file per column and 
+        the scalar attributes in meta.json. 
+        The injections classes open it in place of the original file with np.memmap, see _load_compact.
+        '''
+        if self.condition is not True:
+            self._apply_condition(self.condition)
+        
+        meta = {'N_gen': float(self.N_gen), 'Tobs': float(self.Tobs)}
+        for name in ('snr_th', 'ifar_th', 'max_z'):
+            if getattr(self, name, None) is not None:
+                meta[name] = float(getattr(self, name))
+        if getattr(self, 'which_spins', None) is not None:
+            meta['which_spins'] = self.which_spins
+        if getattr(self, 'nInjUse', None) is not None:
+            meta['nInjUse'] = int(self.nInjUse)
+        self._save_columns(path, meta)
+        print('Saved %s injections to %s' %(self.m1z.shape[0], path))
+    
+    
+    @staticmethod
+    def is_compact_store(path):
+        return os.path.isfile(os.path.join(path, 'meta.json'))
+    
+    
+    def _load_compact(self, path, **requested):
+        '''
+        Opens a store written by save_compact. Columns are memory-mapped read-only, 
+        so loading is instant and the page cache is shared between processes reading the same store.
+        Only the detected injections are stored, so self.condition is True.
+        
+        requested are the options passed to the constructor that were applied when the store was written 
+        (e.g. ifar_th, nInjUse): they cannot be changed on the stored injections, 
+        so a ValueError is raised if they differ from the values in the store
+        '''
+        meta = self._load_columns(path)
+        for name, value in requested.items():
+            if meta.get(name)!=value:
+                raise ValueError('Injections in %s were stored with %s=%s, but %s=%s was requested. Write the store again with the requested options' %(path, name, meta.get(name), name, value))
+        if getattr(self, 'which_spins', None) is not None:
+            # 'skip' has no spin columns, 'chiEff' and 's1s2' have two
+            nSpins = 0 if self.which_spins=='skip' else 2
+            if meta.get('which_spins', self.which_spins)!=self.which_spins or meta['nSpins']!=nSpins:
+                raise ValueError('Injections in %s have spins %s (%s columns), but which_spins=%s' %(path, meta.get('which_spins', 'unknown'), meta['nSpins'], self.which_spins))
+        
+        self.N_gen = meta['N_gen']
+        self.logN_gen = np.log(self.N_gen)
+        self.Tobs = meta['Tobs']
+        for name in ('snr_th', 'ifar_th', 'max_z', 'nInjUse'):
+            if name in meta:
+                setattr(self, name, meta[name])
+        self.condition = True
+        print('Memory-mapped %s detected injections from %s' %(self.m1z.shape[0], path))
+        print('Number of total injections: %s' %self.N_gen)
+        print('Obs time: %s yrs' %self.Tobs )
+    
+    
     def downsample(self, nSamples=None, percSamples=None, verbose=True):
         if nSamples is None:
             return self._downsample_perc(percSamples, verbose=verbose)
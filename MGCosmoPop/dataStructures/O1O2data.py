@@ -120,7 +120,12 @@ class O1O2InjectionsData(Data):
     
     def __init__(self, fname, nInjUse=None,  dist_unit=u.Gpc, ifar_th=1 , which_spins='skip', SNR_th=None ):
         
+        self.which_spins=which_spins
         self.dist_unit=dist_unit
+        if self.is_compact_store(fname):
+            # Pre-processed injections, see Data.save_compact
+            self._load_compact(fname, ifar_th=ifar_th, nInjUse=nInjUse)
+            return
         self.m1z, self.m2z, self.dL, self.spins, self.log_weights_sel, self.N_gen, self.Tobs = self._load_data(fname, nInjUse, which_spins=which_spins )        
         self.logN_gen = np.log(self.N_gen)
         #self.log_weights_sel = np.log(self.weights_sel)
@@ -136,6 +141,7 @@ class O1O2InjectionsData(Data):
         self.ifar_th=ifar_th
         #gstlal_ifar, pycbc_ifar, pycbc_bbh_ifar = conditions_arr
         self.condition = np.full(self.m1z.shape, True) #(gstlal_ifar > ifar_th) | (pycbc_ifar > ifar_th) | (pycbc_bbh_ifar > ifar_th)
+        self._apply_condition(self.condition)
         
         
     def get_theta(self):
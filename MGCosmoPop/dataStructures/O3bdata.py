@@ -114,6 +114,10 @@ class O3InjectionsData(Data):
         
         self.which_spins=which_spins
         self.dist_unit=dist_unit
+        if self.is_compact_store(fname):
+            # Pre-processed injections, see Data.save_compact
+            self._load_compact(fname, ifar_th=ifar_th, nInjUse=nInjUse)
+            return
         self.m1z, self.m2z, self.dL, self.spins, self.log_weights_sel, self.N_gen, self.Tobs, conditions_arr = self._load_data(fname, nInjUse, which_spins=which_spins )        
         self.logN_gen = np.log(self.N_gen)
         #self.log_weights_sel = np.log(self.weights_sel)
@@ -129,6 +133,8 @@ class O3InjectionsData(Data):
         self.ifar_th=ifar_th
         gstlal_ifar, pycbc_ifar, pycbc_bbh_ifar = conditions_arr
         self.condition = (gstlal_ifar > ifar_th) | (pycbc_ifar > ifar_th) | (pycbc_bbh_ifar > ifar_th)
+        # Keep only detected injections from now on
+        self._apply_condition(self.condition)
         
         
     def get_theta(self):
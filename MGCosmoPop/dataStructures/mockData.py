@@ -97,44 +97,50 @@ class GWMockInjectionsData(Data):
     
     def __init__(self, fname, nInjUse=None,  dist_unit=u.Gpc, Tobs=2.5, snr_th=None ):
         
+        self.nInjUse=nInjUse
         self.dist_unit=dist_unit
-        self.m1z, self.m2z, self.dL, self.weights_sel, self.log_weights_sel, self.snr_sel, self.N_gen, self.snr_th = self._load_data(fname, nInjUse )
-        self.logN_gen = np.log(self.N_gen)
-        #self.log_weights_sel = np.log(self.weights_sel)
-        assert (self.m1z > 0).all()
-        assert (self.m2z > 0).all()
-        assert (self.dL > 0).all()
-        assert(self.m2z<=self.m1z).all()
-        self.condition=True
-        
-        self.Tobs=Tobs
-        self.spins = []# np.zeros(self.m1z.shape)
-        print('Obs time: %s' %self.Tobs )
+        if self.is_compact_store(fname):
+            # Pre-processed injections, see Data.save_compact.
+            # The snr threshold can be raised on the stored injections, see set_snr_threshold
+            self._load_compact(fname, nInjUse=nInjUse)
+        else:
+            self.m1z, self.m2z, self.dL, self.weights_sel, self.log_weights_sel, self.snr_sel, self.N_gen, self.snr_th = self._load_data(fname, nInjUse )
+            self.logN_gen = np.log(self.N_gen)
+            #self.log_weights_sel = np.log(self.weights_sel)
+            assert (self.m1z > 0).all()
+            assert (self.m2z > 0).all()
+            assert (self.dL > 0).all()
+            assert(self.m2z<=self.m1z).all()
+            self.condition=True
+        
+            self.Tobs=Tobs
+            self.spins = []# np.zeros(self.m1z.shape)
+            print('Obs time: %s' %self.Tobs )
+            
+            if self.snr_sel.sum()!=0.:
+                # Keep injections sorted by decreasing snr, so that the detected injections
+                # for any threshold are the first ones (see SelectionBiasInjections.Ndet_snr_sweep).
+                # Indexing with a permutation sorts all the per-injection arrays consistently
+                self._apply_condition(np.argsort(-self.snr_sel, kind='stable'), verbose=False)
         
         if snr_th is not None:
             self.set_snr_threshold(snr_th)
         
     def set_snr_threshold(self, snr_th):
+        if getattr(self, 'snr_sel', None) is None:
+            raise ValueError('Snrs are not present in these injections: a snr threshold cannot be applied')
         if self.snr_sel.sum()==0.:
             print('Snrs not present in this dataset.')
             return
-        if snr_th<self.snr_th:
+        if getattr(self, 'snr_th', None) is not None and snr_th<self.snr_th:
             #raise ValueError('New snr threshold is lower than original one !')
             print('warning: New snr threshold is lower than original one ! Using original')
             return
 
         print('Updating snr threshold to %s' %snr_th)
         self.snr_th=snr_th
-        keep = self.snr_sel >= snr_th
-        self.m1z = self.m1z[keep]
-        self.m2z = self.m2z[keep]
-        self.dL = self.dL[keep]
-        try:
-            self.weights_sel =  self.weights_sel[keep]
-        except TypeError:
-            pass
-        self.log_weights_sel = self.log_weights_sel[keep]
-        self.snr_sel = self.snr_sel[keep]
+        # Detected injections have snr>snr_th, as when they are generated (see mock/observePopulation.py)
+        self._apply_condition(self.snr_sel > snr_th, verbose=False)
         
         print('New number of detected injections with snr>%s :  %s' %(self.snr_th, self.dL.shape[0]))
 
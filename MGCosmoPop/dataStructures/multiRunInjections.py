@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+#    Copyright (c) 2021 Michele Mancarella <michele.mancarella@unige.ch>
+#
+#    All rights reserved. Use of this source code is governed by a modified BSD
+#    license that can be found in the LICENSE file.
+
+from .ABSdata import Data
+
+import hashlib
+import numpy as np
+
+
+
+class MultiRunInjectionsData(Data):
+
+    '''
+    Injection sets of several runs (e.g. O1O2, O3a, O3b) merged in one flat store.
+    Injections of each run are a contiguous segment, starting at offsets[i].
+    run_index gives the run of each injection; logN_gen and Tobs are arrays with one entry per run.
+
+    After merging, the per-run objects hold views into the merged arrays,
+    so memory is not duplicated.
+    Merging copies the arrays of each run. If path is given, the merged arrays are written there once
+    (see Data.save_compact) and memory-mapped, so that processes using the same store share them.
+    '''
+
+    def __init__(self, injData, path=None ):
+        '''
+
+        Parameters
+        ----------
+        injData : list of Data objects containing injections.
+                  The selection condition is applied to each of them if not done already.
+        path : str, optional
+            directory of the merged store. If it contains a store written for the same runs 
+            (same content hash, see _content_hash), the merged arrays are memory-mapped from it; 
+            otherwise the runs are merged and written to it. A store written for different runs raises ValueError
+
+        '''
+        self.dist_unit = injData[0].dist_unit
+        self._load_data(injData, path=path)
+
+
+    def _load_data(self, injData, path=None):
+
+        for injData_ in injData:
+            if injData_.condition is not True:
+                injData_._apply_condition(injData_.condition)
+
+        if len(set(len(injData_.spins) for injData_ in injData))>1:
+            raise ValueError('All injection sets should have the same spin variables to be merged')
+
+        self.nRuns = len(injData)
+        self.counts = np.array([injData_.m1z.shape[0] for injData_ in injData])
+        self.offsets = np.concatenate([[0], np.cumsum(self.counts)[:-1]])
+        self.run_index = np.repeat(np.arange(self.nRuns), self.counts)
+
+        self.logN_gen = np.array([injData_.logN_gen for injData_ in injData])
+        self.N_gen = np.exp(self.logN_gen)
+        self.Tobs = np.array([injData_.Tobs for injData_ in injData])
+        self.logTobs = np.log(self.Tobs)
+        self.condition = True
+        if path is not None:
+            self.hash = self._content_hash(injData)
+
+        if path is not None and self.is_compact_store(path):
+            meta = self._load_columns(path)
+            if meta.get('hash')!=self.hash:
+                raise ValueError('The merged store in %s was written for different injection sets (counts %s, N_gen %s, hash %s)' %(path, meta.get('counts'), meta.get('N_gen'), meta.get('hash')))
+            print('Memory-mapped merged injections from %s' %path)
+        else:
+            for name in ('m1z', 'm2z', 'dL', 'log_weights_sel'):
+                setattr(self, name, np.concatenate([getattr(injData_, name) for injData_ in injData]))
+            self.spins = [np.concatenate([injData_.spins[j] for injData_ in injData]) for j in range(len(injData[0].spins))]
+            if path is not None:
+                self._save_columns(path, {'counts': self.counts.tolist(), 'N_gen': self.N_gen.tolist(), 'Tobs': self.Tobs.tolist(), 'hash': self.hash})
+                self._load_columns(path)
+                print('Saved merged injections to %s' %path)
+
+        for i, injData_ in enumerate(injData):
+            sl = slice(self.offsets[i], self.offsets[i]+self.counts[i])
+            for name in ('m1z', 'm2z', 'dL', 'log_weights_sel'):
+                setattr(injData_, name, getattr(self, name)[sl])
+            injData_.spins = [s[sl] for s in self.spins]
+
+        print('Merged %s injection sets, total %s injections' %(self.nRuns, self.m1z.shape[0]))
+
+
+    def _content_hash(self, injData):
+        '''
+        Hash of N_gen, Tobs and of the shape, dtype and content of the columns of each run. 
+        Contiguous (also memory-mapped) arrays are hashed without copies
+        '''
+        hasher = hashlib.sha1(repr([self.counts.tolist(), self.N_gen.tolist(), self.Tobs.tolist()]).encode())
+        for injData_ in injData:
+            for arr in [injData_.m1z, injData_.m2z, injData_.dL, injData_.log_weights_sel, *injData_.spins]:
+                arr = np.ascontiguousarray(arr)
+                hasher.update(('%s%s' %(arr.shape, arr.dtype.str)).encode())
+                hasher.update(arr)
+        return hasher.hexdigest()
+
+
+    def get_theta(self):
+        return np.array( [self.m1z, self.m2z, self.dL, self.spins  ] )
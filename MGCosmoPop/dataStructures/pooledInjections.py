@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+#    Copyright (c) 2021 Michele Mancarella <michele.mancarella@unige.ch>
+#
+#    All rights reserved. Use of this source code is governed by a modified BSD
+#    license that can be found in the LICENSE file.
+
+from .ABSdata import Data
+
+import numpy as np
+
+
+
+class PooledInjectionsData(Data):
+
+    '''
+    Pools several injection sets for the same run (e.g. LVC injections and injections
+    from mock/generateInjections.py) into a single set used by SelectionBiasInjections,
+    with N_gen = sum_k N_gen_k.
+
+    The sets must use the same detection criterion (threshold on the snr or on the ifar),
+    otherwise they do not estimate the same selection function and an error is raised.
+
+    If the draw probability of every set can be evaluated at any point (log_p_draw_funcs),
+    each injection is weighted by the mixture
+        p_draw(theta) = sum_k N_gen_k/N_gen p_draw_k(theta) ,
+    and the pooled set is a single set drawn from the mixture.
+    Otherwise (fallback), each injection keeps the p_draw of its own set. The pooled mu is then
+        mu = sum_k N_gen_k/N_gen mu_k ,
+    i.e. the average of the estimates of the single sets weighted by their number of injections, and not
+    the mixture estimator. It is unbiased only if each set covers the support of the population,
+    and its variance is larger than with the mixture when the draw distributions differ.
+    In both cases, mu, its error and Neff computed by SelectionBiasInjections refer to the pooled set.
+    '''
+
+    def __init__(self, injData, log_p_draw_funcs=None, Tobs=None ):
+        '''
+
+        Parameters
+        ----------
+        injData : list of Data objects containing injections.
+                  The selection condition is applied to each of them if not done already.
+        log_p_draw_funcs : list of callables, optional
+            one for each set, with signature f(m1z, m2z, dL, spins) returning log p_draw
+            in detector frame, normalized in the same way as log_weights_sel
+        Tobs : float, optional
+            observation time in yrs. If None, the sets should have the same Tobs
+
+        '''
+        self.dist_unit = injData[0].dist_unit
+        self._load_data(injData, log_p_draw_funcs, Tobs)
+
+
+    def _load_data(self, injData, log_p_draw_funcs, Tobs):
+
+        for injData_ in injData:
+            if injData_.condition is not True:
+                injData_._apply_condition(injData_.condition)
+
+        criteria = [self._detection_criterion(injData_) for injData_ in injData]
+        if len(set(criteria))>1:
+            raise ValueError('Injection sets have different detection criteria (snr_th, ifar_th): %s. They cannot be pooled' %str(criteria))
+        self.snr_th, self.ifar_th = criteria[0]
+
+        if len(set(len(injData_.spins) for injData_ in injData))>1:
+            raise ValueError('All injection sets should have the same spin variables to be pooled')
+        if Tobs is None:
+            allTobs = np.array([injData_.Tobs for injData_ in injData])
+            if not np.allclose(allTobs, allTobs[0]):
+                raise ValueError('Injection sets have different observation times %s. Pass Tobs explicitly to pool them' %str(allTobs))
+            Tobs = allTobs[0]
+        self.Tobs = Tobs
+
+        self.nSets = len(injData)
+        self.N_gen_sets = np.array([injData_.N_gen for injData_ in injData], dtype=float)
+        self.N_gen = self.N_gen_sets.sum()
+        self.logN_gen = np.log(self.N_gen)
+        self.set_index = np.repeat(np.arange(self.nSets), [injData_.m1z.shape[0] for injData_ in injData])
+
+        for name in ('m1z', 'm2z', 'dL'):
+            setattr(self, name, np.concatenate([getattr(injData_, name) for injData_ in injData]))
+        self.spins = [np.concatenate([injData_.spins[j] for injData_ in injData]) for j in range(len(injData[0].spins))]
+
+        if log_p_draw_funcs is None:
+            self.log_weights_sel = np.concatenate([injData_.log_weights_sel for injData_ in injData])
+        else:
+            logp = np.array([f(self.m1z, self.m2z, self.dL, self.spins) for f in log_p_draw_funcs])
+            self.log_weights_sel = np.logaddexp.reduce(logp+np.log(self.N_gen_sets/self.N_gen)[:, np.newaxis], axis=0)
+        self.condition = True
+
+        if log_p_draw_funcs is None and self.nSets>1:
+            print('No draw probabilities given: each injection keeps the p_draw of its own set')
+        print('Pooled %s injection sets: %s detected injections, %s total injections' %(self.nSets, self.m1z.shape[0], self.N_gen))
+        if log_p_draw_funcs is not None:
+            print('Using mixture p_draw with weights %s' %str(self.N_gen_sets/self.N_gen))
+
+
+    @staticmethod
+    def _detection_criterion(injData):
+        '''
+        Thresholds on snr and ifar used to select the injections (None if not used)
+        '''
+        return tuple(None if getattr(injData, name, None) is None else float(getattr(injData, name)) for name in ('snr_th', 'ifar_th'))
+
+
+    def get_theta(self):
+        return np.array( [self.m1z, self.m2z, self.dL, self.spins  ] )
@@ -15,6 +15,31 @@ import numpy as np
 ########################################################################
 ########################################################################
 
+
+def num_grad(f, Lambda, names, params=None, eps=1e-05):
+    '''
+    Central finite difference of the vectorized function f(Lambda) wrt 
+    the entries of Lambda whose names are in params (all of them if params is None).
+    Returns array of shape (len(params), *f(Lambda).shape ). 
+    Points where f is not finite have zero derivative.
+    '''
+    if params is None:
+        params = names
+    Lambda = np.array(Lambda, dtype=float)
+    grads = []
+    for param in params:
+        i = names.index(param)
+        h = eps*max(abs(Lambda[i]), 1.)
+        Lp, Lm = Lambda.copy(), Lambda.copy()
+        Lp[i] += h
+        Lm[i] -= h
+        fp, fm = f(list(Lp)), f(list(Lm))
+        with np.errstate(invalid='ignore'):
+            grads.append( np.where( np.isfinite(fp) & np.isfinite(fm), (fp-fm)/(2*h), 0.) )
+    return np.array(grads)
+
+
+
 # Abstract logic for a single population . Should implement the differential merger rate dR/dm1dm2
 
 class Population(ABC):
@@ -38,6 +63,29 @@ class Population(ABC):
         # How to set the values of the population parameters
         # Must change them also in other objects that enter the population !
         pass
+    
+    
+    def grad_log_dR_dm1dm2(self, m1, m2, z, spins, LambdaPop, params=None, eps=1e-05):
+        '''
+        Derivatives of log dR/dm1dm2 wrt the parameters of the population, at fixed m1, m2, z.
+        Returns array of shape (len(params), len(m1)). 
+        Default is a central finite difference of log_dR_dm1dm2; populations can override it
+        '''
+        f = lambda lam: self.log_dR_dm1dm2(m1, m2, z, spins, lam)
+        return num_grad(f, LambdaPop, self.params, params=params, eps=eps)
+    
+    
+    def dlog_dR_dm1dm2_dz(self, m1, m2, z, spins, LambdaPop, eps=1e-05):
+        '''
+        Derivative of log dR/dm1dm2 wrt z at fixed detector-frame masses m1(1+z), m2(1+z).
+        Default is a central finite difference along z; populations can override it.
+        Zero where log dR/dm1dm2 is not finite on either side
+        '''
+        h = eps*(1+z)
+        fp = self.log_dR_dm1dm2(m1*(1+z)/(1+z+h), m2*(1+z)/(1+z+h), z+h, spins, LambdaPop)
+        fm = self.log_dR_dm1dm2(m1*(1+z)/(1+z-h), m2*(1+z)/(1+z-h), z-h, spins, LambdaPop)
+        with np.errstate(invalid='ignore'):
+            return np.where( np.isfinite(fp) & np.isfinite(fm), (fp-fm)/(2*h), 0.)
 
 
 
@@ -55,6 +103,24 @@ class RateEvolution(ABC):
         pass
     
     
+    def grad_log_dNdVdt(self, theta, lambdaBBHrate, params=None, eps=1e-05):
+        '''
+        Derivatives of log dN/dVdt wrt the parameters of the rate, at fixed theta.
+        Default is a central finite difference; rate models can override it with analytic expressions
+        '''
+        f = lambda lam: self.log_dNdVdt(theta, lam)
+        return num_grad(f, lambdaBBHrate, self.params, params=params, eps=eps)
+    
+    
+    def dlog_dNdVdt_dz(self, z, lambdaBBHrate, eps=1e-05):
+        '''
+        Derivative of log dN/dVdt wrt z.
+        Default is a central finite difference; rate models can override it with analytic expressions
+        '''
+        h = eps*(1+z)
+        return (self.log_dNdVdt(z+h, lambdaBBHrate)-self.log_dNdVdt(z-h, lambdaBBHrate))/(2*h)
+    
+    
     def _set_values(self, values_dict):
     # update value also in this object
             #print('rate basevalues: %s' %str(self.baseValues))
@@ -92,6 +158,34 @@ class BBHDistFunction(ABC):
         pass
     
     
+    def grad_logpdf(self, theta, lambdaBBH, params=None, eps=1e-05):
+        '''
+        Derivatives of logpdf wrt the parameters of the distribution, at fixed theta.
+        Default is a central finite difference; distributions can override it with analytic expressions
+        '''
+        f = lambda lam: self.logpdf(theta, lam)
+        return num_grad(f, lambdaBBH, self.params, params=params, eps=eps)
+    
+    
+    def grad_logpdf_theta(self, theta, lambdaBBH, eps=1e-05):
+        '''
+        Derivatives of logpdf wrt each of the variables in theta (e.g. m1, m2), at fixed parameters.
+        Returns array of shape (len(theta), *theta[0].shape).
+        Default is a central finite difference; distributions can override it with analytic expressions.
+        Zero where logpdf is not finite on either side
+        '''
+        theta = [np.asarray(t, dtype=float) for t in theta]
+        grads = []
+        for i in range(len(theta)):
+            h = eps*np.maximum(np.abs(theta[i]), 1.)
+            thp, thm = list(theta), list(theta)
+            thp[i], thm[i] = theta[i]+h, theta[i]-h
+            fp, fm = self.logpdf(thp, lambdaBBH), self.logpdf(thm, lambdaBBH)
+            with np.errstate(invalid='ignore'):
+                grads.append( np.where( np.isfinite(fp) & np.isfinite(fm), (fp-fm)/(2*h), 0.) )
+        return np.array(grads)
+    
+    
     def _sample_pdf(self, nSamples, pdf, lower, upper):
         res = 100000
         eps=1e-02
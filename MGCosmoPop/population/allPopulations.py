@@ -8,6 +8,7 @@ Created on Tue Mar  2 16:31:45 2021
 import numpy as np
 #import cosmo
 from copy import deepcopy
+from posteriors.profiling import profiled
 
 # Logic for dN/dtheta with multiple populations (e.g. astro-ph BHs, primordial BHs, ... )
 
@@ -50,6 +51,7 @@ class AllPopulations(object):
     #########################################################################
     # Differential Rate
     
+    @profiled
     def log_dN_dm1dm2dz(self, m1, m2, z, spins, Tobs, Lambda):
         
         LambdaCosmo, LambdaAllPop = self._split_params(Lambda)
@@ -79,6 +81,7 @@ class AllPopulations(object):
         #return np.where( ~np.isnan(m1), logN, np.NINF)
     
     
+    @profiled
     def log_dN_dm1zdm2zddL(self, m1, m2, z, spins, Tobs, Lambda, dL=None):
         LambdaCosmo, LambdaAllPop = self._split_params(Lambda)
         H0, Om0, w0, Xi0, n = self.cosmo._get_values(LambdaCosmo, ['H0', 'Om', 'w0', 'Xi0', 'n'])
@@ -94,7 +97,106 @@ class AllPopulations(object):
         res[where_compute] = logdN
         return res
         #return np.where( ~np.isnan(m1), self.log_dN_dm1dm2dz(m1, m2, z, spins, Tobs, Lambda)-self._log_dMsourcedMdet(z) - self.cosmo.log_ddL_dz(z, H0, Om0, w0, Xi0, n ) , np.NINF)
-    
+
+
+    @profiled
+    def log_dN_dm1zdm2zddL_batch(self, m1z, m2z, dL, spins, Tobs, Lambdas, z):
+        '''
+        log_dN_dm1zdm2zddL for several values of Lambda, at the same detector-frame masses m1z, m2z and GW luminosity distance dL.
+        z has shape (len(Lambdas), len(dL)) and is the redshift corresponding to dL for each value of Lambda.
+
+        Terms that only depend on the cosmology are evaluated for all the values of Lambda at once (see Cosmo.log_dV_dz_vec);
+        the differential rate of each population is evaluated with one call per value of Lambda.
+
+        Returns
+        -------
+        array of shape (len(Lambdas), len(dL))
+
+        '''
+        LambdaCosmo = np.array([self._split_params(Lambda)[0] for Lambda in Lambdas])
+        H0, Om0, w0, Xi0, n = [x[:, None] for x in self.cosmo._get_values(LambdaCosmo.T, ['H0', 'Om', 'w0', 'Xi0', 'n'])]
+
+        m1, m2 = m1z/(1+z), m2z/(1+z)
+        with np.errstate(invalid='ignore'):
+            logdN = np.log(Tobs)-np.log1p(z)+self.cosmo.log_dV_dz_vec(z, dL, H0, Om0, w0, Xi0, n)-self._log_dMsourcedMdet(z)-self.cosmo.log_ddL_dz_vec(z, dL, H0, Om0, w0, Xi0, n)
+
+        for k, Lambda in enumerate(Lambdas):
+            LambdaAllPop = self._split_params(Lambda)[1]
+            where_compute = ~np.isnan(m1[k])
+            spinsk = [s[where_compute] for s in spins]
+            logdNk = logdN[k, where_compute]
+            prev=0
+            for i,pop in enumerate(self._pops):
+                LambdaPop = LambdaAllPop[prev:prev+self._allNParams[i]]
+                logdNk += pop.log_dR_dm1dm2(m1[k, where_compute], m2[k, where_compute], z[k, where_compute], spinsk, LambdaPop)
+                prev+=self._allNParams[i]
+            logdN[k, where_compute] = logdNk
+            logdN[k, ~where_compute] = np.NINF
+
+        return logdN
+
+
+
+    @profiled
+    def grad_log_dN_dm1zdm2zddL(self, m1, m2, z, spins, Tobs, Lambda, params_inference, dL):
+        '''
+        Derivatives of log dN/(dm1z dm2z ddL) wrt the parameters in params_inference, 
+        at fixed detector-frame masses and GW luminosity distance dL .
+        m1, m2, z are the source-frame masses and redshift corresponding to the detector-frame quantities for the value Lambda.
+        
+        Population parameters only enter through the differential rate of each population.
+        Cosmological parameters also change the redshift (hence source-frame masses) corresponding to dL; 
+        this is propagated with the chain rule using the analytic dz/dparam from Cosmo and the 
+        derivative of each population along z at fixed detector-frame quantities (Population.dlog_dR_dm1dm2_dz).
+        All cosmological terms are analytic; the population terms are analytic for the populations that 
+        implement them and finite differences otherwise (see Population).
+
+        Returns
+        -------
+        grads : array of shape (len(params_inference), *m1.shape ). Zero where m1 is nan
+
+        '''
+        LambdaCosmo, LambdaAllPop = self._split_params(Lambda)
+        H0, Om0, w0, Xi0, n = self.cosmo._get_values(LambdaCosmo, ['H0', 'Om', 'w0', 'Xi0', 'n'])
+        
+        where_compute=~np.isnan(m1)
+        grads = np.zeros((len(params_inference),)+m1.shape)
+        
+        m1, m2, z, dL, spins = m1[where_compute], m2[where_compute], z[where_compute], dL[where_compute], [s[where_compute] for s in spins]
+        
+        # Population parameters
+        prev=0
+        for i,pop in enumerate(self._pops):
+            LambdaPop = LambdaAllPop[prev:prev+self._allNParams[i]]
+            popParams = [param for param in pop.params if param in params_inference]
+            if len(popParams)>0:
+                gradPop = pop.grad_log_dR_dm1dm2(m1, m2, z, spins, LambdaPop, params=popParams)
+                for j,param in enumerate(popParams):
+                    grads[params_inference.index(param)][where_compute] += gradPop[j]
+            prev+=self._allNParams[i]
+        
+        # Cosmological parameters
+        cosmoParams = [param for param in self.cosmo.params if param in params_inference]
+        if len(cosmoParams)>0:
+            
+            # explicit dependence through the volume element and the jacobian d(dL)/dz, at fixed z and dL.
+            # The last row is the derivative wrt z
+            gradJac = self.cosmo.grad_log_dV_dz(z, H0, Om0, w0, params=cosmoParams+['z'])-self.cosmo.grad_log_ddL_dz(z, dL, H0, Om0, w0, Xi0, n, params=cosmoParams+['z'])
+            
+            # dependence through z(dL), at fixed detector-frame quantities.
+            # -3/(1+z) comes from the time dilation and from the jacobian between source and detector-frame masses
+            dz = self.cosmo.grad_z_from_dLGW(z, dL, H0, Om0, w0, Xi0, n, params=cosmoParams)
+            dlogdN_dz = gradJac[-1]-3/(1+z)
+            prev=0
+            for i,pop in enumerate(self._pops):
+                LambdaPop = LambdaAllPop[prev:prev+self._allNParams[i]]
+                dlogdN_dz = dlogdN_dz + pop.dlog_dR_dm1dm2_dz(m1, m2, z, spins, LambdaPop)
+                prev+=self._allNParams[i]
+            
+            for j,param in enumerate(cosmoParams):
+                grads[params_inference.index(param)][where_compute] += gradJac[j]+dlogdN_dz*dz[j]
+        
+        return grads
     
     
     def logdN_dz(self, z, H0, Om0, w0, lambdaBBHrate, pop):
@@ -240,6 +240,51 @@ class TruncPowerLawMass(BBHDistFunction):
         elif (alpha > 1) :
             return -np.log(alpha-1)+utils.logdiffexp(  (1-alpha)*np.log(ml), (1-alpha)*np.log(mh) )
         raise ValueError
+    
+    
+    def grad_logpdf(self, theta, lambdaBBHmass, params=None, **kwargs):
+        '''
+        Derivatives of log p(m1, m2 | Lambda ) wrt alpha, beta, ml, mh.
+        The derivative is set to zero outside the support
+        '''
+        m1, m2 = theta
+        alpha, beta, ml, mh = lambdaBBHmass
+        
+        where_compute = (m2 < m1) & (ml < m2) & (m1 < mh )
+        m1c, m2c = np.where(where_compute, m1, 2*ml), np.where(where_compute, m2, ml)
+        
+        # d log C(m1) 
+        x1b, xlb = m1c**(1+beta), ml**(1+beta)
+        dC_dbeta = 1/(1+beta) - (np.log(m1c)*x1b-np.log(ml)*xlb)/(x1b-xlb)
+        dC_dml = (1+beta)*ml**beta/(x1b-xlb)
+        
+        # d log Norm
+        xha, xla = mh**(1-alpha), ml**(1-alpha)
+        dN_dalpha = 1/(1-alpha) - (np.log(mh)*xha-np.log(ml)*xla)/(xha-xla)
+        dN_dml = -(1-alpha)*ml**(-alpha)/(xha-xla)
+        dN_dmh = (1-alpha)*mh**(-alpha)/(xha-xla)
+        
+        allGrads = { 'alpha': -np.log(m1c)-dN_dalpha,
+                     'beta': np.log(m2c)+dC_dbeta,
+                     'ml': dC_dml-dN_dml,
+                     'mh': np.full(m1c.shape, -dN_dmh) }
+        if params is None:
+            params=self.params
+        return np.where(where_compute, np.array([allGrads[param] for param in params]), 0.)
+    
+    
+    def grad_logpdf_theta(self, theta, lambdaBBHmass, **kwargs):
+        '''
+        Derivatives of log p(m1, m2 | Lambda ) wrt m1 and m2. Zero outside the support
+        '''
+        m1, m2 = theta
+        alpha, beta, ml, mh = lambdaBBHmass
+        
+        where_compute = (m2 < m1) & (ml < m2) & (m1 < mh )
+        m1c, m2c = np.where(where_compute, m1, 2*ml), np.where(where_compute, m2, ml)
+        dm1 = -alpha/m1c - (1+beta)*m1c**beta/(m1c**(1+beta)-ml**(1+beta))
+        dm2 = beta/m2c
+        return np.where(where_compute, np.array([dm1, dm2]), 0.)
        
     
     def sample(self, nSamples, lambdaBBHmass):
@@ -316,6 +361,29 @@ class BrokenPowerLawMass(BBHDistFunction):
         return s
     
     
+    def _dlogS(self, m, deltam, ml,):
+        '''
+        Derivatives of _logS wrt m, deltam, ml. Array of shape (3, *m.shape), zero outside (ml, ml+deltam)
+        '''
+        maskM = (m > ml) & (m < ml + deltam)
+        x = np.where(maskM, m-ml, deltam/2)
+        f = deltam/x + deltam/(x - deltam)
+        dlogS_df = -np.exp(-np.logaddexp(0, -f))
+        df_dm = -deltam/x**2 - deltam/(x-deltam)**2
+        df_ddeltam = 1/x + x/(x-deltam)**2
+        return np.where(maskM, dlogS_df*np.array([df_dm, df_ddeltam, -df_dm]), 0.)
+    
+    
+    def _int_pl(self, k, lo, hi):
+        '''
+        Integrals of m^k and of m^k log(m) between lo and hi
+        '''
+        if k == -1:
+            return np.log(hi/lo), (np.log(hi)**2-np.log(lo)**2)/2
+        Fh, Fl = hi**(k+1)/(k+1), lo**(k+1)/(k+1)
+        return Fh-Fl, Fh*(np.log(hi)-1/(k+1))-Fl*(np.log(lo)-1/(k+1))
+    
+    
     def _logpdfm1(self, m,  alpha1, alpha2, deltam, ml, mh, b):
         '''
         Marginal distribution p(m1), not normalised
@@ -382,31 +450,57 @@ class BrokenPowerLawMass(BBHDistFunction):
         
     
     
-    def _logC(self, m, beta, deltam, ml, res = 200, exact_th=0.):
+    def _logC(self, m, beta, deltam, ml, res = 1000, exact_th=0.):
         '''
         Gives inverse log integral of  p(m1, m2) dm2 (i.e. log C(m1) in the LVC notation )
         '''
-        xlow=np.linspace(ml, ml+deltam+deltam/10, 200)
-        xup=np.linspace(ml+deltam+deltam/10+1e-01, m[~np.isnan(m)].max(), res)
-        xx=np.sort(np.concatenate([xlow,xup], ))
-  
-        p2 = np.exp(self._logpdfm2( xx , beta, deltam, ml))
-        cdf = cumtrapz(p2, xx)
-        
+        return -np.log(self._intC(m, beta, deltam, ml, res=res, exact_th=exact_th))
+    
+    
+    def _intC(self, m, beta, deltam, ml, res = 1000, exact_th=0., grad=False):
+        '''
+        Integral of p(m2) between ml and m. 
+        The smoothing window (ml, ml+deltam) is integrated numerically with res points, 
+        the power law above the window analytically.
+        If grad, returns also the derivatives of the integral wrt beta, deltam, ml
+        '''
+        e = ml+deltam
         where_compute = ~np.isnan(m)
         where_exact = m <exact_th*ml
-        
-        where_approx = (~where_exact) & (where_compute)
-        
-        
-        result = np.empty_like(m)
-        
-        result[~where_compute]=np.NINF
-        result[where_exact]=self._logCexact(m[where_exact], beta, deltam, ml,) #np.NINF
-        
-        result[where_approx] = -np.log( np.interp(m[where_approx], xx[1:], cdf) )
-        
-        return result
+        where_up = where_compute & (m>=e)
+        where_win = where_compute & (m<e) & (~where_exact)
+        
+        def integrands(x):
+            p2 = np.exp(self._logpdfm2( x , beta, deltam, ml))
+            if not grad:
+                return [p2, ]
+            dlogS = self._dlogS(x, deltam, ml)
+            return [p2, p2*np.log(x), p2*dlogS[1], p2*dlogS[2]]
+        
+        xx = np.linspace(ml, e, res)
+        fxx = integrands(xx)
+        cdfs = [cumtrapz(f, xx, initial=0) for f in fxx]
+        
+        # inside the window, add the trapezoid between the closest grid point below m and m
+        mw = m[where_win]
+        k = np.clip(np.searchsorted(xx, mw, side='right')-1, 0, res-1)
+        fm = integrands(mw)
+        result = np.full((len(fxx), )+m.shape, np.nan)
+        for i,cdf in enumerate(cdfs):
+            result[i, where_win] = cdf[k]+(mw-xx[k])*(fxx[i][k]+fm[i])/2
+        
+        P, Q = self._int_pl(beta, e, m[where_up])
+        result[0, where_up] = cdfs[0][-1]+P
+        if grad:
+            result[1, where_up] = cdfs[1][-1]+Q
+            result[2, where_up] = cdfs[2][-1]
+            result[3, where_up] = cdfs[3][-1]
+        
+        if where_exact.any():
+            result[0, where_exact] = np.exp(-self._logCexact(m[where_exact], beta, deltam, ml,))
+        if grad:
+            return result
+        return result[0]
     
     
     def _logCexact(self, m, beta, deltam, ml, res=1000):
@@ -423,28 +517,121 @@ class BrokenPowerLawMass(BBHDistFunction):
         
 
 
-    def _logNorm(self, alpha1, alpha2, deltam, ml, mh, b , res=200):
+    def _logNorm(self, alpha1, alpha2, deltam, ml, mh, b , res=1000):
         '''
         Gives log integral of  p(m1, m2) dm1 dm2 (i.e. total normalization of mass function )
 
         '''
-        
-        
+        return np.log(self._intNorm(alpha1, alpha2, deltam, ml, mh, b , res=res))
+    
+    
+    def _intNorm(self, alpha1, alpha2, deltam, ml, mh, b , res=1000, grad=False):
+        '''
+        Integral of p(m1) between ml and mh. 
+        The smoothing window (ml, ml+deltam) is integrated numerically with res points, 
+        the two power laws above the window analytically.
+        If grad, returns also the derivatives of the integral wrt  alpha1, alpha2, deltam, ml, mh, b
+        '''
+        mbr = self._get_Mbreak( ml, mh, b)
+        e = min(ml+deltam, mh)
+        # derivatives of the break mass wrt ml, mh, b
+        dmbr = np.array([1-b, b, mh-ml])
+        
+        xx = np.linspace(ml, e, res)
+        logp1 = self._logpdfm1( xx ,alpha1, alpha2, deltam, ml, mh, b )
+        p1 = np.exp(logp1)
+        if not grad:
+            I = np.trapz(p1, xx)
+        else:
+            above = xx>=mbr
+            dlogS = self._dlogS(xx, deltam, ml)
+            dlogp1 = [ np.where(above, -np.log(mbr), -np.log(xx)),
+                       np.where(above, np.log(mbr)-np.log(xx), 0.),
+                       dlogS[1],
+                       dlogS[2]+ above*(alpha2-alpha1)/mbr*dmbr[0],
+                       above*(alpha2-alpha1)/mbr*dmbr[1],
+                       above*(alpha2-alpha1)/mbr*dmbr[2],
+                      ]
+            I = np.trapz(p1*np.array([np.ones(res)]+dlogp1), xx, axis=-1)
+        
+        # first power law, between the end of the window and the break
+        lo, hi = e, max(e, min(mbr, mh))
+        if hi>lo:
+            P, Q = self._int_pl(-alpha1, lo, hi)
+            if not grad:
+                I += P
+            else:
+                I += np.array([P, -Q, 0, 0, 0, 0, 0])
+        
+        # second power law, between the break and mh
+        lo, hi = max(e, mbr), mh
+        if hi>lo:
+            c = mbr**(alpha2-alpha1)
+            P, Q = self._int_pl(-alpha2, lo, hi)
+            if not grad:
+                I += c*P
+            else:
+                dc = (alpha2-alpha1)/mbr*dmbr*c*P
+                I += np.array([c*P, -np.log(mbr)*c*P, c*(np.log(mbr)*P-Q), 0, dc[0], dc[1], dc[2]])
+        
+        if grad:
+            # boundary term from mh
+            I[5] += np.exp(self._logpdfm1( np.array([mh], dtype=float) ,alpha1, alpha2, deltam, ml, mh, b ))[0]
+        return I
+    
+    
+    def grad_logpdf(self, theta, lambdaBBHmass, params=None, res=1000, **kwargs):
+        '''
+        Derivatives of log p(m1, m2 | Lambda ) wrt the parameters.
+        Analytic, except for the integrals over the smoothing window (ml, ml+deltam) that enter 
+        the normalizations, which are computed numerically on the same grid as in logpdf.
+        The derivative is set to zero outside the support
+        '''
+        m1, m2 = theta
+        alpha1, alpha2, beta, deltam, ml, mh, b = lambdaBBHmass
         mbr = self._get_Mbreak( ml, mh, b)
         
-
-        ms1 = np.linspace(1., ml+deltam+deltam/10, 200)
-        ms2 = np.linspace( ml+deltam+deltam/10+1e-01, mbr-mbr/10, int(res/2) )
-        ms3= np.linspace( mbr-mbr/10+1e-01, mbr+mbr/10, 50 )
-        ms3 = np.linspace(mbr+mbr/10+1e-01, mh+mh/2, int(res/2) )
+        where_compute = (m2 < m1) & (ml< m2) & (m1 < mh ) & (~np.isnan(m1))
+        m1c, m2c = np.where(where_compute, m1, mh), np.where(where_compute, m2, ml+deltam)
+        above = m1c>=mbr
+        dbr = (alpha2-alpha1)/mbr*np.array([1-b, b, mh-ml])
+        
+        dS1, dS2 = self._dlogS(m1c, deltam, ml), self._dlogS(m2c, deltam, ml)
+        IC = self._intC(m1c, beta, deltam, ml, res=res, grad=True)
+        IN = self._intNorm(alpha1, alpha2, deltam, ml, mh, b , res=res, grad=True)
+        dlogC, dlogN = -IC[1:]/IC[0], IN[1:]/IN[0]
+        
+        allGrads = { 'alpha1': np.where(above, -np.log(mbr), -np.log(m1c))-dlogN[0],
+                     'alpha2': np.where(above, np.log(mbr)-np.log(m1c), 0.)-dlogN[1],
+                     'beta': np.log(m2c)+dlogC[0],
+                     'deltam': dS1[1]+dS2[1]+dlogC[1]-dlogN[2],
+                     'ml': dS1[2]+dS2[2]+above*dbr[0]+dlogC[2]-dlogN[3],
+                     'mh': above*dbr[1]-dlogN[4],
+                     'b': above*dbr[2]-dlogN[5],
+                    }
+        if params is None:
+            params=self.params
+        return np.where(where_compute, np.array([allGrads[param] for param in params]), 0.)
+    
+    
+    def grad_logpdf_theta(self, theta, lambdaBBHmass, res=1000, **kwargs):
+        '''
+        Derivatives of log p(m1, m2 | Lambda ) wrt m1 and m2. Zero outside the support
+        '''
+        m1, m2 = theta
+        alpha1, alpha2, beta, deltam, ml, mh, b = lambdaBBHmass
+        mbr = self._get_Mbreak( ml, mh, b)
         
-        ms=np.sort(np.concatenate([ms1,ms2, ms3], ))
+        where_compute = (m2 < m1) & (ml< m2) & (m1 < mh ) & (~np.isnan(m1))
+        m1c, m2c = np.where(where_compute, m1, mh), np.where(where_compute, m2, ml+deltam)
         
-        p1 = np.exp(self._logpdfm1( ms ,alpha1, alpha2, deltam, ml, mh, b ))
-        return np.log(np.trapz(p1,ms))
+        # d log C(m1)/dm1 = -p(m2=m1) C(m1)
+        dlogC = -np.exp(self._logpdfm2(m1c, beta, deltam, ml)+self._logC(m1c, beta, deltam, ml, res=res))
+        dm1 = -np.where(m1c<mbr, alpha1, alpha2)/m1c + self._dlogS(m1c, deltam, ml)[0] + dlogC
+        dm2 = beta/m2c + self._dlogS(m2c, deltam, ml)[0]
+        return np.where(where_compute, np.array([dm1, dm2]), 0.)
         
     
-    
     def _logNorm1(self, alpha1, alpha2, deltam, ml, mh, b ):
         '''
         Gives log integral of  p(m1, m2) dm1 dm2 (i.e. total normalization of mass function )
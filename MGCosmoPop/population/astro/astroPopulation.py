@@ -13,6 +13,7 @@
 #import scipy.stats as ss
 from ..ABSpopulation import Population
 from copy import deepcopy
+import numpy as np
 
 ########################################################################
 ########################################################################
@@ -68,6 +69,43 @@ class AstroPopulation(Population):
         #print(lambdaBBHspin)
         #print(self.spinDist.logpdf(theta_spin, lambdaBBHspin))
         return logdR+self.spinDist.logpdf(theta_spin, lambdaBBHspin)
+    
+    
+    def grad_log_dR_dm1dm2(self, m1, m2, z, spins, lambdaBBH, params=None, **kwargs):
+        '''
+        Derivatives of log dR/(dm1dm2) wrt the parameters in params (default: all), at fixed m1, m2, z.
+        Each component only contributes the derivatives wrt its own parameters.
+        Returns array of shape (len(params), len(m1))
+        '''
+        if params is None:
+            params=self.params
+        lambdaBBHrate, lambdaBBHmass, lambdaBBHspin = self._split_lambdas(lambdaBBH)
+        theta_rate, theta_mass, theta_spin = self._get_thetas( m1, m2, z, spins)
+        
+        grads = np.zeros((len(params),)+m1.shape)
+        for obj, lambdaObj, thetaObj, gradFun in ( (self.rateEvol, lambdaBBHrate, theta_rate, self.rateEvol.grad_log_dNdVdt),
+                                                   (self.massDist, lambdaBBHmass, theta_mass, self.massDist.grad_logpdf),
+                                                   (self.spinDist, lambdaBBHspin, theta_spin, self.spinDist.grad_logpdf) ):
+            objParams = [param for param in obj.params if param in params]
+            if len(objParams)==0:
+                continue
+            gradObj = gradFun(thetaObj, lambdaObj, params=objParams, **kwargs)
+            for j,param in enumerate(objParams):
+                grads[params.index(param)] = gradObj[j]
+        return grads
+        
+    
+    def dlog_dR_dm1dm2_dz(self, m1, m2, z, spins, lambdaBBH, **kwargs):
+        '''
+        Derivative of log dR/(dm1dm2) wrt z at fixed detector-frame masses, i.e. along m_i(z) = m_i^det/(1+z):
+            d log R(z)/dz - ( m1 dlog p/dm1 + m2 dlog p/dm2 )/(1+z) .
+        The spin distribution does not depend on masses and redshift.
+        Analytic if the rate evolution and mass distribution implement the derivatives analytically
+        '''
+        lambdaBBHrate, lambdaBBHmass, lambdaBBHspin = self._split_lambdas(lambdaBBH)
+        theta_rate, theta_mass, theta_spin = self._get_thetas( m1, m2, z, spins)
+        dm1, dm2 = self.massDist.grad_logpdf_theta(theta_mass, lambdaBBHmass)
+        return self.rateEvol.dlog_dNdVdt_dz(theta_rate, lambdaBBHrate)-(m1*dm1+m2*dm2)/(1+z)
         
     
     def _get_thetas(self, m1, m2, z, spins):
@@ -32,6 +32,24 @@ def trunc_gaussian_logpdf(x, mu = 1, sigma = 1, lower = 0, upper=100):
     return pdf
 
 
+def trunc_gaussian_grad_logpdf(x, mu = 1, sigma = 1, lower = 0, upper=100):
+    '''
+    Derivatives of trunc_gaussian_logpdf wrt mu and sigma. Zero outside (lower, upper)
+    '''
+    where_compute= (x>lower) & (x<upper)
+    
+    ua, ub = (lower-mu)/sigma, (upper-mu)/sigma
+    Phialpha = 0.5*erfc(-ua/np.sqrt(2))
+    Phibeta = 0.5*erfc(-ub/np.sqrt(2))
+    phialpha = np.exp(-ua**2/2)/np.sqrt(2*np.pi)
+    phibeta = np.exp(-ub**2/2)/np.sqrt(2*np.pi)
+    
+    dmu = (x-mu)/sigma**2 + (phibeta-phialpha)/(sigma*(Phibeta-Phialpha))
+    dsigma = -1/sigma + (x-mu)**2/sigma**3 + (phibeta*ub-phialpha*ua)/(sigma*(Phibeta-Phialpha))
+    
+    return np.where(where_compute, dmu, 0.), np.where(where_compute, dsigma, 0.)
+
+
 
 class DummySpinDist(BBHDistFunction):
     
@@ -116,6 +134,23 @@ class GaussSpinDist(BBHDistFunction):
         return pdftot
     
     
+    def grad_logpdf(self, theta, lambdaBBHspin, params=None, **kwargs):
+        '''
+        Derivatives of logpdf wrt muEff, sigmaEff, muP, sigmaP
+        '''
+        chiEff, chiP = theta
+        muEff, sigmaEff, muP, sigmaP, = lambdaBBHspin
+        
+        dmuEff, dsigmaEff = trunc_gaussian_grad_logpdf(chiEff, lower=self.minChiEff, upper=self.maxChiEff, mu=muEff, sigma=sigmaEff )
+        # chi_p is nan when not available (selection effects), and does not contribute
+        dmuP, dsigmaP = trunc_gaussian_grad_logpdf(np.nan_to_num(chiP, nan=-1.), lower=self.minChiP, upper=self.maxChiP, mu=muP, sigma=sigmaP )
+        
+        allGrads = {'muEff': dmuEff, 'sigmaEff':dsigmaEff, 'muP':dmuP, 'sigmaP':dsigmaP}
+        if params is None:
+            params=self.params
+        return np.array([allGrads[param] for param in params])
+    
+    
     
     
     
\ No newline at end of file
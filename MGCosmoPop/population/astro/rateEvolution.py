@@ -43,6 +43,24 @@ class PowerLawRateEvolution(RateEvolution):
         return np.log(R0)+lambdaRedshift*np.log1p(z)
     
     
+    def grad_log_dNdVdt(self, theta_rate, lambdaBBHrate, params=None, **kwargs):
+        '''
+        Derivatives of log R(z) wrt R0, lambda
+        '''
+        R0, lambdaRedshift = lambdaBBHrate
+        z=theta_rate
+        allGrads = { 'R0': np.full(z.shape, 1/R0),
+                     'lambdaRedshift': np.log1p(z)}
+        if params is None:
+            params=self.params
+        return np.array([allGrads[param] for param in params])
+    
+    
+    def dlog_dNdVdt_dz(self, z, lambdaBBHrate, **kwargs):
+        R0, lambdaRedshift = lambdaBBHrate
+        return lambdaRedshift/(1+z)
+    
+    
 
 
 
@@ -88,6 +106,36 @@ class AstroPhRateEvolution(RateEvolution):
     def _C0(self, alphaRedshift , betaRedshift, zp):
         
         return 1+(1+zp)**(-alphaRedshift-betaRedshift)
+    
+    
+    def grad_log_dNdVdt(self, theta_rate, lambdaBBHrate, params=None, **kwargs):
+        '''
+        Derivatives of log R(z) wrt R0, alphaRedshift, betaRedshift, zp
+        '''
+        R0, alphaRedshift , betaRedshift, zp = lambdaBBHrate
+        z=theta_rate
+        k = alphaRedshift+betaRedshift
+        
+        # X/(1+X) with X = ((1+z)/(1+zp))**k and Y/(1+Y) with Y = (1+zp)**(-k), i.e. C0=1+Y
+        logx = np.log1p(z)-np.log1p(zp)
+        fX = 1/(1+np.exp(-k*logx))
+        fY = 1-1/self._C0(alphaRedshift , betaRedshift, zp)
+        
+        dk = -np.log1p(zp)*fY-logx*fX
+        allGrads = { 'R0': np.full(z.shape, 1/R0),
+                     'alphaRedshift': dk+np.log1p(z),
+                     'betaRedshift': dk,
+                     'zp': k*(fX-fY)/(1+zp)}
+        if params is None:
+            params=self.params
+        return np.array([allGrads[param] for param in params])
+    
+    
+    def dlog_dNdVdt_dz(self, z, lambdaBBHrate, **kwargs):
+        R0, alphaRedshift , betaRedshift, zp = lambdaBBHrate
+        k = alphaRedshift+betaRedshift
+        fX = 1/(1+np.exp(-k*(np.log1p(z)-np.log1p(zp))))
+        return (alphaRedshift-k*fX)/(1+z)
 
 
 
@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+#    Copyright (c) 2021 Michele Mancarella <michele.mancarella@unige.ch>
+#
+#    All rights reserved. Use of this source code is governed by a modified BSD
+#    license that can be found in the LICENSE file.
+
+import numpy as np
+from scipy.optimize import minimize
+import h5py
+
+
+
+class LaplaceForecast(object):
+
+    '''
+    Quick forecast: finds the maximum of the posterior and approximates the posterior
+    around it with a gaussian, whose covariance is the inverse of minus the Hessian of the log posterior.
+    The Hessian is computed with central finite differences, with all the points of the stencil
+    evaluated in one call to Posterior.logPosterior_batch.
+    The step for each parameter starts from a fraction of its value and is then iterated
+    to a fraction of the width of the posterior along that parameter, 1/sqrt(-H_ii), given by the previous Hessian.
+
+    Usage:
+
+    myForecast = LaplaceForecast(myPost)
+    myForecast.find_MAP(x0)
+    myForecast.compute_covariance()
+    myForecast.print_summary()
+
+    '''
+
+    def __init__(self, posterior, rel_step=1e-03, sigma_step=0.1, max_iter=5, tol=0.05):
+        '''
+
+        Parameters
+        ----------
+        posterior : obj of type Posterior
+        rel_step : float or array
+            initial step of the finite differences, in units of the absolute value of each parameter
+            (of the width of the prior range for parameters equal to zero)
+        sigma_step : float
+            step of the finite differences in units of 1/sqrt(-H_ii)
+        max_iter : int
+            maximum number of evaluations of the Hessian
+        tol : float
+            the iteration stops when the steps change by less than this fraction
+
+        '''
+        self.posterior = posterior
+        self.params_inference = posterior.hyperLikelihood.params_inference
+        self.nParams = len(self.params_inference)
+        self.priorWidth = posterior.prior._limSup-posterior.prior._limInf
+        self.rel_step = rel_step
+        self.sigma_step = sigma_step
+        self.max_iter = max_iter
+        self.tol = tol
+
+        self.xMAP = None
+        self.logPostMAP = None
+        self.hessian = None
+        self.covariance = None
+        self.step = None
+        self.nEvals = 0
+
+
+    def _negLogPost(self, x):
+        self.nEvals += 1
+        return -self.posterior.logPosterior(x)
+
+
+    def _negLogPost_and_grad(self, x):
+        self.nEvals += 1
+        logPost, grad = self.posterior.logPosterior(x, return_grad=True)
+        if not np.isfinite(logPost):
+            return np.inf, np.zeros(self.nParams)
+        return -logPost, -grad
+
+
+    def find_MAP(self, x0, method='Nelder-Mead', use_grad=False, **kwargs):
+        '''
+        Maximizes the posterior starting from x0 with scipy.optimize.minimize.
+        If use_grad, uses the analytic gradient of the posterior (requires a gradient-based method, e.g. 'L-BFGS-B').
+        Bounds are set to the prior range. kwargs are passed to minimize.
+        '''
+        bounds = list(zip(self.posterior.prior._limInf, self.posterior.prior._limSup))
+        if use_grad:
+            res = minimize(self._negLogPost_and_grad, x0, method=method, jac=True, bounds=bounds, **kwargs)
+        else:
+            res = minimize(self._negLogPost, x0, method=method, bounds=bounds, **kwargs)
+        if not res.success:
+            print('Warning: optimizer did not converge: %s' %res.message)
+        self.xMAP = res.x
+        self.logPostMAP = -res.fun
+        print('MAP: %s' %str(dict(zip(self.params_inference, self.xMAP))))
+        print('Log posterior at MAP: %s. Number of evaluations: %s' %(self.logPostMAP, self.nEvals))
+        return res
+
+
+    def _stencil(self, x, h):
+        '''
+        Points needed for the central finite difference Hessian: x, x+-h_i, x+-h_i+-h_j for i<j
+        '''
+        n = self.nParams
+        E = np.diag(h)
+        pts = [x]
+        for i in range(n):
+            pts += [x+E[i], x-E[i]]
+        for i in range(n):
+            for j in range(i+1, n):
+                pts += [x+E[i]+E[j], x+E[i]-E[j], x-E[i]+E[j], x-E[i]-E[j]]
+        return np.array(pts)
+
+
+    def _hessian(self, x, h):
+        '''
+        Hessian of the log posterior at x by central finite differences with steps h
+        '''
+        n = self.nParams
+        pts = self._stencil(x, h)
+        f = self.posterior.logPosterior_batch(pts)
+        self.nEvals += pts.shape[0]
+        if not np.all(np.isfinite(f)):
+            raise ValueError('Log posterior is not finite at some points of the stencil. Try a smaller rel_step')
+
+        f0 = f[0]
+        fp, fm = f[1:2*n+1:2], f[2:2*n+1:2]
+        H = np.diag((fp-2*f0+fm)/h**2)
+        k = 2*n+1
+        for i in range(n):
+            for j in range(i+1, n):
+                fpp, fpm, fmp, fmm = f[k:k+4]
+                H[i, j] = H[j, i] = (fpp-fpm-fmp+fmm)/(4*h[i]*h[j])
+                k += 4
+        return H
+
+
+    def compute_hessian(self, x=None):
+        '''
+        Hessian of the log posterior at x (default: MAP), by central finite differences.
+        The steps are iterated to sigma_step/sqrt(-H_ii), see the class docstring
+        '''
+        if x is None:
+            x = self.xMAP
+        x = np.asarray(x, dtype=float)
+        # Keep the stencil inside the prior range
+        dist = np.minimum(x-self.posterior.prior._limInf, self.posterior.prior._limSup-x)
+        if np.any(dist<=0):
+            raise ValueError('Parameters %s are at the boundary of the prior range. The Laplace approximation is not valid' %str([p for p, d in zip(self.params_inference, dist) if d<=0]))
+        h = self.rel_step*np.where(x!=0, np.abs(x), self.priorWidth)*np.ones(self.nParams)
+
+        for it in range(self.max_iter):
+            tooLarge = h>dist/2
+            if np.any(tooLarge):
+                print('Warning: parameters %s are close to the boundary of the prior range. Reducing the finite difference step' %str([p for p, t in zip(self.params_inference, tooLarge) if t]))
+                h = np.where(tooLarge, dist/2, h)
+            H = self._hessian(x, h)
+            self.step = h
+            # Parameters with non-negative curvature keep their step
+            curv = -np.diag(H)
+            h = np.where(curv>0, self.sigma_step/np.sqrt(np.where(curv>0, curv, 1.)), self.step)
+            change = np.abs(h/self.step-1)
+            if np.all(change<self.tol):
+                break
+        else:
+            print('Warning: finite difference steps did not converge in %s iterations. Last relative change: %s' %(self.max_iter, str(change)))
+        self.hessian = H
+        return H
+
+
+    def compute_covariance(self, x=None):
+        '''
+        Covariance of the Laplace approximation, i.e. inverse of minus the Hessian of the log posterior
+        (Fisher matrix plus the contribution of the prior)
+        '''
+        H = self.compute_hessian(x=x)
+        eigs = np.linalg.eigvalsh(-H)
+        if np.any(eigs<=0):
+            print('Warning: Hessian is not negative definite at this point (eigenvalues of -H: %s). The covariance is not reliable' %str(eigs))
+        self.covariance = np.linalg.inv(-H)
+        return self.covariance
+
+
+    def summary(self):
+        sigmas = np.sqrt(np.diag(self.covariance))
+        return {'params': self.params_inference,
+                'MAP': self.xMAP,
+                'sigma': sigmas,
+                'correlation': self.covariance/np.outer(sigmas, sigmas),
+                'covariance': self.covariance}
+
+
+    def print_summary(self):
+        res = self.summary()
+        print('Laplace approximation around MAP:')
+        for p, m, s in zip(res['params'], res['MAP'], res['sigma']):
+            print('%s = %s +- %s' %(p, m, s))
+
+
+    def sample(self, nSamples, seed=None):
+        '''
+        Samples from the gaussian approximation
+        '''
+        rng = np.random.default_rng(seed)
+        return rng.multivariate_normal(self.xMAP, self.covariance, size=nSamples)
+
+
+    def save(self, fname):
+        res = self.summary()
+        with h5py.File(fname, 'w') as f:
+            f.create_dataset('params', data=np.array(self.params_inference, dtype='S'))
+            for name in ('MAP', 'sigma', 'correlation', 'covariance'):
+                f.create_dataset(name, data=res[name])
+            f.create_dataset('hessian', data=self.hessian)
+            f.attrs['logPostMAP'] = self.logPostMAP
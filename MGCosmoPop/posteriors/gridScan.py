@@ -0,0 +1,357 @@
+#!/usr/bin/env python3
+#    Copyright (c) 2021 Michele Mancarella <michele.mancarella@unige.ch>
+#
+#    All rights reserved. Use of this source code is governed by a modified BSD
+#    license that can be found in the LICENSE file.
+
+import os
+import time
+import multiprocessing
+import numpy as np
+from scipy.optimize import minimize
+import h5py
+
+
+# Posterior used by the worker processes. It is set by _init_worker,
+# so it is inherited by the workers and never pickled when the start method is fork
+_posterior = None
+
+
+def _init_worker(posterior):
+    global _posterior
+    _posterior = posterior
+
+
+def _eval_block(args):
+    iBlock, pts = args
+    return iBlock, _posterior.logPosterior_batch(pts), None
+
+
+def _profile_block(args):
+    '''
+    Maximizes the posterior over the free parameters at each point of the block.
+    Each optimization starts from the best of x0 and of the optimum at the neighbouring grid point,
+    which is in the block if nbr[k]>=0, otherwise is starts[k] (NaN if not known).
+    The posterior is evaluated with Posterior.logPosterior_batch. For methods using the gradient,
+    the objective and its central finite difference gradient are computed in a single call
+    '''
+    iBlock, pts, freeIdx, nbr, starts, lims, method, options, fd_step = args
+    nFree = freeIdx.shape[0]
+    logPosts = np.full(pts.shape[0], -np.inf)
+    best = np.full((pts.shape[0], nFree), np.NaN)
+    for k in range(pts.shape[0]):
+        x = pts[k]
+
+        def negLogPost_batch(ys):
+            xs = np.tile(x, (ys.shape[0], 1))
+            xs[:, freeIdx] = ys
+            return -_posterior.logPosterior_batch(xs)
+
+        def negLogPost(y):
+            return negLogPost_batch(y[np.newaxis, :])[0]
+
+        def negLogPost_grad(y):
+            h = fd_step*np.maximum(np.abs(y), 1.)
+            f = negLogPost_batch(np.vstack([y, y+np.diag(h), y-np.diag(h)]))
+            if not np.isfinite(f[0]):
+                return np.inf, np.zeros(nFree)
+            fp, fm = f[1:nFree+1], f[nFree+1:]
+            # One-sided differences where a step leaves the support of the posterior
+            with np.errstate(invalid='ignore'):
+                grad = np.where(np.isfinite(fp) & np.isfinite(fm), (fp-fm)/(2*h),
+                                np.where(np.isfinite(fp), (fp-f[0])/h, np.where(np.isfinite(fm), (f[0]-fm)/h, 0.)))
+            return f[0], grad
+
+        candidates = [x[freeIdx]]
+        neighbour = best[nbr[k]] if nbr[k]>=0 else starts[k]
+        if np.all(np.isfinite(neighbour)):
+            candidates.append(neighbour)
+        candidates = np.array(candidates)
+        y0 = candidates[np.argmin(negLogPost_batch(candidates))]
+
+        if method in _derivative_free:
+            res = minimize(negLogPost, y0, method=method, options=options)
+        else:
+            res = minimize(negLogPost_grad, y0, method=method, jac=True, options=options,
+                           bounds=lims if method in _bounded else None)
+        logPosts[k] = -res.fun
+        best[k] = res.x
+    return iBlock, logPosts, best
+
+
+# Methods of scipy.optimize.minimize that do not use the gradient, and methods accepting bounds among the others
+_derivative_free = ('Nelder-Mead', 'Powell', 'COBYLA')
+_bounded = ('L-BFGS-B', 'TNC', 'SLSQP')
+
+
+
+class GridScan(object):
+
+    '''
+    Evaluates the posterior on a grid over 1 to 3 parameters.
+    The other parameters are either fixed to the values in x0 or, if profile=True,
+    maximized at each point of the grid (profile posterior; equal to the profile likelihood for flat priors).
+
+    The grid is split in blocks of points that are evaluated in parallel by a pool of processes.
+    Without profiling, each block is evaluated with one call to Posterior.logPosterior_batch.
+    When profiling, the points of a block are optimized in order, each one starting from the optimum
+    at the neighbouring grid point if it is better than x0; the objective and its finite difference gradient
+    are evaluated with one call to Posterior.logPosterior_batch.
+    With more than one process, profiled blocks are submitted in waves, so that a block starts after the blocks
+    containing the neighbours of its points whenever possible (see _waves).
+    If fname is given, each block is written to HDF5 as soon as it is done,
+    so an interrupted scan resumes from the blocks already computed.
+
+    Usage:
+
+    myScan = GridScan(myPost, {'H0': np.linspace(40, 120, 50), 'Xi0': np.linspace(0.5, 3, 50)}, x0, fname='scan.h5', nCores=8)
+    res = myScan.run()
+    H0grid, profH0 = myScan.profile_1d('H0')
+
+    '''
+
+    def __init__(self, posterior, grid, x0, profile=False, fname=None, nCores=1, block_size=64, method='L-BFGS-B', options=None, fd_step=1e-05):
+        '''
+
+        Parameters
+        ----------
+        posterior : obj of type Posterior
+        grid : dict
+            {param: 1D array} for 1 to 3 parameters in params_inference
+        x0 : array
+            values of all the parameters in params_inference. Values of the parameters in grid are ignored.
+            If profile, starting point of the optimization over the other parameters
+        profile : bool
+            whether to maximize over the parameters not in grid
+        fname : str, optional
+            HDF5 file for checkpointing
+        nCores : int
+            number of processes. If 1, runs in the main process
+        block_size : int
+            number of grid points per block
+        method, options :
+            passed to scipy.optimize.minimize when profiling. For methods using the gradient
+            ('L-BFGS-B' by default), it is computed by central finite differences
+        fd_step : float
+            step of the finite differences, relative to max(|value of the parameter|, 1)
+
+        '''
+        self.posterior = posterior
+        self.params_inference = posterior.hyperLikelihood.params_inference
+        if not 1<=len(grid)<=3:
+            raise ValueError('Grid scan supports 1 to 3 parameters. Got %s' %len(grid))
+        for param in grid.keys():
+            if param not in self.params_inference:
+                raise ValueError('Parameter %s is not among the parameters of the inference %s' %(param, str(self.params_inference)))
+
+        self.grid_params = list(grid.keys())
+        self.axes = [np.asarray(grid[param], dtype=float) for param in self.grid_params]
+        self.shape = tuple(len(ax) for ax in self.axes)
+        self.gridIdx = np.array([self.params_inference.index(param) for param in self.grid_params])
+        self.freeIdx = np.array([i for i in range(len(self.params_inference)) if i not in self.gridIdx])
+        self.x0 = np.asarray(x0, dtype=float)
+        self.profile = profile and len(self.freeIdx)>0
+
+        self.fname = fname
+        self.nCores = nCores
+        self.block_size = block_size
+        self.method = method
+        self.options = options if options is not None else {}
+        self.fd_step = fd_step
+        # Optimization within the prior range, whose edges are excluded
+        self.lims = []
+        for i in self.freeIdx:
+            lo, hi = posterior.prior.priorLimits[self.params_inference[i]]
+            self.lims.append((lo+1e-08*(hi-lo), hi-1e-08*(hi-lo)))
+
+        self.nPoints = int(np.prod(self.shape))
+        self.nBlocks = int(np.ceil(self.nPoints/block_size))
+        self.logPost = np.full(self.nPoints, np.NaN)
+        self.best = np.full((self.nPoints, len(self.freeIdx)), np.NaN) if self.profile else None
+        self.done = np.zeros(self.nBlocks, dtype=bool)
+
+        if fname is not None:
+            if os.path.exists(fname):
+                self._load_checkpoint()
+            else:
+                self._init_checkpoint()
+
+
+    def _points(self, iBlock):
+        flat = np.arange(iBlock*self.block_size, min((iBlock+1)*self.block_size, self.nPoints))
+        idx = np.unravel_index(flat, self.shape)
+        pts = np.tile(self.x0, (flat.shape[0], 1))
+        for j, ax in enumerate(self.axes):
+            pts[:, self.gridIdx[j]] = ax[idx[j]]
+        return flat, pts
+
+
+    def _neighbour_points(self, flat):
+        '''
+        Flat index of the preceding neighbouring grid point of each point in flat (along the last axis if possible),
+        -1 for the first point of the grid
+        '''
+        idx = np.unravel_index(flat, self.shape)
+        strides = [int(np.prod(self.shape[j+1:])) for j in range(len(self.shape))]
+        nbrFlat = np.full(flat.shape[0], -1)
+        for j in reversed(range(len(self.shape))):
+            mask = (nbrFlat<0) & (idx[j]>0)
+            nbrFlat[mask] = flat[mask]-strides[j]
+        return nbrFlat
+
+
+    def _dependencies(self, iBlock):
+        '''
+        Blocks containing the neighbours of the points of block iBlock, other than iBlock itself
+        '''
+        nbrFlat = self._neighbour_points(self._points(iBlock)[0])
+        return np.setdiff1d(nbrFlat[nbrFlat>=0]//self.block_size, [iBlock])
+
+
+    def _neighbours(self, flat):
+        '''
+        For each point in flat, the index in the block of the preceding neighbouring grid point
+        (along the last axis if possible), or -1 if it is not in the block.
+        In the latter case, the optimum at the neighbouring point is returned if it is already known
+        '''
+        nbrFlat = self._neighbour_points(flat)
+        nbr = np.where(nbrFlat>=flat[0], nbrFlat-flat[0], -1)
+        starts = np.full((flat.shape[0], len(self.freeIdx)), np.NaN)
+        outside = (nbr<0) & (nbrFlat>=0)
+        starts[outside] = self.best[nbrFlat[outside]]
+        return nbr, starts
+
+
+    def _profile_task(self, iBlock):
+        flat, pts = self._points(iBlock)
+        nbr, starts = self._neighbours(flat)
+        return (iBlock, pts, self.freeIdx, nbr, starts, self.lims, self.method, self.options, self.fd_step)
+
+
+    def _waves(self, pool, todo):
+        '''
+        Submits the profile tasks of the blocks in todo to pool in waves, yielding the results.
+        The tasks of a wave are built when the previous wave is done, so that the blocks whose dependencies
+        (see _dependencies) are done start from the optima at the neighbouring points.
+        If less than nCores blocks are ready, the wave is completed with the next blocks, 
+        which start from x0 at the points whose neighbouring optimum is not known yet
+        '''
+        deps = {iBlock: self._dependencies(iBlock) for iBlock in todo}
+        pending = list(todo)
+        while pending:
+            ready = [iBlock for iBlock in pending if self.done[deps[iBlock]].all()]
+            others = [iBlock for iBlock in pending if iBlock not in ready]
+            wave = ready+others[:max(self.nCores-len(ready), 0)]
+            pending = [iBlock for iBlock in pending if iBlock not in wave]
+            for res in pool.imap_unordered(_profile_block, [self._profile_task(iBlock) for iBlock in wave]):
+                yield res
+
+
+    def _init_checkpoint(self):
+        with h5py.File(self.fname, 'w') as f:
+            f.attrs['params'] = np.array(self.grid_params, dtype='S')
+            f.attrs['profile'] = self.profile
+            f.attrs['block_size'] = self.block_size
+            for param, ax in zip(self.grid_params, self.axes):
+                f.create_dataset('grid_%s' %param, data=ax)
+            f.create_dataset('x0', data=self.x0)
+            f.create_dataset('logPost', data=self.logPost)
+            f.create_dataset('done', data=self.done)
+            if self.profile:
+                f.create_dataset('best', data=self.best)
+
+
+    def _load_checkpoint(self):
+        with h5py.File(self.fname, 'r') as f:
+            same = ( [p.decode() for p in f.attrs['params']]==self.grid_params
+                     and bool(f.attrs['profile'])==self.profile
+                     and f.attrs['block_size']==self.block_size
+                     and all(np.array_equal(np.array(f['grid_%s' %param]), ax) for param, ax in zip(self.grid_params, self.axes))
+                     and np.array_equal(np.array(f['x0']), self.x0) )
+            if not same:
+                raise ValueError('Checkpoint %s was written for a different grid. Remove it or use another file name' %self.fname)
+            self.logPost = np.array(f['logPost'])
+            self.done = np.array(f['done'])
+            if self.profile:
+                self.best = np.array(f['best'])
+        print('Resuming grid scan from %s: %s/%s blocks done' %(self.fname, self.done.sum(), self.nBlocks))
+
+
+    def _write_block(self, f, iBlock, flat):
+        f['logPost'][flat[0]:flat[-1]+1] = self.logPost[flat]
+        if self.profile:
+            f['best'][flat[0]:flat[-1]+1] = self.best[flat]
+        f['done'][iBlock] = True
+        f.flush()
+
+
+    def run(self):
+        '''
+        Evaluates the blocks that are not done yet. Returns the result (see results())
+        '''
+        todo = np.where(~self.done)[0]
+        print('Grid scan over %s: %s points in %s blocks, %s to do, %s cores' %(str(self.grid_params), self.nPoints, self.nBlocks, todo.shape[0], self.nCores))
+        if self.profile:
+            # Tasks are generated lazily, so that blocks can start from the optima of the blocks already done.
+            # With a pool, imap_unordered would consume all of them at once: they are submitted in waves instead
+            tasks = (self._profile_task(iBlock) for iBlock in todo)
+            worker = _profile_block
+        else:
+            tasks = ((iBlock, self._points(iBlock)[1]) for iBlock in todo)
+            worker = _eval_block
+
+        f = h5py.File(self.fname, 'r+') if self.fname is not None else None
+        pool = None
+        t0 = time.perf_counter()
+        try:
+            if self.nCores>1:
+                pool = multiprocessing.get_context('fork').Pool(self.nCores, initializer=_init_worker, initargs=(self.posterior,))
+                results = self._waves(pool, todo) if self.profile else pool.imap_unordered(worker, tasks)
+            else:
+                _init_worker(self.posterior)
+                results = map(worker, tasks)
+            for nDone, (iBlock, logPosts, best) in enumerate(results):
+                flat = self._points(iBlock)[0]
+                self.logPost[flat] = logPosts
+                if self.profile:
+                    self.best[flat] = best
+                self.done[iBlock] = True
+                if f is not None:
+                    self._write_block(f, iBlock, flat)
+                if self.posterior.verbose:
+                    print('Block %s done (%s/%s), elapsed time %.1f s' %(iBlock, nDone+1, todo.shape[0], time.perf_counter()-t0))
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+            if f is not None:
+                f.close()
+        print('Grid scan done in %.1f s' %(time.perf_counter()-t0))
+        return self.results()
+
+
+    def results(self):
+        '''
+        Returns a dictionary with the axes of the grid, the log posterior on the grid
+        and, if profiling, the values of the other parameters maximizing the posterior at each point
+        '''
+        res = {'params': self.grid_params,
+               'axes': self.axes,
+               'logPost': self.logPost.reshape(self.shape)}
+        if self.profile:
+            res['profiled_params'] = [self.params_inference[i] for i in self.freeIdx]
+            res['best'] = self.best.reshape(self.shape+(len(self.freeIdx),))
+        return res
+
+
+    def profile_1d(self, param):
+        '''
+        Profile over one of the grid parameters: maximum of the log posterior over the other grid axes
+        (and over the profiled parameters, if profile=True), normalized to zero at the maximum.
+        Returns the axis and the profile
+        '''
+        j = self.grid_params.index(param)
+        logPost = np.where(np.isnan(self.logPost), -np.inf, self.logPost).reshape(self.shape)
+        other = tuple(i for i in range(len(self.shape)) if i!=j)
+        prof = logPost.max(axis=other) if other else logPost
+        return self.axes[j], prof-prof.max()
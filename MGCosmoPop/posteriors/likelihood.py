@@ -6,6 +6,7 @@ Created on Thu Mar  4 11:54:06 2021
 @author: Michi
 """
 import numpy as np
+from .profiling import profiled
 
 def logdiffexp(x, y):
     '''                                                                                                                                                                      
@@ -22,7 +23,7 @@ class HyperLikelihood(object):
     marginalised over the GW parameters
     
     '''
-    def __init__(self, population, data, params_inference, safety_factor=100, verbose=False):
+    def __init__(self, population, data, params_inference, safety_factor=100, verbose=False, telemetry=None):
         '''
         
 
@@ -31,6 +32,9 @@ class HyperLikelihood(object):
         population : TYPE object of type AllPopulations
 
         data : TYPE list of objects Data
+        
+        telemetry : TYPE object of type NeffTelemetry, optional
+            if given, Neff of each event is recorded at every evaluation under the key 'events_<index of dataset>'
 
         '''
         self.population=population
@@ -38,7 +42,9 @@ class HyperLikelihood(object):
         self.params_inference=params_inference
         self.safety_factor = safety_factor
         self.verbose=verbose
+        self.telemetry=telemetry
     
+    @profiled
     def _get_mass_redshift(self, Lambda, data):
         
         LambdaCosmo, LambdaAllPop = self.population._split_params(Lambda)
@@ -57,9 +63,13 @@ class HyperLikelihood(object):
         return data.Tobs
      
     
-    def _logLik(self, Lambda_test, data,):
+    @profiled
+    def _logLik(self, Lambda_test, data, return_grad=False, iData=None):
         """
-        Returns log likelihood for each dataset
+        Returns log likelihood for each dataset.
+        If return_grad, returns also the gradient wrt params_inference
+        iData is the index of data in self.data, used for telemetry. Telemetry is not recorded if iData is None
+        (e.g. for data objects with a subset of the events, which are not among the datasets of the likelihood)
         """
         Lambda = self.population.get_Lambda(Lambda_test, self.params_inference )
         m1, m2, z = self._get_mass_redshift(Lambda, data)
@@ -90,9 +100,13 @@ class HyperLikelihood(object):
         logs2 = ( np.logaddexp.reduce(2*logLik_, axis=-1) -2*data.logNsamples)
         logSigmaSq = logdiffexp( logs2, 2.0*allLogLiks - data.logNsamples)
         Neff = np.exp( 2.0*allLogLiks - logSigmaSq)
+        if self.telemetry is not None and iData is not None:
+            self.telemetry.update('events_%s' %iData, Neff, self.safety_factor)
         if np.any(Neff<self.safety_factor):
             if self.verbose:
                 print('Not enough samples to safely evaluate the likelihood. Neff: %s at position(s) %s for safety factor: %s. Rejecting sample. Values of Lambda: %s' %(str(Neff[Neff<self.safety_factor]), str(np.argwhere(Neff<self.safety_factor).T),self.safety_factor,str(Lambda)))
+            if return_grad:
+                return np.NINF, np.zeros(len(self.params_inference))
             return np.NINF
 
         else:
@@ -100,14 +114,34 @@ class HyperLikelihood(object):
             ll = allLogLiks.sum()
             if np.isnan(ll):
                 raise ValueError('NaN value for logLik. Values of Lambda: %s' %(str(Lambda) ) )
-            return ll
+            if not return_grad:
+                return ll
+            
+            # d/dLambda of log( mean over samples ) is the mean of d logLik_ /dLambda weighted by the samples' likelihood
+            grad_ = np.zeros((len(self.params_inference),)+m1.shape)
+            grad_[:, where_compute] = self.population.grad_log_dN_dm1zdm2zddL(m1[where_compute], m2[where_compute], z[where_compute], spins, Tobs, Lambda, self.params_inference, dL=data.dL[where_compute])
+            weights = np.exp(logLik_-np.logaddexp.reduce(logLik_, axis=-1)[:, np.newaxis])
+            grad = (weights[np.newaxis, :, :]*grad_).sum(axis=(1,2))
+            return ll, grad
     
     
-    def logLik(self, Lambda_test, **kwargs):
-        
+    @profiled
+    def logLik(self, Lambda_test, return_grad=False, **kwargs):
+        '''
+        Log likelihood for each dataset. If return_grad, returns also a list 
+        with the gradient wrt params_inference for each dataset
+        '''
         allL = []
-        for data_ in self.data:
-            allL.append(self._logLik( Lambda_test, data_, **kwargs))
+        allGrads = []
+        for i, data_ in enumerate(self.data):
+            res = self._logLik( Lambda_test, data_, return_grad=return_grad, iData=i, **kwargs)
+            if return_grad:
+                allL.append(res[0])
+                allGrads.append(res[1])
+            else:
+                allL.append(res)
+        if return_grad:
+            return allL, allGrads
         return  allL  
         
             
@@ -5,7 +5,10 @@ Created on Thu Mar  4 13:18:13 2021
 
 @author: Michi
 """
+import warnings
 import numpy as np
+import scipy.special as sc
+from .profiling import profiled
 
 
 
@@ -20,28 +23,215 @@ def logdiffexp(x, y):
 
 class Posterior(object):
     
-    def __init__(self, hyperLikelihood, prior, selectionBias, verbose=False, bias_safety_factor=10.):
-        
+    def __init__(self, hyperLikelihood, prior, selectionBias, verbose=False, bias_safety_factor=10., telemetry=None,
+                 marginalize_R0=False, R0_prior='flatLog', R0_limits=(0, np.inf)):
+        '''
+        telemetry: optional object of type NeffTelemetry. If given, Neff of each injection set is recorded
+                   at every evaluation under the key 'injections_<index of dataset>'
+        marginalize_R0: if True, the likelihood is marginalized analytically over the local rate R0,
+                        which must not be among the parameters of the inference. 
+                        Components of the posterior (blobs) are computed at the fiducial value of R0 
+                        and can be used to sample R0 in post-processing with sample_R0
+        R0_prior: 'flat' or 'flatLog'. Prior on R0 used for the marginalization
+        R0_limits: prior range for R0
+        '''
         self.hyperLikelihood = hyperLikelihood
         self.prior = prior
         self.selectionBias = selectionBias
         self.verbose=verbose
         self.bias_safety_factor=bias_safety_factor
+        self.telemetry=telemetry
         #self.params_inference = params_inference
+        
+        self.marginalize_R0 = marginalize_R0
+        self.R0_prior = R0_prior
+        self.R0_limits = R0_limits
+        if marginalize_R0:
+            self._check_marginalize_R0()
+    
+    
+    def _check_marginalize_R0(self):
+        population = self.hyperLikelihood.population
+        if population.params.count('R0')!=1:
+            raise ValueError('Analytic marginalization over R0 requires a population with one overall rate R0. Parameters: %s' %str(population.params))
+        if 'R0' in self.hyperLikelihood.params_inference:
+            raise ValueError('R0 cannot be among the parameters of the inference if it is marginalized analytically')
+        if self.R0_prior not in ('flat', 'flatLog'):
+            raise ValueError('Prior for R0 not supported: %s. Use flat or flatLog' %self.R0_prior)
+        R0min, R0max = self.R0_limits
+        if not 0<=R0min<R0max:
+            raise ValueError('Invalid prior range for R0: %s' %str(self.R0_limits))
+        self.R0_fid = population.baseValues['R0']
+        # Power of R0 in the prior
+        self._R0_prior_index = 0 if self.R0_prior=='flat' else -1
+        self._Nobs_tot = sum(data.Nobs for data in self.hyperLikelihood.data)
+        if self._Nobs_tot+self._R0_prior_index<0:
+            raise ValueError('Analytic marginalization over R0 with %s prior requires at least one event' %self.R0_prior)
+        # lls and mus in the blobs do not refer to the value of R0 of the samples
+        warnings.warn('R0 is marginalized analytically with %s prior in %s: the components of the posterior (blobs) are computed at the fiducial value R0=%s. Use sample_R0 to sample R0' %(self.R0_prior, str(self.R0_limits), self.R0_fid))
+    
+    
+    def _logLik_marginal_R0(self, lls, mus, Neffs):
+        '''
+        Log likelihood marginalized over R0, from the components computed at the fiducial value R0_fid.
+        Since ll_i = Nobs_i log R0 + ll'_i and mu_i = R0 mu'_i, for a prior R0^a (a=0 flat, a=-1 flatLog)
+        
+        int dR0 R0^a prod_i exp(ll_i-mu_i) = exp(sum_i ll'_i) [ Gamma(k+1, M R0_min)-Gamma(k+1, M R0_max) ] / M^(k+1)
+        
+        with k = N+a, N = sum_i Nobs_i and M = sum_i mu'_i.
+        The uncertainty on the MC estimate of mu is included at first order in 1/Neff (1904.10879), 
+        by adding (k+1)(k+2)/(2 Neff_tot) with Neff_tot = M^2/sum_i (mu'_i^2/Neff_i) 
+        (for the flatLog prior this is N(N+1)/(2 Neff_tot) ).
+        '''
+        mus = np.asarray(mus)/self.R0_fid
+        llsPrime = np.asarray(lls) - np.array([data.Nobs for data in self.hyperLikelihood.data])*np.log(self.R0_fid)
+        M = mus.sum()
+        k = self._Nobs_tot+self._R0_prior_index
+        
+        R0min, R0max = self.R0_limits
+        logNorm = np.log(sc.gammainc(k+1, M*R0max)-sc.gammainc(k+1, M*R0min))
+        logL = llsPrime.sum()+sc.gammaln(k+1)-(k+1)*np.log(M)+logNorm
+        if self.selectionBias is not None and getattr(self.selectionBias, 'get_uncertainty', False):
+            logL += (k+1)*(k+2)/2*(mus**2/np.asarray(Neffs)).sum()/M**2
+        return logL
+    
+    
+    def sample_R0(self, mus, nSamples=1, seed=None):
+        '''
+        Samples R0 from its conditional posterior p(R0 | other parameters), given the values of mu 
+        for each dataset saved in the blobs (blobs['mus'], of shape (nPoints, nDatasets) ).
+        Returns array of shape (nPoints, nSamples)
+        '''
+        if not self.marginalize_R0:
+            raise ValueError('R0 is not marginalized in this posterior')
+        rng = np.random.default_rng(seed)
+        M = np.atleast_2d(mus).sum(axis=-1)[:, np.newaxis]/self.R0_fid
+        k = self._Nobs_tot+self._R0_prior_index
+        R0min, R0max = self.R0_limits
+        # inverse CDF of the gamma distribution truncated to the prior range
+        cmin, cmax = sc.gammainc(k+1, M*R0min), sc.gammainc(k+1, M*R0max)
+        u = cmin+(cmax-cmin)*rng.uniform(size=(M.shape[0], nSamples))
+        return sc.gammaincinv(k+1, u)/M
+    
+    
+    @property
+    def blobs_dtype(self):
+        '''
+        dtype of the blobs returned by logPosterior with return_blob=True: 
+        log prior, and log likelihood, mu, error and Neff for each dataset.
+        To be passed to emcee.EnsembleSampler as blobs_dtype
+        '''
+        nData = len(self.hyperLikelihood.data)
+        return np.dtype([('lp', np.float64), ('lls', np.float64, (nData,)), ('mus', np.float64, (nData,)), 
+                         ('errs', np.float64, (nData,)), ('Neffs', np.float64, (nData,))])
+    
+    
+    @profiled
+    def logPosterior_batch(self, Lambdas_test, return_blob=False):
+        '''
+        Log posterior for an array of points of shape (nPoints, len(params_inference)).
+        The prior is vectorized, and the selection bias is computed for all points 
+        with a single pass over the injections if the selection bias object has Ndet_batch.
+        
+        Returns an array of length nPoints. If return_blob, returns also a structured array 
+        with the components of the posterior for each point (see blobs_dtype)
+        '''
+        Lambdas_test = np.atleast_2d(Lambdas_test)
+        nPoints, nData = Lambdas_test.shape[0], len(self.hyperLikelihood.data)
+        
+        blobs = np.empty(nPoints, dtype=self.blobs_dtype)
+        blobs['lp'] = self.prior.logPrior(Lambdas_test)
+        for name in ('lls', 'mus', 'errs', 'Neffs'):
+            blobs[name] = np.NaN
+        logPosts = np.full(nPoints, -np.inf)
+        
+        inside = np.where(np.isfinite(blobs['lp']))[0]
+        if self.selectionBias is None or not hasattr(self.selectionBias, 'Ndet_batch'):
+            for k in inside:
+                logPosts[k], _, blobs['lls'][k], blobs['mus'][k], blobs['errs'][k], blobs['Neffs'][k] = self.logPosterior(Lambdas_test[k], return_blob=True)
+        elif inside.shape[0]>0:
+            for k in inside:
+                blobs['lls'][k] = self.hyperLikelihood.logLik(Lambdas_test[k])
+            mus, errs, Neffs = self.selectionBias.Ndet_batch(Lambdas_test[inside])
+            blobs['mus'][inside], blobs['errs'][inside], blobs['Neffs'][inside] = mus, errs, Neffs
+            
+            thresholds = self.bias_safety_factor*np.array([data.Nobs for data in self.hyperLikelihood.data])
+            for k in inside:
+                if self.telemetry is not None:
+                    for i in range(nData):
+                        self.telemetry.update('injections_%s' %i, blobs['Neffs'][k][i], thresholds[i])
+                if np.any(blobs['Neffs'][k]<thresholds):
+                    if self.verbose:
+                        print('NEED MORE SAMPLES FOR SELECTION EFFECTS! Nobs = %s, Neff = %s, Values of Lambda: %s' %(str(thresholds/self.bias_safety_factor), str(blobs['Neffs'][k]), str(Lambdas_test[k])))
+                    continue
+                if self.marginalize_R0:
+                    logPosts[k] = self._logLik_marginal_R0(blobs['lls'][k], blobs['mus'][k], blobs['Neffs'][k])+blobs['lp'][k]
+                else:
+                    logPosts[k] = (blobs['lls'][k]-blobs['mus'][k]+blobs['errs'][k]).sum()+blobs['lp'][k]
+        
+        if return_blob:
+            return logPosts, blobs
+        return logPosts
+    
+    
+    def logPosterior_from_blobs(self, blobs):
+        '''
+        Log posterior from its components (structured array with dtype blobs_dtype),
+        e.g. after some of them have been recomputed for a modified model.
+        The same cuts on Neff of logPosterior are applied.
+        '''
+        thresholds = self.bias_safety_factor*np.array([data.Nobs for data in self.hyperLikelihood.data])
+        logPosts = np.full(blobs.shape[0], -np.inf)
+        with np.errstate(invalid='ignore'):
+            ok = np.isfinite(blobs['lp']) & np.all(np.isfinite(blobs['lls']), axis=1) & np.all(blobs['Neffs']>=thresholds, axis=1)
+        if self.marginalize_R0:
+            for k in np.where(ok)[0]:
+                logPosts[k] = self._logLik_marginal_R0(blobs['lls'][k], blobs['mus'][k], blobs['Neffs'][k])+blobs['lp'][k]
+        else:
+            logPosts[ok] = (blobs['lls'][ok]-blobs['mus'][ok]+blobs['errs'][ok]).sum(axis=1)+blobs['lp'][ok]
+        return logPosts
 
+
+    def _rejected_blob(self, lp):
+        nData = len(self.hyperLikelihood.data)
+        return (lp, )+tuple(np.full(nData, np.NaN) for _ in range(4))
+    
         
-    def logPosterior(self, Lambda_test, return_all=False,):
+    @profiled
+    def logPosterior(self, Lambda_test, return_all=False, return_grad=False, return_blob=False):
+        '''
+        Log posterior. If return_grad, the gradient wrt params_inference is returned 
+        as an additional (last) output. Requires a selectionBias object
+        
+        If return_blob, returns logPost, lp, lls, mus, errs, Neffs with the components of the posterior 
+        as arrays of fixed length (see blobs_dtype), so that they can be stored as emcee blobs. 
+        Components are NaN if the point is rejected by the prior
+        '''
+        if return_grad and self.selectionBias is None:
+            raise NotImplementedError('Gradient of the posterior is only supported with a SelectionBias object')
+        if return_grad and self.marginalize_R0:
+            raise NotImplementedError('Gradient of the posterior is not supported with analytic marginalization over R0')
         
         # Compute prior
         lp = self.prior.logPrior(Lambda_test)
         if not np.isfinite(lp):
+            if return_blob:
+                res = (-np.inf, )+self._rejected_blob(lp)
+                if return_grad:
+                    return res+(np.zeros(len(self.prior.params_inference)), )
+                return res
+            if return_grad:
+                return -np.inf, np.zeros(len(self.prior.params_inference))
             return -np.inf
         
         # Get all parameters in case we are fixing some of them
         # Lambda = self.hyperLikelihood.population.get_Lambda(Lambda_test, self.prior.params_inference )
         
         # Compute likelihood
-        lls = self.hyperLikelihood.logLik(Lambda_test)
+        if return_grad:
+            lls, dlls = self.hyperLikelihood.logLik(Lambda_test, return_grad=True)
+        else:
+            lls = self.hyperLikelihood.logLik(Lambda_test)
         
         #logll = np.log(ll)
         
@@ -50,15 +240,21 @@ class Posterior(object):
         # Compute selection bias
         # Includes uncertainty on MC estimation of the selection effects if required. err is =zero if we required to ignore it.
         if self.selectionBias is not None:
-            mus, errs, Neffs = self.selectionBias.Ndet(Lambda_test, )
+            if return_grad:
+                mus, errs, Neffs, dmus, derrs = self.selectionBias.Ndet(Lambda_test, return_grad=True)
+            else:
+                mus, errs, Neffs = self.selectionBias.Ndet(Lambda_test, )
         else:
             Lambda = self.hyperLikelihood.population.get_Lambda(Lambda_test, self.hyperLikelihood.params_inference )
             mus = [ self.hyperLikelihood.population.Nperyear_expected(Lambda)*self.hyperLikelihood._getTobs(self.hyperLikelihood.data[i]) for i in range(len(lls))]
             errs = [0 for _ in range(len(lls))]
+            Neffs = [np.inf for _ in range(len(lls))]
             
         #logNdet = logdiffexp(logMu, logErr )
         logPosts = np.zeros(len(lls))
         for i in range(len(lls)):
+            if self.telemetry is not None:
+                self.telemetry.update('injections_%s' %i, Neffs[i], self.bias_safety_factor * self.hyperLikelihood.data[i].Nobs)
             if Neffs[i] < self.bias_safety_factor * self.hyperLikelihood.data[i].Nobs:
                 if self.verbose:
                     print('NEED MORE SAMPLES FOR SELECTION EFFECTS! Nobs = %s, Neff = %s, Values of Lambda: %s' %(self.hyperLikelihood.data[i].Nobs, Neffs[i], str(Lambda_test)))
@@ -71,16 +267,32 @@ class Posterior(object):
         
         # sum log likelihood of different datasets
         logPost = logPosts.sum()
+        if self.marginalize_R0 and np.isfinite(logPost):
+            logPost = self._logLik_marginal_R0(lls, mus, Neffs)
         
         
         # Add prior
         logPost += lp
         
+        if return_grad:
+            grad = self.prior.gradLogPrior(Lambda_test)
+            if np.isfinite(logPost):
+                for i in range(len(lls)):
+                    grad += dlls[i]-dmus[i]+derrs[i]
         
+        if return_blob:
+            res = (logPost, lp, np.array(lls, dtype=np.float64), np.array(mus, dtype=np.float64), np.array(errs, dtype=np.float64), np.array(Neffs, dtype=np.float64))
+            if return_grad:
+                return res+(grad, )
+            return res
         
         if not return_all:
+            if return_grad:
+                return logPost, grad
             return logPost
         else:
+            if return_grad:
+                return logPost, lp, lls, mus, errs, grad
             return logPost, lp, lls, mus, errs #np.exp( logMu.astype('float128')), np.exp(logErr.astype('float128'))
         
         
@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+#    Copyright (c) 2021 Michele Mancarella <michele.mancarella@unige.ch>
+#
+#    All rights reserved. Use of this source code is governed by a modified BSD
+#    license that can be found in the LICENSE file.
+
+import os
+import hashlib
+from collections import OrderedDict
+import numpy as np
+import h5py
+
+
+
+class CachedPosterior(object):
+
+    '''
+    Memoization of Posterior.logPosterior with bounded size and LRU eviction.
+    Entries are keyed on a hash of the parameter vector and of the configuration of the posterior
+    (parameters of the inference, fixed values, prior, datasets and injections), and store
+    the full breakdown of the posterior (see Posterior.blobs_dtype) and the gradient if it was computed.
+
+    logPosterior has the same signature and outputs as Posterior.logPosterior.
+    Evaluations are bitwise reproducible only for deterministic selection bias objects.
+
+    Usage:
+
+    myPost = Posterior(myLik, myPrior, selBias)
+    myCachedPost = CachedPosterior(myPost, maxsize=100000, fname='cache.h5')
+    myCachedPost.logPosterior(Lambda_test)
+    ...
+    myCachedPost.print_stats()
+    myCachedPost.save()
+
+    '''
+
+    def __init__(self, posterior, maxsize=100000, fname=None):
+        '''
+
+        Parameters
+        ----------
+        posterior : obj of type Posterior
+        maxsize : int
+            maximum number of entries. The least recently used ones are dropped first
+        fname : str, optional
+            HDF5 file used to persist the cache between sessions.
+            If it exists and was written with the same configuration, it is loaded
+
+        '''
+        self.posterior = posterior
+        self.maxsize = maxsize
+        self.fname = fname
+        self.configKey = self._config_key()
+        self.cache = OrderedDict()
+        self.reset_stats()
+        if fname is not None and os.path.exists(fname):
+            self.load(fname)
+
+
+    @staticmethod
+    def _hash_arrays(hasher, obj, names):
+        '''
+        Adds to hasher the shape, dtype and content of the arrays of obj in names (or of lists of arrays, e.g. spins).
+        Contiguous (also memory-mapped) arrays are hashed without copies
+        '''
+        for name in names:
+            arrs = getattr(obj, name, None)
+            if arrs is None:
+                continue
+            if not isinstance(arrs, list):
+                arrs = [arrs]
+            for arr in arrs:
+                arr = np.ascontiguousarray(arr)
+                hasher.update(('%s%s%s' %(name, arr.shape, arr.dtype.str)).encode())
+                hasher.update(arr)
+
+
+    def _config_key(self):
+        '''
+        Hash of the configuration of the posterior, including the content of the datasets and of the injections
+        and the settings that select them (condition, thresholds), so that a cache written for different data is not used
+        '''
+        post = self.posterior
+        lik = post.hyperLikelihood
+        config = [ lik.params_inference,
+                   sorted(lik.population.baseValues.items()),
+                   [(param, post.prior.priorLimits[param], post.prior.priorNames[param]) for param in post.prior.params_inference],
+                   sorted((k, sorted(v.items())) for k, v in post.prior.priorParams.items()),
+                   post.bias_safety_factor,
+                   lik.safety_factor,
+                   (post.marginalize_R0, post.R0_prior, tuple(post.R0_limits)),
+                   [(data.__class__.__name__, data.Nobs, data.Tobs) for data in lik.data],
+                   post.selectionBias.__class__.__name__ ]
+        if post.selectionBias is not None:
+            config.append([ getattr(post.selectionBias, name, None) for name in ('get_uncertainty', 'Neff_target', 'max_std', 'min_points', 'snr_th', 'Tobs', 'dL2Gpc')])
+            config.append([ (injData.__class__.__name__, float(injData.N_gen), injData.m1z.shape[0], injData.Tobs,
+                             [getattr(injData, name, None) for name in ('snr_th', 'ifar_th', 'max_z', 'which_spins')])
+                            for injData in post.selectionBias.injData])
+            config.append([ sorted(network.get_detectors()) for network in getattr(post.selectionBias, 'networks', [])])
+        hasher = hashlib.sha1(repr(config).encode())
+        for data in lik.data:
+            self._hash_arrays(hasher, data, ('m1z', 'm2z', 'dL', 'spins', 'Nsamples'))
+            hasher.update(np.ascontiguousarray(data.logOrMassPrior()))
+            hasher.update(np.ascontiguousarray(data.logOrDistPrior()))
+        if post.selectionBias is not None:
+            for injData in post.selectionBias.injData:
+                # Injections not selected yet are hashed with the condition
+                self._hash_arrays(hasher, injData, ('m1z', 'm2z', 'dL', 'log_weights_sel', 'spins', 'condition'))
+            # Semi-analytic selection bias: quadrature grid, and angular factors and oSNRs of the networks on it
+            self._hash_arrays(hasher, post.selectionBias, ('m1', 'm2', 'z', 'logWeights', 'levels', 'logmBinEdges', 'wQuantiles', 'gridOSNR'))
+        return hasher.hexdigest()
+
+
+    def _key(self, Lambda_test):
+        return hashlib.sha1(np.ascontiguousarray(Lambda_test, dtype=np.float64).tobytes()+self.configKey.encode()).hexdigest()
+
+
+    def reset_stats(self):
+        self.nHits = 0
+        self.nMisses = 0
+        self.nEvictions = 0
+
+
+    def stats(self):
+        nCalls = self.nHits+self.nMisses
+        return {'nCalls': nCalls, 'nHits': self.nHits, 'nMisses': self.nMisses, 'nEvictions': self.nEvictions,
+                'hitRate': self.nHits/max(nCalls, 1), 'size': len(self.cache)}
+
+
+    def print_stats(self):
+        st = self.stats()
+        print('Posterior cache: %s calls, %s hits, hit rate %.3f, %s entries, %s evictions' %(st['nCalls'], st['nHits'], st['hitRate'], st['size'], st['nEvictions']))
+
+
+    def clear(self):
+        self.cache = OrderedDict()
+
+
+    def _insert(self, key, entry):
+        self.cache[key] = entry
+        self.cache.move_to_end(key)
+        while len(self.cache)>self.maxsize:
+            self.cache.popitem(last=False)
+            self.nEvictions += 1
+
+
+    def logPosterior(self, Lambda_test, return_all=False, return_grad=False, return_blob=False):
+
+        key = self._key(Lambda_test)
+        entry = self.cache.get(key)
+        if entry is not None and (not return_grad or entry['grad'] is not None):
+            self.nHits += 1
+            self.cache.move_to_end(key)
+        else:
+            self.nMisses += 1
+            res = self.posterior.logPosterior(Lambda_test, return_grad=return_grad, return_blob=True)
+            entry = {'blob': res[:6], 'grad': res[6] if return_grad else None}
+            self._insert(key, entry)
+
+        logPost, lp, lls, mus, errs, Neffs = entry['blob']
+        if return_blob:
+            res = (logPost, lp, lls.copy(), mus.copy(), errs.copy(), Neffs.copy())
+        elif return_all:
+            res = (logPost, lp, list(lls), list(mus), list(errs))
+        else:
+            res = (logPost, )
+        if return_grad:
+            res = res+(entry['grad'].copy(), )
+        if len(res)==1:
+            return res[0]
+        return res
+
+
+    def save(self, fname=None):
+        '''
+        Writes the cache to HDF5. Entries are ordered from least to most recently used
+        '''
+        if fname is None:
+            fname = self.fname
+        nParams = len(self.posterior.hyperLikelihood.params_inference)
+        keys = list(self.cache.keys())
+        blobs = np.empty(len(keys), dtype=[('logPost', np.float64)]+self.posterior.blobs_dtype.descr)
+        grads = np.full((len(keys), nParams), np.NaN)
+        hasGrad = np.zeros(len(keys), dtype=bool)
+        for i, key in enumerate(keys):
+            entry = self.cache[key]
+            blobs[i] = entry['blob']
+            if entry['grad'] is not None:
+                grads[i] = entry['grad']
+                hasGrad[i] = True
+        with h5py.File(fname, 'w') as f:
+            f.attrs['configKey'] = self.configKey
+            f.create_dataset('keys', data=np.array(keys, dtype='S40'))
+            f.create_dataset('blobs', data=blobs)
+            f.create_dataset('grads', data=grads)
+            f.create_dataset('hasGrad', data=hasGrad)
+        print('Saved %s entries of the posterior cache to %s' %(len(keys), fname))
+
+
+    def load(self, fname):
+        with h5py.File(fname, 'r') as f:
+            if f.attrs['configKey']!=self.configKey:
+                print('Posterior cache in %s was written with a different configuration. Not loading.' %fname)
+                return
+            keys = [k.decode() for k in np.array(f['keys'])]
+            blobs = np.array(f['blobs'])
+            grads = np.array(f['grads'])
+            hasGrad = np.array(f['hasGrad'])
+        for i, key in enumerate(keys):
+            b = blobs[i]
+            entry = {'blob': (b['logPost'], b['lp'], b['lls'], b['mus'], b['errs'], b['Neffs']),
+                     'grad': grads[i] if hasGrad[i] else None}
+            self._insert(key, entry)
+        print('Loaded %s entries of the posterior cache from %s' %(len(keys), fname))
@@ -6,6 +6,7 @@ Created on Thu Mar  4 11:31:43 2021
 @author: Michi
 """
 import numpy as np
+from .profiling import profiled
 
 
 
@@ -50,15 +51,29 @@ class Prior(object):
         self.priorNames = priorNames
         self.priorParams = priorParams
         
+        self._compile()
+    
+    
+    def _compile(self):
+        '''
+        Stores limits and prior types as arrays, so that logPrior is vectorized over parameters and points.
+        Parameters with types other than 'flatLog' and 'gauss' have flat prior
+        '''
+        self.nParams = len(self.params_inference)
+        self._limInf = np.array([self.priorLimits[param][0] for param in self.params_inference], dtype=float)
+        self._limSup = np.array([self.priorLimits[param][1] for param in self.params_inference], dtype=float)
+        
+        self._flatLogIdx = np.array([i for i,param in enumerate(self.params_inference) if self.priorNames[param]=='flatLog'], dtype=int)
+        self._gaussIdx = np.array([i for i,param in enumerate(self.params_inference) if self.priorNames[param]=='gauss'], dtype=int)
+        self._mu = np.array([self.priorParams[self.params_inference[i]]['mu'] for i in self._gaussIdx], dtype=float)
+        self._sigma = np.array([self.priorParams[self.params_inference[i]]['sigma'] for i in self._gaussIdx], dtype=float)
     
     
     def _logGauss(self, x, mu, sigma):
         '''
         gaussian prior
         '''
-        if np.abs(x-mu)>7*sigma:
-            return np.NINF
-        return (-np.log(sigma)-(x-mu)**2/(2*sigma**2))
+        return np.where(np.abs(x-mu)>7*sigma, np.NINF, -np.log(sigma)-(x-mu)**2/(2*sigma**2))
     
     
     def _flatLog(self, x):
@@ -68,32 +83,62 @@ class Prior(object):
         return -np.log(x)
     
     
+    @profiled
     def logPrior(self, Lambda_test):
+        '''
+        Log prior for a single point (scalar or array of length len(params_inference)),
+        or for an array of shape (nPoints, len(params_inference)). 
+        In the latter case returns an array of length nPoints, with -inf for points outside the prior range
+        '''
+        x = np.asarray(Lambda_test, dtype=float)
+        single = x.ndim<2
+        x = x.reshape(-1, self.nParams)
         
-        if np.isscalar(Lambda_test):
-            limInf, limSup =  self.priorLimits[self.params_inference[0]]
-            condition = limInf < Lambda_test < limSup
-        else:
-            condition = True
-            for i,param in enumerate(self.params_inference):
-                limInf, limSup = self.priorLimits[param]
-                condition &= limInf < Lambda_test[i] < limSup
-    
-        if not condition:
-            return np.NINF
+        inside = np.all( (x>self._limInf) & (x<self._limSup), axis=1)
+        lp = np.full(x.shape[0], np.NINF)
+        xin = x[inside]
+        lp[inside] = self._flatLog(xin[:, self._flatLogIdx]).sum(axis=1)+self._logGauss(xin[:, self._gaussIdx], self._mu, self._sigma).sum(axis=1)
         
-        lp = 0
-        for i,param in enumerate(self.params_inference):
-            pname= self.priorNames[param]
-            if np.isscalar(Lambda_test):
-                    x = Lambda_test
-            else:
-                    x=Lambda_test[i]
-            if pname=='flatLog':
-                lp+=self._flatLog(x)
-            elif pname=='gauss':
-                mu, sigma = self.priorParams[param]['mu'], self.priorParams[param]['sigma']
-                lp +=  self._logGauss( x, mu, sigma)
+        if single:
+            return lp[0]
         return lp
+    
+    
+    def gradLogPrior(self, Lambda_test):
+        '''
+        Gradient of the log prior wrt params_inference, inside the prior range.
+        For an array of shape (nPoints, len(params_inference)), returns an array with the same shape
+        '''
+        x = np.asarray(Lambda_test, dtype=float)
+        single = x.ndim<2
+        x = x.reshape(-1, self.nParams)
+        
+        grad = np.zeros(x.shape)
+        grad[:, self._flatLogIdx] = -1/x[:, self._flatLogIdx]
+        grad[:, self._gaussIdx] = -(x[:, self._gaussIdx]-self._mu)/self._sigma**2
         
-        
\ No newline at end of file
+        if single:
+            return grad[0]
+        return grad
+    
+    
+    def sample(self, nSamples, seed=None):
+        '''
+        Draws nSamples points from the prior. Returns array of shape (nSamples, len(params_inference))
+        '''
+        rng = np.random.default_rng(seed)
+        x = self._draw(nSamples, rng)
+        # Redraw all the parameters of points outside the prior range: gaussian parameters beyond the limits,
+        # or flat parameters drawn exactly at the lower limit, which logPrior excludes
+        out = ~np.isfinite(self.logPrior(x))
+        while np.any(out):
+            x[out] = self._draw(out.sum(), rng)
+            out[out] = ~np.isfinite(self.logPrior(x[out]))
+        return x
+    
+    
+    def _draw(self, nSamples, rng):
+        x = rng.uniform(self._limInf, self._limSup, size=(nSamples, self.nParams))
+        x[:, self._flatLogIdx] = np.exp(rng.uniform(np.log(self._limInf[self._flatLogIdx]), np.log(self._limSup[self._flatLogIdx]), size=(nSamples, len(self._flatLogIdx))))
+        x[:, self._gaussIdx] = rng.normal(self._mu, self._sigma, size=(nSamples, len(self._gaussIdx)))
+        return x
@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+#    Copyright (c) 2021 Michele Mancarella <michele.mancarella@unige.ch>
+#
+#    All rights reserved. Use of this source code is governed by a modified BSD
+#    license that can be found in the LICENSE file.
+
+import time
+import json
+import threading
+import functools
+import numpy as np
+
+
+# Profiler collecting the timings in this process (see StageProfiler.enable). None when profiling is off
+_active = None
+
+
+
+def profiled(method):
+    '''
+    Decorator for the stages timed by StageProfiler: methods of Posterior, Prior, HyperLikelihood,
+    the selection bias classes, AllPopulations and Cosmo.
+    The stage is named ClassOfTheInstance.method. When no profiler is enabled,
+    the method is called directly after checking one global
+    '''
+    name = method.__name__
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        profiler = _active
+        if profiler is None:
+            return method(self, *args, **kwargs)
+        return profiler._call(method, '%s.%s' %(self.__class__.__name__, name), self, args, kwargs)
+
+    return wrapper
+
+
+
+class StageProfiler(object):
+
+    '''
+    Cumulative wall time, call counts and array sizes for the stages of the posterior
+    (methods decorated with profiled in Posterior, Prior, HyperLikelihood, SelectionBiasInjections and its subclasses,
+    SelectionBiasSemiAnalytic, AllPopulations and Cosmo).
+
+    Profiling is off by default. It is on between enable() and disable(), or inside a with block.
+    Only the calls made in the current process are recorded (not those in the workers of a pool).
+    For each stage, the total time includes the time spent in the other timed stages called by it,
+    while the self time does not. For example, the self time of HyperLikelihood._logLik
+    is the time spent in the log-sum-exp over samples and in the masking.
+    A stage called again while it is running (e.g. a subclass calling the method of its parent) is counted once.
+    The size recorded for each call is that of the first array argument
+    (e.g. number of samples or injections for population and cosmology stages).
+
+    Usage:
+
+    myProfiler = StageProfiler()
+    with myProfiler:
+        myPost.logPosterior(Lambda_test)
+        ...
+    myProfiler.print_table()
+    myProfiler.save('profile.json')
+
+    '''
+
+    def __init__(self, ):
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._previous = None
+        self.reset()
+
+
+    def reset(self):
+        self.stats = {}
+
+
+    def enable(self):
+        global _active
+        self._previous = _active
+        _active = self
+        return self
+
+
+    def disable(self):
+        global _active
+        _active = self._previous
+        self._previous = None
+
+
+    def __enter__(self):
+        return self.enable()
+
+
+    def __exit__(self, *exc):
+        self.disable()
+        return False
+
+
+    def _call(self, method, key, obj, args, kwargs):
+        local = self._local
+        if not hasattr(local, 'stack'):
+            local.stack, local.running = [], set()
+        if key in local.running:
+            return method(obj, *args, **kwargs)
+        local.stack.append(0.)
+        local.running.add(key)
+        t0 = time.perf_counter()
+        try:
+            return method(obj, *args, **kwargs)
+        finally:
+            dt = time.perf_counter()-t0
+            tChildren = local.stack.pop()
+            local.running.discard(key)
+            if local.stack:
+                local.stack[-1] += dt
+            size = 0
+            for arg in args:
+                if isinstance(arg, np.ndarray):
+                    size = arg.size
+                    break
+            with self._lock:
+                self._record(key, dt, dt-tChildren, size)
+
+
+    def _record(self, key, dt, dtSelf, size):
+        if key not in self.stats:
+            self.stats[key] = {'nCalls': 0, 'totTime': 0., 'selfTime': 0., 'totSize': 0, 'maxSize': 0}
+        st = self.stats[key]
+        st['nCalls'] += 1
+        st['totTime'] += dt
+        st['selfTime'] += dtSelf
+        st['totSize'] += int(size)
+        st['maxSize'] = max(st['maxSize'], int(size))
+
+
+    def summary(self):
+        '''
+        Returns a dictionary with one entry per stage, sorted by decreasing self time
+        '''
+        res = {}
+        for key in sorted(self.stats.keys(), key=lambda k: -self.stats[k]['selfTime']):
+            st = dict(self.stats[key])
+            st['timePerCall'] = st['totTime']/st['nCalls']
+            st['meanSize'] = st['totSize']/st['nCalls']
+            res[key] = st
+        return res
+
+
+    def table(self):
+        res = self.summary()
+        totSelf = sum(st['selfTime'] for st in res.values())
+        lines = ['%-45s %10s %12s %12s %8s %12s %12s' %('Stage', 'Calls', 'Total [s]', 'Self [s]', 'Self %', 'Per call [s]', 'Mean size')]
+        for key, st in res.items():
+            lines.append('%-45s %10d %12.4f %12.4f %8.2f %12.3e %12.1f' %(key, st['nCalls'], st['totTime'], st['selfTime'],
+                                                                      100*st['selfTime']/max(totSelf, 1e-300), st['timePerCall'], st['meanSize']))
+        return '\n'.join(lines)
+
+
+    def print_table(self):
+        print(self.table())
+
+
+    def save(self, fname):
+        '''
+        Dump summary to JSON. Overwrites the file, so it can be called at every checkpoint
+        '''
+        with open(fname, 'w') as f:
+            json.dump(self.summary(), f, indent=2)
@@ -10,6 +10,16 @@ from abc import ABC, abstractmethod
 import numpy as np
 #from .. import utils
 import scipy.stats as ss
+import astropy.units as u
+
+import os
+import sys
+PACKAGE_PARENT = '..'
+SCRIPT_DIR = os.path.dirname(os.path.realpath(os.path.join(os.getcwd(), os.path.expanduser(__file__))))
+sys.path.append(os.path.normpath(os.path.join(SCRIPT_DIR, PACKAGE_PARENT)))
+
+from dataStructures.multiRunInjections import MultiRunInjectionsData
+from .profiling import profiled
 
 
 
@@ -30,6 +40,17 @@ def logdiffexpvec(xs, ys):
     return xs[0] + np.log1p(  np.sum(np.exp(xs[1:]-xs[0]))  - np.sum(np.exp(ys-xs[0])) )
 
 
+def logsumexp_segments(x, offsets):
+    '''
+    computes log( sum_i(e^x_i) ) separately over the contiguous segments of x starting at offsets, along the last axis
+    '''
+    m = np.maximum.reduceat(x, offsets, axis=-1)
+    m = np.where(np.isfinite(m), m, 0.)
+    counts = np.diff(np.append(offsets, x.shape[-1]))
+    with np.errstate(divide='ignore'):
+        return m + np.log(np.add.reduceat(np.exp(x-np.repeat(m, counts, axis=-1)), offsets, axis=-1))
+
+
 
 
 
@@ -55,7 +76,7 @@ class SelectionBiasInjections(SelectionBias):
     Logic for computing the selection effects
     '''
     
-    def __init__(self, population, injData, params_inference, get_uncertainty=True ):
+    def __init__(self, population, injData, params_inference, get_uncertainty=True, mem_budget_MB=64, merge_runs=False ):
         ''' 
 
         Parameters
@@ -66,16 +87,36 @@ class SelectionBiasInjections(SelectionBias):
         injData: Data object . Contains the injections data. Shoulf have attributes:
                 log_weights_sel' : [array of log_p_draw]
                  'logN_gen': number of injections 
-                 'condition': if any, some condition to filter injections
+                 'condition': if any, some condition to filter injections. 
+                              This is applied once here if the data objects did not already do it at loading
+        
+        mem_budget_MB: approximate memory used for temporary arrays by Ndet_batch. 
+                       Sets the number of injections processed at a time.
+        
+        merge_runs: if True, all injection sets are merged in a MultiRunInjectionsData object 
+                    and Ndet and Ndet_batch do a single population evaluation for all of them.
+                    If a str, directory where the merged injections are written once and memory-mapped 
+                    (see MultiRunInjectionsData)
            
 
         '''
         
         
         self.get_uncertainty=get_uncertainty
+        self.mem_budget_MB=mem_budget_MB
         SelectionBias.__init__(self, population, injData, params_inference)
+        
+        # From now on, injections arrays only contain detected injections
+        for injData_ in self.injData:
+            if injData_.condition is not True:
+                injData_._apply_condition(injData_.condition)
+        
+        self.merge_runs=merge_runs
+        if merge_runs:
+            self.injStore = MultiRunInjectionsData(self.injData, path=merge_runs if isinstance(merge_runs, str) else None)
     
     
+    @profiled
     def _get_mass_redshift(self, Lambda, injData):
         
         LambdaCosmo, LambdaAllPop = self.population._split_params(Lambda)
@@ -95,7 +136,8 @@ class SelectionBiasInjections(SelectionBias):
         return injData.Tobs
     
     
-    def _Ndet(self, Lambda_test, injData, verbose=False, ):
+    @profiled
+    def _Ndet(self, Lambda_test, injData, verbose=False, return_grad=False):
         
         Lambda = self.population.get_Lambda(Lambda_test, self.params_inference )
         
@@ -105,13 +147,12 @@ class SelectionBiasInjections(SelectionBias):
         
         #logdN=np.empty_like(m1)
         #logdN[~injData.condition]=np.NINF
-    
-        m1, m2, z, spins = m1[injData.condition], m2[injData.condition], z[injData.condition], [s[injData.condition] for s in spins]
         
+        # injData only contains injections satisfying the selection condition, see __init__
         
         #logdN =  np.where( injData.condition, self.population.log_dN_dm1zdm2zddL(m1, m2, z, spins, Tobs, Lambda),  np.NINF) 
         #logdN -= injData.log_weights_sel
-        logdN=np.squeeze(self.population.log_dN_dm1zdm2zddL(m1, m2, z, spins, Tobs, Lambda, dL=injData.dL[injData.condition])-injData.log_weights_sel[injData.condition])
+        logdN=self.population.log_dN_dm1zdm2zddL(m1, m2, z, spins, Tobs, Lambda, dL=injData.dL)-injData.log_weights_sel
         
         
         logMu = np.logaddexp.reduce(logdN) - injData.logN_gen
@@ -135,7 +176,15 @@ class SelectionBiasInjections(SelectionBias):
                 # return -inf and reject sample
                 #return mu, np.NINF
 
+        if return_grad:
+            # Gradients of mu and of the MC variance of the estimator, wrt params_inference
+            grad_logdN = self.population.grad_log_dN_dm1zdm2zddL(m1, m2, z, spins, Tobs, Lambda, self.params_inference, dL=injData.dL)
+            dmu = mu*(np.exp(logdN-np.logaddexp.reduce(logdN))*grad_logdN).sum(axis=-1)
+            dSigmaSq = 2*np.exp(logs2)*(np.exp(2*logdN-np.logaddexp.reduce(2*logdN))*grad_logdN).sum(axis=-1) - 2*mu*dmu/np.exp(injData.logN_gen)
+
         if not self.get_uncertainty:
+            if return_grad:
+                return mu, 0, Neff, dmu, np.zeros(len(self.params_inference))
             return mu, 0, Neff
 
         ## Effects of uncertainty on selection effect and/or marginalisation over total rate
@@ -149,25 +198,644 @@ class SelectionBiasInjections(SelectionBias):
         den = ss.norm(loc=mu, scale=Sigma ).logsf(0)
         error = SigmaSq/2-den+num
         
+        if return_grad:
+            # d/dx log Phi(x) = phi(x)/Phi(x), with x=(mu-SigmaSq)/Sigma for num and x=mu/Sigma for den
+            dSigma = dSigmaSq/(2*Sigma)
+            xnum, xden = (mu-SigmaSq)/Sigma, mu/Sigma
+            dxnum = (dmu-dSigmaSq)/Sigma - xnum*dSigma/Sigma
+            dxden = dmu/Sigma - xden*dSigma/Sigma
+            derror = dSigmaSq/2 - np.exp(ss.norm.logpdf(xden)-ss.norm.logcdf(xden))*dxden + np.exp(ss.norm.logpdf(xnum)-ss.norm.logcdf(xnum))*dxnum
+            return mu, error, Neff, dmu, derror
                 
         return mu, error, Neff
     
     
-    def Ndet(self, Lambda_test, verbose=False, ):
+    def _get_mu_error_Neff(self, logS1, logS2, logN_gen):
+        '''
+        mu, error and Neff from the log sums of the weights and of the squared weights 
+        over all injections. Vectorized over the first argument (e.g. many values of Lambda)
+        '''
+        logMu = logS1 - logN_gen
+        if np.any(np.isnan(logMu)):
+            raise ValueError('NaN value for logMu.')
+        mu = np.exp(logMu)
+        logs2 = logS2 - 2*logN_gen
+        logSigmaSq = logdiffexp( logs2, 2.0*logMu - logN_gen )
+        Neff = np.exp( 2.0*logMu - logSigmaSq)
+        
+        if not self.get_uncertainty:
+            return mu, np.zeros(mu.shape), Neff
+        
+        ## Effects of uncertainty on selection effect and/or marginalisation over total rate
+        ## Adapted from 1904.10879
+        SigmaSq = np.exp(logSigmaSq)
+        Sigma = np.sqrt(SigmaSq)
+        num = ss.norm(loc=mu-SigmaSq, scale=Sigma).logsf(0)
+        den = ss.norm(loc=mu, scale=Sigma ).logsf(0)
+        error = SigmaSq/2-den+num
+        return mu, error, Neff
+    
+    
+    def _get_chunk_size(self, nLambdas):
+        # Rough estimate of the number of float64 temporaries of shape (nLambdas, chunk_size) created for the terms
+        # that are vectorized over Lambda, plus those created by the population function for one Lambda at a time
+        nTemp, nTempPop = 20, 50
+        return max(int(self.mem_budget_MB*2**20/(8*(nTemp*nLambdas+nTempPop))), 1)
+    
+    
+    @profiled
+    def _Ndet_batch(self, Lambdas, injData, chunk_size=None):
+        
+        if chunk_size is None:
+            chunk_size = self._get_chunk_size(len(Lambdas))
+        
+        # The interpolator for z(dL) only depends on the cosmology, build it once per Lambda
+        z2dL = []
+        for Lambda in Lambdas:
+            LambdaCosmo, LambdaAllPop = self.population._split_params(Lambda)
+            z2dL.append( self.population.cosmo.z_from_dLGW_interpolator(*self.population.cosmo._get_values(LambdaCosmo, ['H0', 'Om', 'w0','Xi0', 'n'])) )
+        Tobs = self._getTobs(injData)
+        
+        logS1 = np.full(len(Lambdas), np.NINF)
+        logS2 = np.full(len(Lambdas), np.NINF)
+        
+        # Loop over blocks of injections, and evaluate all Lambdas on each block at once (arrays of shape (nLambdas, chunk_size)).
+        # Running log-sum-exp over blocks gives the same sums as _Ndet
+        for start in range(0, injData.m1z.shape[0], chunk_size):
+            sl = slice(start, start+chunk_size)
+            dL, m1z, m2z, logw = injData.dL[sl], injData.m1z[sl], injData.m2z[sl], injData.log_weights_sel[sl]
+            spins = [s[sl] for s in self._getSpins(injData)]
+            z = np.array([interp(dL) for interp in z2dL])
+            logdN = self.population.log_dN_dm1zdm2zddL_batch(m1z, m2z, dL, spins, Tobs, Lambdas, z)-logw
+            logS1 = np.logaddexp(logS1, np.logaddexp.reduce(logdN, axis=1))
+            logS2 = np.logaddexp(logS2, np.logaddexp.reduce(2*logdN, axis=1))
+        
+        return self._get_mu_error_Neff(logS1, logS2, injData.logN_gen)
+    
+    
+    @profiled
+    def Ndet_batch(self, Lambdas_test, chunk_size=None):
+        '''
+        Selection bias for a block of values of Lambda in one pass over each injection set.
+
+        Parameters
+        ----------
+        Lambdas_test : array of shape (nLambdas, len(params_inference))
+        
+        chunk_size : int, optional
+            number of injections processed at a time. If None, it is set from mem_budget_MB
+
+        Returns
+        -------
+        mus, errs, Neffs : arrays of shape (nLambdas, number of injection sets) 
+
+        '''
+        Lambdas = [self.population.get_Lambda(Lambda_test, self.params_inference ) for Lambda_test in Lambdas_test]
+        if self.merge_runs:
+            return self._Ndet_batch_merged(Lambdas, chunk_size=chunk_size)
+        
+        mus = np.empty((len(Lambdas), len(self.injData)))
+        errs = np.empty((len(Lambdas), len(self.injData)))
+        Neffs = np.empty((len(Lambdas), len(self.injData)))
+        for i, injData_ in enumerate(self.injData):
+            mus[:, i], errs[:, i], Neffs[:, i] = self._Ndet_batch(Lambdas, injData_, chunk_size=chunk_size)
+        return mus, errs, Neffs
+    
+    
+    @profiled
+    def Ndet_snr_sweep(self, Lambda_test, snr_ths):
+        '''
+        mu, error and Neff for a vector of thresholds on the snr of the injections, 
+        with a single evaluation of the population. 
+        Injections are sorted by decreasing snr, so that the sums over detected injections 
+        for all thresholds are given by cumulative sums.
+        Injections data should have snrs (snr_sel). Detected injections have snr>threshold, 
+        as in GWMockInjectionsData.set_snr_threshold, so the result for each threshold is equal to Ndet 
+        after setting that threshold. Thresholds below the one used to generate the injections (snr_th) 
+        cannot be evaluated and give NaN.
+
+        Returns
+        -------
+        mus, errs, Neffs : lists with one entry per injection set, each an array of length len(snr_ths)
+        
+        '''
+        snr_ths = np.atleast_1d(snr_ths)
+        Lambda = self.population.get_Lambda(Lambda_test, self.params_inference )
+        
+        mus=[]
+        errs=[]
+        Neffs=[]
+        for injData in self.injData:
+            snr = getattr(injData, 'snr_sel', None)
+            if snr is None or snr.sum()==0.:
+                raise ValueError('SNRs are not available for this injection set')
+            
+            m1, m2, z = self._get_mass_redshift(Lambda, injData)
+            logdN = self.population.log_dN_dm1zdm2zddL(m1, m2, z, self._getSpins(injData), self._getTobs(injData), Lambda, dL=injData.dL)-injData.log_weights_sel
+            
+            if np.any(np.diff(snr)>0):
+                # Not sorted at loading (e.g. shuffled by AdaptiveSelectionBiasInjections)
+                order = np.argsort(-snr, kind='stable')
+                snr, logdN = snr[order], logdN[order]
+            
+            cum1 = np.logaddexp.accumulate(logdN)
+            cum2 = np.logaddexp.accumulate(2*logdN)
+            # Number of injections with snr>threshold
+            nDet = np.searchsorted(-snr, -snr_ths, side='left')
+            logS1 = np.where(nDet>0, cum1[np.maximum(nDet-1, 0)], np.NINF)
+            logS2 = np.where(nDet>0, cum2[np.maximum(nDet-1, 0)], np.NINF)
+            
+            with np.errstate(invalid='ignore'):
+                mu, error, Neff = self._get_mu_error_Neff(logS1, logS2, injData.logN_gen)
+            below = snr_ths<getattr(injData, 'snr_th', np.NINF)
+            mus.append(np.where(below, np.NaN, mu))
+            errs.append(np.where(below, np.NaN, error))
+            Neffs.append(np.where(below, np.NaN, Neff))
+        
+        return mus, errs, Neffs
+    
+    
+    @profiled
+    def _Ndet_merged(self, Lambda_test, verbose=False):
+        
+        Lambda = self.population.get_Lambda(Lambda_test, self.params_inference )
+        injStore = self.injStore
+        
+        m1, m2, z = self._get_mass_redshift(Lambda, injStore)
+        spins = self._getSpins(injStore)
+        
+        # Tobs differs between runs: evaluate with unit observation time 
+        # and add log Tobs of each run after the reduction
+        logdN=self.population.log_dN_dm1zdm2zddL(m1, m2, z, spins, 1., Lambda, dL=injStore.dL)-injStore.log_weights_sel
+        logS1 = logsumexp_segments(logdN, injStore.offsets) + injStore.logTobs
+        logS2 = logsumexp_segments(2*logdN, injStore.offsets) + 2*injStore.logTobs
+        
+        mu, error, Neff = self._get_mu_error_Neff(logS1, logS2, injStore.logN_gen)
+        return list(mu), list(error), list(Neff)
+    
+    
+    @profiled
+    def _Ndet_batch_merged(self, Lambdas, chunk_size=None):
+        '''
+        Same as _Ndet_batch on the merged store: blocks of injections may contain several runs, 
+        whose sums are accumulated separately
+        '''
+        if chunk_size is None:
+            chunk_size = self._get_chunk_size(len(Lambdas))
+        injStore = self.injStore
+        
+        z2dL = []
+        for Lambda in Lambdas:
+            LambdaCosmo, LambdaAllPop = self.population._split_params(Lambda)
+            z2dL.append( self.population.cosmo.z_from_dLGW_interpolator(*self.population.cosmo._get_values(LambdaCosmo, ['H0', 'Om', 'w0','Xi0', 'n'])) )
+        spins = self._getSpins(injStore)
+        ends = injStore.offsets+injStore.counts
+        
+        logS1 = np.full((len(Lambdas), injStore.nRuns), np.NINF)
+        logS2 = np.full((len(Lambdas), injStore.nRuns), np.NINF)
+        for start in range(0, injStore.m1z.shape[0], chunk_size):
+            stop = min(start+chunk_size, injStore.m1z.shape[0])
+            sl = slice(start, stop)
+            dL = injStore.dL[sl]
+            z = np.array([interp(dL) for interp in z2dL])
+            # Tobs differs between runs, see _Ndet_merged
+            logdN = self.population.log_dN_dm1zdm2zddL_batch(injStore.m1z[sl], injStore.m2z[sl], dL, [s[sl] for s in spins], 1., Lambdas, z)-injStore.log_weights_sel[sl]
+            runs = np.where((injStore.offsets<stop) & (ends>start) & (injStore.counts>0))[0]
+            segments = np.maximum(injStore.offsets[runs], start)-start
+            logS1[:, runs] = np.logaddexp(logS1[:, runs], logsumexp_segments(logdN, segments))
+            logS2[:, runs] = np.logaddexp(logS2[:, runs], logsumexp_segments(2*logdN, segments))
+        
+        return self._get_mu_error_Neff(logS1+injStore.logTobs, logS2+2*injStore.logTobs, injStore.logN_gen)
+    
+    
+    @profiled
+    def Ndet(self, Lambda_test, verbose=False, return_grad=False):
+        '''
+        Returns lists with mu, error, Neff for each injection set. 
+        If return_grad, returns also lists with the gradients of mu and of the error wrt params_inference
+        '''
+        if self.merge_runs and not return_grad:
+            return self._Ndet_merged(Lambda_test, verbose=verbose)
         
         mus=[]
         errs=[]
         Neffs=[]
+        dmus=[]
+        derrs=[]
         for i, injData_ in enumerate(self.injData):
             #if allNobs is None:
             #    Nobs=None
             #else: Nobs=allNobs[i]
-            mu_, err_, Neff_ = self._Ndet(Lambda_test, injData_, verbose=verbose, )
-            mus.append(mu_)
-            errs.append(err_)
-            Neffs.append(Neff_)
+            res = self._Ndet(Lambda_test, injData_, verbose=verbose, return_grad=return_grad)
+            mus.append(res[0])
+            errs.append(res[1])
+            Neffs.append(res[2])
+            if return_grad:
+                dmus.append(res[3])
+                derrs.append(res[4])
+        if return_grad:
+            return mus, errs, Neffs, dmus, derrs
         return mus, errs, Neffs
             
         
         
         
+
+
+class AdaptiveSelectionBiasInjections(SelectionBiasInjections):
+    
+    '''
+    Selection effects computed on the smallest subset of the injections that gives 
+    a large enough Neff.
+    The injections are shuffled once, so that the first n injections are a random subset. 
+    For each Lambda, the sums are computed on the first subset and extended to the next,
+    larger subset only if Neff is below the target. Sums over smaller subsets are re-used.
+    
+    Usage is recorded in self.nUsed (number of injections used for each injection set 
+    at the last call) and summarised by usage_summary()
+    '''
+    
+    def __init__(self, population, injData, params_inference, get_uncertainty=True, mem_budget_MB=64, 
+                 Neff_target=None, rel_err_target=None, min_fraction=0.1, growth=2., seed=None ):
+        '''
+        
+        Parameters
+        ----------
+        Neff_target : float, optional
+            minimum Neff required to stop at a subset. 
+            Should be above bias_safety_factor*Nobs used in Posterior, otherwise the point is rejected
+        rel_err_target : float, optional
+            maximum relative MC error of mu required to stop at a subset. 
+            Since sigma_mu/mu = Neff^(-1/2), this is equivalent to Neff_target = 1/rel_err_target^2.
+            If both are given, the most stringent is used
+        min_fraction : float
+            fraction of the injections in the smallest subset
+        growth : float
+            ratio between the sizes of consecutive subsets
+        seed : int, optional
+            seed for the shuffling of the injections
+
+        '''
+        SelectionBiasInjections.__init__(self, population, injData, params_inference, get_uncertainty=get_uncertainty, mem_budget_MB=mem_budget_MB)
+        
+        if Neff_target is None and rel_err_target is None:
+            raise ValueError('Adaptive selection bias needs Neff_target or rel_err_target')
+        self.Neff_target = 0.
+        if Neff_target is not None:
+            self.Neff_target = Neff_target
+        if rel_err_target is not None:
+            self.Neff_target = max(self.Neff_target, 1/rel_err_target**2)
+        print('Adaptive selection bias: target Neff is %s' %self.Neff_target)
+        
+        rng = np.random.default_rng(seed)
+        self.edges = []
+        for injData_ in self.injData:
+            nInj = injData_.m1z.shape[0]
+            # Indexing with a permutation shuffles all the per-injection arrays consistently
+            injData_._apply_condition(rng.permutation(nInj), verbose=False)
+            edges = []
+            nSub = max(int(min_fraction*nInj), 1)
+            while nSub<nInj:
+                edges.append(nSub)
+                nSub = int(np.ceil(nSub*growth))
+            edges.append(nInj)
+            self.edges.append(np.array(edges))
+            print('Subsets sizes: %s' %str(self.edges[-1]))
+        
+        self.reset_usage()
+    
+    
+    def reset_usage(self):
+        self.nCalls = 0
+        self.nUsed = [0 for _ in self.injData]
+        self.levelCounts = [np.zeros(len(e), dtype=int) for e in self.edges]
+        self.nNotConverged = np.zeros(len(self.injData), dtype=int)
+    
+    
+    def usage_summary(self):
+        '''
+        Number of calls, histogram of the subset used for each injection set, 
+        mean fraction of the injections used, and number of calls where the full set 
+        was not enough to reach the target.
+        '''
+        res = {'nCalls':self.nCalls, 'nNotConverged':self.nNotConverged }
+        res['levelCounts'] = self.levelCounts
+        res['subsetSizes'] = self.edges
+        res['meanFraction'] = np.array([ (c*e).sum()/max(c.sum(), 1)/e[-1] for c, e in zip(self.levelCounts, self.edges)])
+        return res
+    
+    
+    def print_usage(self):
+        res = self.usage_summary()
+        print('Adaptive selection bias: %s calls' %res['nCalls'])
+        for i in range(len(self.injData)):
+            print('Injection set %s: mean fraction of injections used: %s' %(i, res['meanFraction'][i]))
+            print('Calls per subset size: %s' %str(dict(zip(res['subsetSizes'][i], res['levelCounts'][i]))))
+            print('Calls not reaching the target with all injections: %s' %res['nNotConverged'][i])
+    
+    
+    @profiled
+    def _Ndet(self, Lambda_test, injData, verbose=False, return_grad=False):
+        
+        if return_grad:
+            raise NotImplementedError('Gradients are not available for the adaptive selection bias')
+        
+        Lambda = self.population.get_Lambda(Lambda_test, self.params_inference )
+        LambdaCosmo, LambdaAllPop = self.population._split_params(Lambda)
+        z2dL = self.population.cosmo.z_from_dLGW_interpolator(*self.population.cosmo._get_values(LambdaCosmo, ['H0', 'Om', 'w0','Xi0', 'n']))
+        spins = self._getSpins(injData)
+        Tobs = self._getTobs(injData)
+        
+        i = self.injData.index(injData)
+        edges = self.edges[i]
+        
+        logS1, logS2 = np.NINF, np.NINF
+        start = 0
+        for level, stop in enumerate(edges):
+            sl = slice(start, stop)
+            dL = injData.dL[sl]
+            z = z2dL(dL)
+            logdN = self.population.log_dN_dm1zdm2zddL(injData.m1z[sl]/(1+z), injData.m2z[sl]/(1+z), z, [s[sl] for s in spins], Tobs, Lambda, dL=dL)-injData.log_weights_sel[sl]
+            logS1 = np.logaddexp(logS1, np.logaddexp.reduce(logdN))
+            logS2 = np.logaddexp(logS2, np.logaddexp.reduce(2*logdN))
+            start = stop
+            
+            # The first n of the shuffled detected injections correspond to a fraction n/nTot of the generated ones
+            logN_gen = injData.logN_gen + np.log(stop/edges[-1])
+            mu, error, Neff = self._get_mu_error_Neff(logS1, logS2, logN_gen)
+            if Neff>=self.Neff_target:
+                break
+        
+        if Neff<self.Neff_target:
+            self.nNotConverged[i] += 1
+            if verbose:
+                print('Neff=%s below target with all injections. Values of Lambda: %s' %(Neff, str(Lambda)))
+        self.levelCounts[i][level] += 1
+        self.nUsed[i] = stop
+        
+        return mu, error, Neff
+
+
+    @profiled
+    def _Ndet_batch(self, Lambdas, injData, chunk_size=None):
+        '''
+        Same as _Ndet for several values of Lambda. Each subset is evaluated at once (see SelectionBiasInjections._Ndet_batch)
+        for the values of Lambda that have not reached the target on the smaller subsets.
+        nUsed is set to the size of the largest subset used in the batch
+        '''
+        if chunk_size is None:
+            chunk_size = self._get_chunk_size(len(Lambdas))
+
+        z2dL = []
+        for Lambda in Lambdas:
+            LambdaCosmo, LambdaAllPop = self.population._split_params(Lambda)
+            z2dL.append( self.population.cosmo.z_from_dLGW_interpolator(*self.population.cosmo._get_values(LambdaCosmo, ['H0', 'Om', 'w0','Xi0', 'n'])) )
+        spins = self._getSpins(injData)
+        Tobs = self._getTobs(injData)
+
+        i = self.injData.index(injData)
+        edges = self.edges[i]
+
+        logS1 = np.full(len(Lambdas), np.NINF)
+        logS2 = np.full(len(Lambdas), np.NINF)
+        mu, error, Neff = np.empty(len(Lambdas)), np.empty(len(Lambdas)), np.empty(len(Lambdas))
+        level = np.zeros(len(Lambdas), dtype=int)
+        active = np.ones(len(Lambdas), dtype=bool)
+        start = 0
+        for lev, stop in enumerate(edges):
+            idx = np.where(active)[0]
+            for chunkStart in range(start, stop, chunk_size):
+                sl = slice(chunkStart, min(chunkStart+chunk_size, stop))
+                dL = injData.dL[sl]
+                z = np.array([z2dL[k](dL) for k in idx])
+                logdN = self.population.log_dN_dm1zdm2zddL_batch(injData.m1z[sl], injData.m2z[sl], dL, [s[sl] for s in spins], Tobs, [Lambdas[k] for k in idx], z)-injData.log_weights_sel[sl]
+                logS1[idx] = np.logaddexp(logS1[idx], np.logaddexp.reduce(logdN, axis=1))
+                logS2[idx] = np.logaddexp(logS2[idx], np.logaddexp.reduce(2*logdN, axis=1))
+            start = stop
+
+            logN_gen = injData.logN_gen + np.log(stop/edges[-1])
+            mu[idx], error[idx], Neff[idx] = self._get_mu_error_Neff(logS1[idx], logS2[idx], logN_gen)
+            level[idx] = lev
+            active[idx] = Neff[idx]<self.Neff_target
+            if not active.any():
+                break
+
+        self.nNotConverged[i] += np.sum(Neff<self.Neff_target)
+        self.levelCounts[i] += np.bincount(level, minlength=len(edges))
+        self.nUsed[i] = edges[level.max()]
+
+        return mu, error, Neff
+
+
+    @profiled
+    def Ndet(self, Lambda_test, verbose=False, return_grad=False):
+        self.nCalls += 1
+        return SelectionBiasInjections.Ndet(self, Lambda_test, verbose=verbose, return_grad=return_grad)
+
+
+    @profiled
+    def Ndet_batch(self, Lambdas_test, chunk_size=None):
+        self.nCalls += len(Lambdas_test)
+        return SelectionBiasInjections.Ndet_batch(self, Lambdas_test, chunk_size=chunk_size)
+
+
+
+
+class SelectionBiasSemiAnalytic(SelectionBias):
+    
+    '''
+    Selection effects computed by quadrature of the population over a grid in 
+    source frame masses and redshift, with a semi-analytic detection probability.
+    
+    For a network of detectors, the SNR is written as 
+        SNR^2 = oSNR_ref(m1z, m2z, dL)^2 * w ,
+    where oSNR_ref is the optimal SNR of the first detector (from the oSNR interpolator) and 
+    w = sum_d s_d(m1z, m2z) Q_d is the network angular factor, with Q_d given by Detector._Qsq,
+    s_d = (oSNR_d/oSNR_ref)^2, and the duty cycle of each detector. 
+    The ratios s_d depend on the detector-frame masses when the detectors have different PSDs. 
+    They are evaluated at the centre of each cell of a log-spaced grid in (m1z, m2z), 
+    and the distribution of w in each cell is computed once by sampling the angles, so that
+        p_det(m1z, m2z, dL) = P( w > (snr_th/oSNR_ref)^2 ) 
+    is given by the CDF of the cell, stored at nQuantiles quantiles and interpolated linearly.
+    
+    The result has no Monte Carlo noise, so Neff is inf and error is zero.
+    p_det does not depend on spins, so the spin distribution integrates to one: 
+    only populations with DummySpinDist are supported.
+    '''
+    
+    def __init__(self, population, networks, params_inference, Tobs, snr_th=8., 
+                 mmin=2., mmax=150., zmax=3., nMasses=100, nz=100, nAngles=100000, nMassBins=20, nQuantiles=1000, seed=None ):
+        '''
+
+        Parameters
+        ----------
+        population : obj of type AllPopulations
+        networks : list of objects of type NetworkSNR (see mock/SNRtools.py), one for each dataset
+        params_inference : list
+        Tobs : list of observation times in yrs, one for each network
+        snr_th : float
+            threshold on the network SNR
+        mmin, mmax, zmax : float
+            range of the quadrature grid in source frame masses (log-spaced) and redshift.
+            Should contain the support of the population
+        nMasses, nz : int
+            number of points of the grid for each mass and for redshift
+        nAngles : int
+            number of samples of the angles used for the CDF of the angular factor
+        nMassBins : int
+            number of log-spaced bins in each detector-frame mass, over the range of the oSNR interpolator 
+            of the first detector, for the ratios of the oSNRs
+        nQuantiles : int
+            number of quantiles at which the CDF of the angular factor is stored in each mass bin
+
+        '''
+        SelectionBias.__init__(self, population, [], params_inference)
+        
+        for pop in self.population._pops:
+            if pop.spinDist.__class__.__name__ !='DummySpinDist':
+                raise NotImplementedError('Semi-analytic selection bias only supports populations with DummySpinDist')
+        
+        self.networks = networks
+        self.Tobs = Tobs
+        self.snr_th = snr_th
+        
+        # Midpoint rule on a grid in log m1, t, z, with log m2 = log mmin + t*(log m1 - log mmin) and 0<t<1, 
+        # so that the region m2<m1 is covered with the same number of points for each m1. 
+        # This resolves distributions of m2 concentrated near m1, which happens for m1 close to 
+        # the lower edge of the population: mmin should be set to that edge if it is known
+        logmEdges = np.linspace(np.log(mmin), np.log(mmax), nMasses+1)
+        tEdges = np.linspace(0, 1, nMasses+1)
+        zEdges = np.linspace(0, zmax, nz+1)
+        self.zGrid = (zEdges[1:]+zEdges[:-1])/2
+        z, logm1, t = np.meshgrid(self.zGrid, (logmEdges[1:]+logmEdges[:-1])/2, (tEdges[1:]+tEdges[:-1])/2, indexing='ij')
+        logm2 = np.log(mmin)+t*(logm1-np.log(mmin))
+        self.m1 = np.exp(logm1).ravel()
+        self.m2 = np.exp(logm2).ravel()
+        self.z = z.ravel()
+        self.zIdx = np.repeat(np.arange(nz), nMasses**2)
+        # log of the cell volume, plus the Jacobian of the change of variables
+        self.logWeights = (np.log(logmEdges[1]-logmEdges[0])+np.log(tEdges[1]-tEdges[0])+np.log(zEdges[1]-zEdges[0])+
+                           np.log(self.m1)+np.log(self.m2)+np.log(np.log(self.m1)-np.log(mmin)) )
+        
+        # dL of the population is in units of cosmo.dist_unit, the oSNR interpolators use Gpc
+        self.dL2Gpc = (1*self.population.cosmo.dist_unit).to(u.Gpc).value
+        
+        rng = np.random.default_rng(seed)
+        self.levels = np.linspace(0, 1, nQuantiles)
+        self.refDets = []
+        self.logmBinEdges = []
+        self.wQuantiles = []
+        self.gridBins = []
+        self.gridOSNR = []
+        for network in self.networks:
+            refDet, logmBinEdges, wQuantiles = self._angular_factor(network, nMassBins, nAngles, rng)
+            self.refDets.append(refDet)
+            self.logmBinEdges.append(logmBinEdges)
+            self.wQuantiles.append(wQuantiles)
+            # the detector-frame masses of the grid do not depend on Lambda
+            self.gridBins.append(self._mass_bins(self.m1*(1+self.z), self.m2*(1+self.z), len(self.refDets)-1))
+            self.gridOSNR.append(self._oSNR_pivot(self.m1*(1+self.z), self.m2*(1+self.z), len(self.refDets)-1))
+    
+    
+    def _angular_factor(self, network, nMassBins, nAngles, rng):
+        '''
+        Quantiles of the angular factor w in each cell of a log-spaced grid in detector-frame masses.
+        Returns the reference detector, the edges of the grid in log m, 
+        and an array of shape (nMassBins, nMassBins, nQuantiles). Only cells with m2z<=m1z are filled
+        '''
+        costheta = rng.uniform(-1, 1, nAngles)
+        phi = rng.uniform(0, 2*np.pi, nAngles)
+        cosiota = rng.uniform(-1, 1, nAngles)
+        t_det = rng.uniform(0, 1, nAngles)
+        
+        detectors = list(network.get_detectors().values())
+        refDet = detectors[0]
+        
+        # Angular factor of each detector, including the duty cycle
+        Q = []
+        for det in detectors:
+            costhetaD, phiD = det._equat2detector(costheta, phi, t_det)
+            keep = rng.uniform(0, 1, nAngles)<det.duty_cycle
+            Q.append( np.where(keep, det._Qsq(costhetaD, phiD, cosiota), 0.) )
+        Q = np.array(Q)
+        
+        logmBinEdges = np.linspace(np.log(refDet.mmin), np.log(refDet.mmax), nMassBins+1)
+        mCentres = np.exp((logmBinEdges[1:]+logmBinEdges[:-1])/2)
+        m1c, m2c = np.meshgrid(mCentres, mCentres, indexing='ij')
+        mask = m2c<=m1c
+        refSNR = refDet.interpolator.ev(m1c[mask], m2c[mask])*refDet.dL_pivot_Gpc
+        ratios = np.array([ (det.interpolator.ev(m1c[mask], m2c[mask])*det.dL_pivot_Gpc/refSNR)**2 for det in detectors ])
+        
+        idx = np.round(self.levels*(nAngles-1)).astype(int)
+        wQuantiles = np.full((nMassBins, nMassBins, len(self.levels)), np.nan)
+        wQuantiles[mask] = np.array([ np.sort(r @ Q)[idx] for r in ratios.T ])
+        
+        return refDet, logmBinEdges, wQuantiles
+    
+    
+    def _mass_bins(self, m1z, m2z, i):
+        '''
+        Indices of the mass cells of the points, and the points grouped by cell: 
+        returns the cells, the indices that sort the points by cell and the start of each group
+        '''
+        edges = self.logmBinEdges[i]
+        nBins = len(edges)-1
+        i1 = np.clip(np.searchsorted(edges, np.log(np.maximum(m1z, m2z)))-1, 0, nBins-1)
+        i2 = np.clip(np.searchsorted(edges, np.log(np.minimum(m1z, m2z)))-1, 0, nBins-1)
+        cells = i1*nBins+i2
+        order = np.argsort(cells, kind='stable')
+        uniqueCells, starts = np.unique(cells[order], return_index=True)
+        return uniqueCells, order, np.append(starts, len(cells))
+    
+    
+    def _oSNR_pivot(self, m1z, m2z, i):
+        '''
+        Optimal SNR of the reference detector of network i at 1 Gpc
+        '''
+        refDet = self.refDets[i]
+        return refDet.interpolator.ev(np.clip(m1z, refDet.mmin, refDet.mmax), np.clip(m2z, refDet.mmin, refDet.mmax))*refDet.dL_pivot_Gpc
+    
+    
+    def _logPdet(self, m1z, m2z, dL, i, bins=None, oSNR_pivot=None):
+        if oSNR_pivot is None:
+            oSNR_pivot = self._oSNR_pivot(m1z, m2z, i)
+        oSNR = oSNR_pivot/(dL*self.dL2Gpc)
+        wMin = (self.snr_th/np.maximum(oSNR, 1e-300))**2
+        
+        if bins is None:
+            bins = self._mass_bins(m1z, m2z, i)
+        uniqueCells, order, starts = bins
+        wQuantiles = self.wQuantiles[i].reshape(-1, len(self.levels))
+        pDet = np.empty(wMin.shape)
+        for k,cell in enumerate(uniqueCells):
+            idx = order[starts[k]:starts[k+1]]
+            pDet[idx] = 1-np.interp(wMin[idx], wQuantiles[cell], self.levels, left=0., right=1.)
+        with np.errstate(divide='ignore'):
+            return np.log(pDet)
+    
+    
+    @profiled
+    def _Ndet(self, Lambda_test, i):
+        
+        Lambda = self.population.get_Lambda(Lambda_test, self.params_inference )
+        LambdaCosmo, LambdaAllPop = self.population._split_params(Lambda)
+        H0, Om0, w0,  Xi0, n = self.population.cosmo._get_values(LambdaCosmo, ['H0', 'Om', 'w0','Xi0', 'n'])
+        
+        dL = self.population.cosmo.dLGW(self.zGrid, H0, Om0, w0, Xi0, n)[self.zIdx]
+        
+        logdN = self.population.log_dN_dm1dm2dz(self.m1, self.m2, self.z, [], self.Tobs[i], Lambda)+self.logWeights
+        logdN += self._logPdet(self.m1*(1+self.z), self.m2*(1+self.z), dL, i, bins=self.gridBins[i], oSNR_pivot=self.gridOSNR[i])
+        mu = np.exp(np.logaddexp.reduce(logdN))
+        
+        return mu, 0., np.inf
+    
+    
+    @profiled
+    def Ndet(self, Lambda_test, verbose=False, return_grad=False):
+        '''
+        Returns lists with mu, error (zero), Neff (inf) for each network 
+        '''
+        if return_grad:
+            raise NotImplementedError('Gradients are not available for the semi-analytic selection bias')
+        res = [self._Ndet(Lambda_test, i) for i in range(len(self.networks))]
+        return tuple(list(r) for r in zip(*res))
@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+#    Copyright (c) 2021 Michele Mancarella <michele.mancarella@unige.ch>
+#
+#    All rights reserved. Use of this source code is governed by a modified BSD
+#    license that can be found in the LICENSE file.
+
+import numpy as np
+from scipy.linalg import cho_factor, cho_solve, solve_triangular
+from scipy.optimize import minimize
+
+from .selectionBias import SelectionBias
+
+
+
+class GPEmulator(object):
+
+    '''
+    Gaussian process regression with squared exponential kernel
+    and one length scale per dimension, used to emulate log mu(Lambda).
+    Training points have individual noise variances (the MC variance of log mu).
+    A second target (log Neff) is predicted with the same kernel.
+
+    Points are added online. The Cholesky factor is recomputed every update_every
+    new points. The kernel hyperparameters are re-optimized each time the number of points doubles
+    and at least every refit_every new points, on at most max_opt_points training points.
+    The optimization starts both from the current hyperparameters and from the amplitude given by
+    the spread of the targets with unit length scales (inputs are standardized), and keeps the best.
+    '''
+
+    def __init__(self, update_every=10, refit_every=100, max_points=2000, max_opt_points=500, jitter=1e-08):
+
+        self.update_every=update_every
+        self.refit_every=refit_every
+        self.max_points=max_points
+        self.max_opt_points=max_opt_points
+        self.jitter=jitter
+
+        self.X = []
+        self.y = []
+        self.y2 = []
+        self.noise = []
+
+        self.nFit = 0
+        self.nOpt = 0
+        self.cho = None
+        self.logHyp = None
+
+
+    @property
+    def nPoints(self):
+        return len(self.y)
+
+
+    def add(self, x, y, y2, noise):
+        if self.nPoints>=self.max_points:
+            return
+        self.X.append(np.asarray(x, dtype=float))
+        self.y.append(y)
+        self.y2.append(y2)
+        self.noise.append(noise)
+        if self.logHyp is None or self.nPoints>=2*self.nOpt or self.nPoints-self.nOpt>=self.refit_every:
+            self.fit(optimize=True)
+        elif self.nPoints-self.nFit>=self.update_every:
+            self.fit(optimize=False)
+
+
+    def _kernel(self, X1, X2, logHyp):
+        amp, ls = np.exp(logHyp[0]), np.exp(logHyp[1:])
+        X1s, X2s = X1/ls, X2/ls
+        # Squared distances from dot products, without temporaries of shape (n1, n2, ndim)
+        d2 = (X1s**2).sum(axis=1)[:, np.newaxis]+(X2s**2).sum(axis=1)[np.newaxis, :]-2*X1s.dot(X2s.T)
+        return amp**2*np.exp(-0.5*np.maximum(d2, 0.))
+
+
+    def _neg_log_marg_lik(self, logHyp, X, y, noise):
+        '''
+        Negative log marginal likelihood and its gradient wrt logHyp
+        '''
+        Kf = self._kernel(X, X, logHyp)
+        K = Kf.copy()
+        K[np.diag_indices_from(K)] += noise+self.jitter
+        try:
+            L = np.linalg.cholesky(K)
+        except np.linalg.LinAlgError:
+            return np.inf, np.zeros(logHyp.shape)
+        alpha = cho_solve((L, True), y)
+        Kinv = cho_solve((L, True), np.eye(y.shape[0]))
+        # d NLML/d theta = -tr( (alpha alpha^T - K^-1) dK/dtheta )/2, with dK/dlog(amp) = 2 Kf and
+        # dK_ik/dlog(ls_j) = Kf_ik (x_ij-x_kj)^2/ls_j^2
+        W = (np.outer(alpha, alpha)-Kinv)*Kf
+        Xs = X/np.exp(logHyp[1:])
+        dls = (Xs**2*W.sum(axis=1)[:, np.newaxis]).sum(axis=0)-(Xs*W.dot(Xs)).sum(axis=0)
+        grad = -np.concatenate([[W.sum()], dls])
+        return 0.5*y.dot(alpha)+np.log(np.diag(L)).sum(), grad
+
+
+    def _optimize(self, Xn, y, noise):
+        if Xn.shape[0]>self.max_opt_points:
+            idx = np.linspace(0, Xn.shape[0]-1, self.max_opt_points).astype(int)
+            Xn, y, noise = Xn[idx], y[idx], noise[idx]
+        bounds = [(-10, 5)]+[(-5, 5)]*Xn.shape[1]
+        starts = [self.logHyp, np.concatenate([[np.log(max(y.std(), 1e-03))], np.zeros(Xn.shape[1])])]
+        best = None
+        for x0 in starts:
+            res = minimize(self._neg_log_marg_lik, np.clip(x0, *np.array(bounds).T), args=(Xn, y, noise), jac=True,
+                           method='L-BFGS-B', bounds=bounds)
+            if np.isfinite(res.fun) and (best is None or res.fun<best.fun):
+                best = res
+        if best is not None:
+            self.logHyp = best.x
+
+
+    def fit(self, optimize=True):
+
+        X = np.array(self.X)
+        self.xMean, self.xStd = X.mean(axis=0), X.std(axis=0)
+        self.xStd[self.xStd==0] = 1.
+        Xn = (X-self.xMean)/self.xStd
+        y, y2, noise = np.array(self.y), np.array(self.y2), np.array(self.noise)
+        self.yMean, self.y2Mean = y.mean(), y2.mean()
+
+        if self.logHyp is None or self.logHyp.shape[0]!=X.shape[1]+1:
+            self.logHyp = np.concatenate([[np.log(max(y.std(), 1e-03))], np.zeros(X.shape[1])])
+        if optimize and self.nPoints>1:
+            self._optimize(Xn, y-self.yMean, noise)
+            self.nOpt = self.nPoints
+
+        K = self._kernel(Xn, Xn, self.logHyp)
+        K[np.diag_indices_from(K)] += noise+self.jitter
+        self.cho = cho_factor(K, lower=True)
+        self.alpha = cho_solve(self.cho, y-self.yMean)
+        self.alpha2 = cho_solve(self.cho, y2-self.y2Mean)
+        self.Xn = Xn
+        self.nFit = self.nPoints
+
+
+    def predict(self, x):
+        '''
+        Returns mean and std of the first target, and mean of the second target at x
+        '''
+        xn = ((np.asarray(x, dtype=float)-self.xMean)/self.xStd)[np.newaxis, :]
+        kStar = self._kernel(self.Xn, xn, self.logHyp)[:, 0]
+        mean = self.yMean+kStar.dot(self.alpha)
+        mean2 = self.y2Mean+kStar.dot(self.alpha2)
+        v = solve_triangular(self.cho[0], kStar, lower=True)
+        var = np.exp(2*self.logHyp[0])-v.dot(v)
+        return mean, np.sqrt(max(var, 0.)), mean2
+
+
+
+
+class EmulatedSelectionBias(SelectionBias):
+
+    '''
+    Wraps a SelectionBiasInjections object with an emulator for log mu(Lambda) and log Neff(Lambda),
+    one for each injection set, trained online on the points where the MC sum is computed.
+    A new Lambda is answered by the emulator if the predictive std of log mu is below max_std,
+    otherwise the MC sum over injections is computed and added to the training set.
+
+    Usage:
+
+    selBias = SelectionBiasInjections(allPops, injData, params_inference)
+    emuBias = EmulatedSelectionBias(selBias, max_std=0.01)
+    myPost = Posterior(myLik, myPrior, emuBias)
+    ...
+    emuBias.print_usage()
+
+    '''
+
+    def __init__(self, selectionBias, max_std=0.01, min_points=50, **kwargs):
+        '''
+
+        Parameters
+        ----------
+        selectionBias : SelectionBiasInjections
+            object used for the MC evaluation
+        max_std : float
+            maximum predictive std of log mu for using the emulator.
+            Should be small compared to the MC error 1/sqrt(Neff)
+        min_points : int
+            number of MC evaluations before the emulator is used
+        kwargs : passed to GPEmulator (update_every, refit_every, max_points, max_opt_points)
+
+        '''
+        SelectionBias.__init__(self, selectionBias.population, selectionBias.injData, selectionBias.params_inference)
+        self.selectionBias = selectionBias
+        self.max_std = max_std
+        self.min_points = min_points
+        self.emulators = [GPEmulator(**kwargs) for _ in self.injData]
+        self.reset_usage()
+
+
+    def reset_usage(self):
+        self.nEmulated = np.zeros(len(self.injData), dtype=int)
+        self.nMC = np.zeros(len(self.injData), dtype=int)
+
+
+    def usage_summary(self):
+        return {'nEmulated': self.nEmulated,
+                'nMC': self.nMC,
+                'fracEmulated': self.nEmulated/np.maximum(self.nEmulated+self.nMC, 1),
+                'nTrainingPoints': np.array([e.nPoints for e in self.emulators]) }
+
+
+    def print_usage(self):
+        res = self.usage_summary()
+        for i in range(len(self.injData)):
+            print('Injection set %s: %s emulated, %s MC (fraction emulated: %s), %s training points' %(i, res['nEmulated'][i], res['nMC'][i], res['fracEmulated'][i], res['nTrainingPoints'][i]))
+
+
+    def _Ndet(self, Lambda_test, i, verbose=False, return_grad=False):
+
+        injData = self.injData[i]
+        emulator = self.emulators[i]
+
+        if not return_grad and emulator.nPoints>=self.min_points:
+            logMu, std, logNeff = emulator.predict(Lambda_test)
+            if std<=self.max_std:
+                self.nEmulated[i] += 1
+                # Back to the log sums over injections, to get the error as in the MC case
+                logS1 = logMu+injData.logN_gen
+                logS2 = np.logaddexp(2*logMu-logNeff, 2*logMu-injData.logN_gen)+2*injData.logN_gen
+                return self.selectionBias._get_mu_error_Neff(logS1, logS2, injData.logN_gen)
+
+        self.nMC[i] += 1
+        res = self.selectionBias._Ndet(Lambda_test, injData, verbose=verbose, return_grad=return_grad)
+        mu, Neff = res[0], res[2]
+        if mu>0 and np.isfinite(Neff) and Neff>0:
+            # Variance of log mu from MC is 1/Neff
+            emulator.add(Lambda_test, np.log(mu), np.log(Neff), 1/Neff)
+            if emulator.nPoints==self.min_points and emulator.nOpt<self.min_points:
+                # Hyperparameters from all the points before the emulator is first used
+                emulator.fit(optimize=True)
+        return res
+
+
+    def Ndet(self, Lambda_test, verbose=False, return_grad=False):
+        '''
+        Same output as SelectionBiasInjections.Ndet. Gradients are always computed by MC
+        '''
+        res = [self._Ndet(Lambda_test, i, verbose=verbose, return_grad=return_grad) for i in range(len(self.injData))]
+        return tuple(list(r) for r in zip(*res))
@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+#    Copyright (c) 2021 Michele Mancarella <michele.mancarella@unige.ch>
+#
+#    All rights reserved. Use of this source code is governed by a modified BSD
+#    license that can be found in the LICENSE file.
+
+import numpy as np
+import h5py
+
+
+
+class RunningNeffStats(object):
+
+    '''
+    Running statistics of the effective number of samples for a group of
+    quantities (e.g. all events in a dataset, or a single injection set).
+    Quantiles are estimated from a histogram with log-spaced bins, so that
+    memory is fixed and each update is a single pass over the new values.
+
+    '''
+
+    def __init__(self, n, logNeffMin=-2., logNeffMax=8., nBins=1000):
+        '''
+
+        Parameters
+        ----------
+        n : int
+            number of quantities tracked (e.g. number of events).
+        logNeffMin, logNeffMax : float
+            log10 of the range of the histogram used for quantiles.
+            Values outside the range are put in the first/last bin.
+        nBins : int
+            number of bins of the histogram.
+
+        '''
+        self.n = n
+        self.edges = np.linspace(logNeffMin, logNeffMax, nBins+1)
+        self.reset()
+
+
+    def reset(self):
+        self.nCalls = 0
+        self.nRejected = np.zeros(self.n, dtype=int)
+        self.minNeff = np.full(self.n, np.inf)
+        self.maxNeff = np.full(self.n, -np.inf)
+        self.sumNeff = np.zeros(self.n)
+        self.counts = np.zeros((self.n, len(self.edges)-1), dtype=int)
+
+
+    def update(self, Neff, threshold):
+        '''
+        Adds the values Neff (array of length n) from one evaluation.
+        Entries with Neff<threshold are counted as rejected.
+        '''
+        Neff = np.atleast_1d(Neff)
+        finite = np.isfinite(Neff)
+        self.nCalls += 1
+        self.nRejected += (Neff<threshold)
+        self.minNeff = np.where(finite, np.minimum(self.minNeff, Neff), self.minNeff)
+        self.maxNeff = np.where(finite, np.maximum(self.maxNeff, Neff), self.maxNeff)
+        self.sumNeff += np.where(finite, Neff, 0.)
+
+        idxs = np.clip(np.searchsorted(self.edges, np.log10(np.where(finite & (Neff>0), Neff, 10**self.edges[0])))-1, 0, len(self.edges)-2)
+        self.counts[np.arange(self.n)[finite], idxs[finite]] += 1
+
+
+    def meanNeff(self):
+        return self.sumNeff/np.maximum(self.counts.sum(axis=-1), 1)
+
+
+    def quantiles(self, qs=(0.05, 0.5, 0.95)):
+        '''
+        Returns array of shape (len(qs), n) with the estimated quantiles of Neff.
+        The resolution is given by the bin width; results are clipped to the observed range
+        '''
+        cdf = np.cumsum(self.counts, axis=-1)/np.maximum(self.counts.sum(axis=-1), 1)[:, np.newaxis]
+        res = np.empty((len(qs), self.n))
+        for i in range(self.n):
+            res[:, i] = 10**np.interp(qs, np.concatenate([[0], cdf[i]]), self.edges)
+        return np.clip(res, self.minNeff, self.maxNeff)
+
+
+    def summary(self, qs=(0.05, 0.5, 0.95)):
+        return { 'nCalls': self.nCalls,
+                 'nRejected': self.nRejected,
+                 'minNeff': self.minNeff,
+                 'maxNeff': self.maxNeff,
+                 'meanNeff': self.meanNeff(),
+                 'quantiles': self.quantiles(qs),
+                 'qs':np.array(qs)}
+
+
+
+class NeffTelemetry(object):
+
+    '''
+    Collects running statistics of Neff for the events of each dataset
+    (recorded by HyperLikelihood) and for each injection set (recorded by Posterior),
+    together with the number of rejections.
+
+    Usage:
+
+    myTelemetry = NeffTelemetry()
+    myLik = HyperLikelihood(allPops, allData, params_inference, telemetry=myTelemetry)
+    myPost = Posterior(myLik, myPrior, selBias, telemetry=myTelemetry)
+    ...
+    myTelemetry.print_summary()
+    myTelemetry.save('telemetry.h5')
+
+    '''
+
+    def __init__(self, **kwargs):
+        '''
+        kwargs are passed to each RunningNeffStats object (histogram range and bins)
+        '''
+        self.stats = {}
+        self.kwargs = kwargs
+
+
+    def update(self, key, Neff, threshold):
+        '''
+        Record values of Neff for the group key (e.g. 'events_0', 'injections_1').
+        '''
+        if key not in self.stats:
+            self.stats[key] = RunningNeffStats(np.atleast_1d(Neff).shape[0], **self.kwargs)
+        self.stats[key].update(Neff, threshold)
+
+
+    def reset(self):
+        for key in self.stats.keys():
+            self.stats[key].reset()
+
+
+    def summary(self, qs=(0.05, 0.5, 0.95)):
+        return {key: self.stats[key].summary(qs=qs) for key in self.stats.keys()}
+
+
+    def print_summary(self, qs=(0.05, 0.5, 0.95)):
+        for key, res in self.summary(qs=qs).items():
+            print('--- %s: %s calls' %(key, res['nCalls']))
+            print('Rejected: %s' %str(res['nRejected']))
+            print('Min Neff: %s' %str(res['minNeff']))
+            print('Mean Neff: %s' %str(res['meanNeff']))
+            for q, vals in zip(qs, res['quantiles']):
+                print('Neff %s quantile: %s' %(q, str(vals)))
+
+
+    def save(self, fname, qs=(0.05, 0.5, 0.95)):
+        '''
+        Dump summary and histograms to HDF5. Overwrites the file, so it can be called at every checkpoint
+        '''
+        with h5py.File(fname, 'w') as f:
+            for key, res in self.summary(qs=qs).items():
+                g = f.create_group(key)
+                g.attrs['nCalls'] = res['nCalls']
+                for name in ('nRejected', 'minNeff', 'maxNeff', 'meanNeff', 'quantiles', 'qs'):
+                    g.create_dataset(name, data=res[name])
+                g.create_dataset('counts', data=self.stats[key].counts)
+                g.create_dataset('edges', data=self.stats[key].edges)
@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+#    Copyright (c) 2021 Michele Mancarella <michele.mancarella@unige.ch>
+#
+#    All rights reserved. Use of this source code is governed by a modified BSD
+#    license that can be found in the LICENSE file.
+
+import os
+import numpy as np
+import h5py
+from emcee.backends import Backend
+
+
+
+class StreamingHDFBackend(Backend):
+
+    '''
+    emcee backend that streams the chain, log posterior and blobs to HDF5.
+    At most flush_every steps are kept in memory; they are appended to the file at each flush,
+    together with the acceptance counts and the random state of the sampler.
+    An interrupted run is resumed exactly from the last flush by creating a sampler with the same backend
+    (see EnsembleDriver.run).
+
+    The file is opened only during flushes, so the partial chain can be read while the run is live,
+    e.g. with StreamingHDFBackend(fname, read_only=True).get_chain()
+
+    Layout of the file (group name):
+        chain (nSteps, nwalkers, ndim), log_prob (nSteps, nwalkers), blobs (nSteps, nwalkers), accepted (nwalkers),
+        random_state_keys, and attributes nwalkers, ndim, iteration, has_blobs, random_state_*
+    '''
+
+    def __init__(self, fname, name='mcmc', flush_every=100, read_only=False, dtype=None):
+        '''
+
+        Parameters
+        ----------
+        fname : str
+            HDF5 file. If it exists and contains the group name, the run is resumed from it
+        name : str
+            name of the group in the file
+        flush_every : int
+            number of steps kept in memory between writes
+        read_only : bool
+            if True, the backend can only be used to read the chain
+
+        '''
+        if dtype is None:
+            dtype = np.float64
+        self.dtype = dtype
+        self.fname = fname
+        self.name = name
+        self.flush_every = flush_every
+        self.read_only = read_only
+        self._buffers = None
+        self._nBuf = 0
+        self._blobs_dtype = None
+
+        self.initialized = False
+        if os.path.exists(fname):
+            with h5py.File(fname, 'r') as f:
+                if name in f:
+                    self._load(f[name])
+
+
+    def _load(self, g):
+        self.nwalkers = int(g.attrs['nwalkers'])
+        self.ndim = int(g.attrs['ndim'])
+        self._nFile = int(g.attrs['iteration'])
+        self._has_blobs = bool(g.attrs['has_blobs'])
+        if self._has_blobs:
+            self._blobs_dtype = g['blobs'].dtype
+        self.accepted = np.array(g['accepted'])
+        if 'random_state_keys' in g:
+            self.random_state = (g.attrs['random_state_name'], np.array(g['random_state_keys']), int(g.attrs['random_state_pos']),
+                                 int(g.attrs['random_state_has_gauss']), float(g.attrs['random_state_cached_gaussian']))
+        else:
+            self.random_state = None
+        self.initialized = True
+
+
+    def _open(self, mode='r'):
+        if self.read_only and mode!='r':
+            raise RuntimeError('The backend was opened in read-only mode')
+        return h5py.File(self.fname, mode)
+
+
+    @property
+    def iteration(self):
+        return self._nFile+self._nBuf
+
+
+    def reset(self, nwalkers, ndim):
+        '''
+        Clears the chain in the file and in memory
+        '''
+        self.nwalkers = int(nwalkers)
+        self.ndim = int(ndim)
+        self._nFile = 0
+        self._nBuf = 0
+        self._buffers = None
+        self._has_blobs = False
+        self._blobs_dtype = None
+        self.accepted = np.zeros(self.nwalkers, dtype=self.dtype)
+        self.random_state = None
+        with self._open('a') as f:
+            if self.name in f:
+                del f[self.name]
+            g = f.create_group(self.name)
+            g.attrs['nwalkers'] = self.nwalkers
+            g.attrs['ndim'] = self.ndim
+            g.attrs['iteration'] = 0
+            g.attrs['has_blobs'] = False
+            g.create_dataset('chain', (0, self.nwalkers, self.ndim), maxshape=(None, self.nwalkers, self.ndim),
+                             chunks=(self.flush_every, self.nwalkers, self.ndim), dtype=self.dtype)
+            g.create_dataset('log_prob', (0, self.nwalkers), maxshape=(None, self.nwalkers),
+                             chunks=(self.flush_every, self.nwalkers), dtype=self.dtype)
+            g.create_dataset('accepted', data=self.accepted)
+        self.initialized = True
+
+
+    def has_blobs(self):
+        return self._has_blobs
+
+
+    def grow(self, ngrow, blobs):
+        '''
+        Allocates the buffers. The file grows at each flush
+        '''
+        self._check_blobs(blobs)
+        if blobs is not None and not self._has_blobs:
+            self._has_blobs = True
+            self._blobs_dtype = np.asarray(blobs).dtype
+            with self._open('a') as f:
+                g = f[self.name]
+                g.attrs['has_blobs'] = True
+                g.create_dataset('blobs', (0, self.nwalkers), maxshape=(None, self.nwalkers),
+                                 chunks=(self.flush_every, self.nwalkers), dtype=self._blobs_dtype)
+        if self._buffers is None:
+            self._buffers = {'chain': np.empty((self.flush_every, self.nwalkers, self.ndim), dtype=self.dtype),
+                             'log_prob': np.empty((self.flush_every, self.nwalkers), dtype=self.dtype)}
+            if self._has_blobs:
+                self._buffers['blobs'] = np.empty((self.flush_every, self.nwalkers), dtype=self._blobs_dtype)
+
+
+    def save_step(self, state, accepted):
+        self._check(state, accepted)
+        self._buffers['chain'][self._nBuf] = state.coords
+        self._buffers['log_prob'][self._nBuf] = state.log_prob
+        if self._has_blobs:
+            self._buffers['blobs'][self._nBuf] = state.blobs
+        self._nBuf += 1
+        self.accepted += accepted
+        self.random_state = state.random_state
+        if self._nBuf==self.flush_every:
+            self.flush()
+
+
+    def flush(self):
+        '''
+        Appends the steps in memory to the file, and stores acceptance counts and random state
+        '''
+        if self._nBuf==0:
+            return
+        n0, n1 = self._nFile, self._nFile+self._nBuf
+        with self._open('a') as f:
+            g = f[self.name]
+            for key, buf in self._buffers.items():
+                g[key].resize(n1, axis=0)
+                g[key][n0:n1] = buf[:self._nBuf]
+            g['accepted'][...] = self.accepted
+            if self.random_state is not None:
+                name, keys, pos, has_gauss, cached = self.random_state
+                if 'random_state_keys' in g:
+                    g['random_state_keys'][...] = keys
+                else:
+                    g.create_dataset('random_state_keys', data=keys)
+                g.attrs['random_state_name'] = name
+                g.attrs['random_state_pos'] = pos
+                g.attrs['random_state_has_gauss'] = has_gauss
+                g.attrs['random_state_cached_gaussian'] = cached
+            g.attrs['iteration'] = n1
+        self._nFile = n1
+        self._nBuf = 0
+
+
+    def get_value(self, name, flat=False, thin=1, discard=0):
+        if self.iteration<=0:
+            raise AttributeError('you must run the sampler before accessing the results')
+        if name=='blobs' and not self._has_blobs:
+            return None
+
+        start = discard+thin-1
+        parts = []
+        if start<self._nFile:
+            with h5py.File(self.fname, 'r') as f:
+                parts.append(f[self.name][name][start:self._nFile:thin])
+        if self._nBuf>0:
+            # first step in the buffer with the same stride
+            bufStart = start-self._nFile if start>=self._nFile else (thin-(self._nFile-start)%thin)%thin
+            parts.append(self._buffers[name][bufStart:self._nBuf:thin])
+        if len(parts)==0:
+            # discard covers all the steps
+            if name=='chain':
+                v = np.empty((0, self.nwalkers, self.ndim), dtype=self.dtype)
+            else:
+                v = np.empty((0, self.nwalkers), dtype=self._blobs_dtype if name=='blobs' else self.dtype)
+        else:
+            v = np.concatenate(parts) if len(parts)>1 else parts[0]
+        if flat:
+            s = list(v.shape[1:])
+            s[0] = np.prod(v.shape[:2])
+            return v.reshape(s)
+        return v
+
+
+    def iter_chain(self, block=1000):
+        '''
+        Yields the chain in blocks of at most block steps, reading the file one block at a time
+        '''
+        for n0 in range(0, self._nFile, block):
+            with h5py.File(self.fname, 'r') as f:
+                yield f[self.name]['chain'][n0:min(n0+block, self._nFile)]
+        if self._nBuf>0:
+            yield self._buffers['chain'][:self._nBuf]
+
+
+    def write_attrs(self, attrs):
+        '''
+        Stores extra information (e.g. throughput) as attributes of the group
+        '''
+        with self._open('a') as f:
+            for key, val in attrs.items():
+                f[self.name].attrs[key] = val
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+#    Copyright (c) 2021 Michele Mancarella <michele.mancarella@unige.ch>
+#
+#    All rights reserved. Use of this source code is governed by a modified BSD
+#    license that can be found in the LICENSE file.
+
+# Example configuration for runMCMC.py
+
+
+###############################################################################
+# CONFIGURE THE POPULATIONS
+###############################################################################
+
+populations = { 'astro' : { 'mass_function': 'trunc_pow_law' , #'smooth_pow_law', 'broken_pow_law'
+                           'spin_distribution': 'skip',
+                           'rate': 'simple_pow_law' #'astro-ph'
+                            }
+    }
+
+# Any extra argument to the mass, spin distributions and rate evolution
+# The units for the rate will be passed automatically. No need to put them here
+mass_args={}
+spin_args={}
+rate_args={}
+
+# Values of the parameters that are not inferred
+lambdaBase = {'R0': 20. ,
+              'lambdaRedshift':4.,
+              'mh': 500., 'ml':2.,
+              'alpha': 1.1 , 'beta': 0.75 }
+
+
+###############################################################################
+# DATA AND INJECTIONS
+###############################################################################
+
+# Paths are relative to the data folder. The type of data is the part of the name before the first underscore.
+# There should be one injection set for each dataset, with the same name
+data = { 'mock': {'fname': 'mock/data', 'args': {'Tobs': 2.5} },
+        }
+
+injections = { 'mock': {'fname': 'mock/injections', 'args': {'Tobs': 2.5, 'snr_th': 8.} },
+              }
+
+
+###############################################################################
+# INFERENCE
+###############################################################################
+
+params_inference = ['H0', 'Xi0', 'R0', 'lambdaRedshift', 'alpha', 'beta', 'ml', 'mh']
+
+priorLimits = { 'H0': (20, 140), 'Xi0': (0.1, 10), 'R0': (1e-03, 1e03), 'lambdaRedshift': (-15, 15),
+                'alpha': (-5, 10), 'beta': (-5, 10), 'ml': (2, 10), 'mh': (30, 150) }
+
+priorNames = { 'H0': 'flat', 'Xi0': 'flatLog', 'R0': 'flatLog', 'lambdaRedshift': 'flat',
+               'alpha': 'flat', 'beta': 'flat', 'ml': 'flat', 'mh': 'flat' }
+
+priorParams = { }
+
+# Minimum effective number of samples for each event and, in units of the number of events, for the injections
+safety_factor = 10
+bias_safety_factor = 4.
+get_uncertainty = True
+mem_budget_MB = 64
+
+# Analytic marginalization over R0 (R0 should then be removed from params_inference)
+marginalize_R0 = False
+R0_prior = 'flatLog'
+R0_limits = (1e-03, 1e03)
+
+
+###############################################################################
+# SAMPLER
+###############################################################################
+
+# 'emcee' (stretch move, see EnsembleDriver) or 'slice' (ensemble slice sampling, see EnsembleSliceSampler)
+sampler = 'emcee'
+nwalkers = 32
+nsteps = 10000
+# 'vectorize', 'pool', 'mpi' or 'serial'. The slice sampler always uses batched calls to the posterior
+mode = 'vectorize'
+nCores = 4
+# Maximum number of walkers per call to the batched posterior in vectorize mode
+block_size = None
+# Starting point of the walkers: fiducial values, and relative scatter
+eps = 1e-02
+seed = 1312
+print_every = 100
+# Slice sampler: initial scale of the directions, and number of steps during which it is tuned
+slice_mu = 1.
+slice_tune_steps = 200
+# Delayed acceptance for the emcee sampler: proposals are screened with a cheap surrogate of the posterior
+# (not available with sampler = 'slice').
+# None, 'quadratic' (gaussian approximation around the MAP, with covariance multiplied by da_inflate)
+# or 'subset' (posterior with the extra arguments below for data and injections)
+delayed_acceptance = None
+da_inflate = 2.
+surrogate_data_args = {'nSamplesUse': 200}
+surrogate_injections_args = {'nInjUse': 100000}
+# Number of steps kept in memory between writes of the chain to file
+flush_every = 100
+# Stop when converged: at least min_steps steps, chain after burn-in longer than ntau autocorrelation times,
+# autocorrelation times stable to tau_rtol and split R-hat below rhat_th, checked every check_every steps
+monitor = True
+monitor_args = {'check_every': 100, 'min_steps': 1000, 'ntau': 50, 'tau_rtol': 0.01, 'rhat_th': 1.01}
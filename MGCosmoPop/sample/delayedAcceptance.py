@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+#    Copyright (c) 2021 Michele Mancarella <michele.mancarella@unige.ch>
+#
+#    All rights reserved. Use of this source code is governed by a modified BSD
+#    license that can be found in the LICENSE file.
+
+import numpy as np
+from emcee import State
+from emcee.moves import StretchMove
+
+
+
+class QuadraticSurrogate(object):
+
+    '''
+    Quadratic model of the log posterior, log p(Lambda) = -(Lambda-mean)^T cov^-1 (Lambda-mean)/2,
+    e.g. from the Laplace approximation around the MAP (see QuadraticSurrogate.from_forecast).
+    The covariance is multiplied by inflate, so that the surrogate has wider tails than the posterior.
+    Outside the prior range the log posterior is -inf.
+    '''
+
+    def __init__(self, mean, cov, prior=None, inflate=1.):
+        self.mean = np.asarray(mean, dtype=float)
+        self.cov = np.atleast_2d(cov)*inflate
+        self.icov = np.linalg.inv(self.cov)
+        self.prior = prior
+
+
+    @classmethod
+    def from_forecast(cls, forecast, inflate=1.):
+        '''
+        forecast : obj of type LaplaceForecast, with covariance already computed
+        '''
+        if forecast.covariance is None:
+            raise ValueError('Compute the covariance of the forecast before building the surrogate')
+        return cls(forecast.xMAP, forecast.covariance, prior=forecast.posterior.prior, inflate=inflate)
+
+
+    def logPosterior_batch(self, Lambdas, return_blob=False):
+        Lambdas = np.atleast_2d(Lambdas)
+        dx = Lambdas-self.mean
+        logPost = -0.5*np.einsum('ij,jk,ik->i', dx, self.icov, dx)
+        if self.prior is not None:
+            inside = np.all((Lambdas>=self.prior._limInf) & (Lambdas<=self.prior._limSup), axis=1)
+            logPost = np.where(inside, logPost, -np.inf)
+        return logPost
+
+
+
+class DelayedAcceptanceMove(StretchMove):
+
+    '''
+    Stretch move with delayed acceptance (Christen & Fox 2005).
+    The proposals of each half of the ensemble are first screened with a cheap surrogate of the posterior,
+    accepting with probability
+        a1 = min(1, z^(d-1) p_s(y)/p_s(x)) .
+    Only the proposals that pass are evaluated with the full posterior (in one batched call),
+    and are accepted with probability
+        a2 = min(1, p(y) p_s(x) / (p(x) p_s(y)) ) ,
+    so that the chain has exactly the full posterior as stationary distribution.
+    The surrogate must be finite wherever the posterior is finite: walkers cannot leave points where it is not.
+
+    The surrogate is any object with a method logPosterior_batch(Lambdas) returning the log posterior
+    for an array of points, e.g. a QuadraticSurrogate, or a Posterior built with a subset of the samples
+    of each event and of the injections (see setupRun.build_surrogate_posterior).
+
+    The fraction of full evaluations saved is returned by stats().
+
+    Usage:
+
+    myMove = DelayedAcceptanceMove(QuadraticSurrogate.from_forecast(myForecast, inflate=2.))
+    myDriver = EnsembleDriver(myPost, nwalkers=32, moves=myMove)
+    myDriver.run(p0, nsteps=5000)
+    print(myMove.stats())
+
+    '''
+
+    def __init__(self, surrogate, a=2., **kwargs):
+        self.surrogate = surrogate
+        self._coords = None
+        self._logSurr = None
+        self.nProposals = 0
+        self.nFull = 0
+        self.nAccepted = 0
+        self._warned = False
+        super(DelayedAcceptanceMove, self).__init__(a=a, **kwargs)
+
+
+    def _surrogate_at(self, coords):
+        '''
+        Surrogate at the current positions. Values are kept between steps and recomputed only for walkers
+        that were moved by something else (e.g. when resuming)
+        '''
+        if self._coords is None or self._coords.shape!=coords.shape:
+            self._coords = np.array(coords)
+            self._logSurr = self.surrogate.logPosterior_batch(coords)
+        else:
+            changed = np.any(self._coords!=coords, axis=1)
+            if changed.any():
+                self._coords[changed] = coords[changed]
+                self._logSurr[changed] = self.surrogate.logPosterior_batch(coords[changed])
+        if not self._warned and not np.all(np.isfinite(self._logSurr)):
+            # Printed once: the same walkers would be reported at every step
+            print('Warning: the surrogate is not finite for %s walkers. They will not move' %np.sum(~np.isfinite(self._logSurr)))
+            self._warned = True
+        return self._logSurr
+
+
+    def propose(self, model, state):
+        nwalkers, ndim = state.coords.shape
+        if nwalkers<2*ndim and not self.live_dangerously:
+            raise RuntimeError('It is unadvisable to use a red-blue move with fewer walkers than twice the number of dimensions.')
+        logSurr = self._surrogate_at(state.coords)
+
+        accepted = np.zeros(nwalkers, dtype=bool)
+        all_inds = np.arange(nwalkers)
+        inds = all_inds%self.nsplits
+        if self.randomize_split:
+            model.random.shuffle(inds)
+        for split in range(self.nsplits):
+            S1 = inds==split
+            idx = all_inds[S1]
+            sets = [state.coords[inds==j] for j in range(self.nsplits)]
+            q, factors = self.get_proposal(sets[split], sets[:split]+sets[split+1:], model.random)
+            self.nProposals += q.shape[0]
+
+            # First stage: surrogate
+            logSurrQ = self.surrogate.logPosterior_batch(q)
+            with np.errstate(invalid='ignore'):
+                pass1 = factors+logSurrQ-logSurr[idx]>np.log(model.random.rand(q.shape[0]))
+            pass1 &= np.isfinite(logSurrQ)
+
+            # Second stage: full posterior, only for the proposals that passed the first stage
+            new_log_probs = np.full(q.shape[0], -np.inf)
+            new_blobs = None
+            if pass1.any():
+                log_probs, blobs = model.compute_log_prob_fn(q[pass1])
+                new_log_probs[pass1] = log_probs
+                if blobs is not None:
+                    new_blobs = np.empty((q.shape[0],)+blobs.shape[1:], dtype=blobs.dtype)
+                    new_blobs[pass1] = blobs
+                self.nFull += pass1.sum()
+                with np.errstate(invalid='ignore'):
+                    lnpdiff = new_log_probs[pass1]-state.log_prob[idx[pass1]]+logSurr[idx[pass1]]-logSurrQ[pass1]
+                acc = np.zeros(q.shape[0], dtype=bool)
+                acc[pass1] = lnpdiff>np.log(model.random.rand(pass1.sum()))
+                accepted[idx[acc]] = True
+                logSurr[idx[acc]] = logSurrQ[acc]
+                self._coords[idx[acc]] = q[acc]
+                self.nAccepted += acc.sum()
+
+            new_state = State(q, log_prob=new_log_probs, blobs=new_blobs)
+            state = self.update(state, new_state, accepted, S1)
+
+        return state, accepted
+
+
+    def stats(self):
+        return {'nProposals': int(self.nProposals), 'nFullEvals': int(self.nFull),
+                'savedFraction': 1.-self.nFull/max(self.nProposals, 1),
+                'firstStageAcceptance': self.nFull/max(self.nProposals, 1),
+                'secondStageAcceptance': self.nAccepted/max(self.nFull, 1),
+                'acceptance': self.nAccepted/max(self.nProposals, 1)}
+
+
+    def print_stats(self):
+        st = self.stats()
+        print('Delayed acceptance: %s proposals, %s full evaluations of the posterior (%.1f%% saved). Acceptance: first stage %.3f, second stage %.3f, total %.3f'
+              %(st['nProposals'], st['nFullEvals'], 100*st['savedFraction'], st['firstStageAcceptance'], st['secondStageAcceptance'], st['acceptance']))
@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+#    Copyright (c) 2021 Michele Mancarella <michele.mancarella@unige.ch>
+#
+#    All rights reserved. Use of this source code is governed by a modified BSD
+#    license that can be found in the LICENSE file.
+
+import numpy as np
+
+
+
+class OnlineConvergence(object):
+
+    '''
+    Convergence diagnostics updated at every step of an ensemble sampler, with memory independent of the chain length.
+
+    For each walker and parameter, the chain is summarized by at most nBatches consecutive batches of equal size,
+    storing the sum and the sum of squares of each batch. When all the batches are full,
+    adjacent batches are merged and the batch size is doubled.
+
+    Diagnostics are computed on the batches after discarding the fraction discard of the chain (burn-in):
+        - integrated autocorrelation time with batch means, tau_b = b Var(batch means)/Var(samples),
+          averaged over walkers. tau_b is biased low by ~tau^2/(2b), so it is extrapolated to infinite batch size
+          from the batch sizes b and 2b (merging adjacent batches): tau = 2 tau_2b - tau_b, 
+          and never smaller than tau_b. It is reliable when the batch size b is larger than tau
+        - split R-hat, treating the two halves of the chain of each walker as separate chains
+
+    Stopping rule (checked every check_every steps): the chain has at least min_steps steps,
+    the retained part is longer than ntau times the largest autocorrelation time,
+    the autocorrelation times changed by less than tau_rtol with respect to a reference estimate,
+    and R-hat is below rhat_th for all parameters.
+    The reference is the estimate of the latest check that is at least one (largest) autocorrelation time 
+    older and that was computed on a different set of batches. Between two checks no batch may complete
+    when the batch size is larger than check_every, and comparing identical estimates would pass trivially.
+    
+    The extrapolation increases the variance of tau, which is controlled by the number of batches: 
+    with the default nBatches, the retained chain has between 64 and 128 batches
+
+    Usage:
+
+    myDiagnostics = OnlineConvergence(nwalkers, ndim)
+    for state in sampler.sample(p0, iterations=nsteps):
+        myDiagnostics.update(state.coords)
+        if myDiagnostics.n%myDiagnostics.check_every==0 and myDiagnostics.check():
+            break
+
+    '''
+
+    def __init__(self, nwalkers, ndim, nBatches=256, discard=0.5, ntau=50, tau_rtol=0.01, rhat_th=1.01,
+                 min_steps=1000, check_every=100, params=None):
+        '''
+
+        Parameters
+        ----------
+        nwalkers, ndim : int
+        nBatches : int
+            maximum number of batches stored. Rounded to an even number
+        discard : float
+            fraction of the chain discarded as burn-in for the diagnostics
+        ntau : float
+            minimum length of the retained chain in units of the autocorrelation time
+        tau_rtol : float
+            maximum relative change of the autocorrelation times with respect to the reference estimate
+        rhat_th : float
+            maximum split R-hat
+        min_steps : int
+            minimum number of steps
+        check_every : int
+            number of steps between checks of the stopping rule
+        params : list, optional
+            names of the parameters, used for printing
+
+        '''
+        self.nwalkers = nwalkers
+        self.ndim = ndim
+        self.nBatches = 2*(nBatches//2)
+        self.discard = discard
+        self.ntau = ntau
+        self.tau_rtol = tau_rtol
+        self.rhat_th = rhat_th
+        self.min_steps = min_steps
+        self.check_every = check_every
+        self.params = params if params is not None else ['p%s' %i for i in range(ndim)]
+        self.reset()
+
+
+    def reset(self):
+        self.n = 0
+        self.batch_size = 1
+        self.nFull = 0
+        self._sums = np.zeros((self.nBatches, self.nwalkers, self.ndim))
+        self._sumsq = np.zeros((self.nBatches, self.nwalkers, self.ndim))
+        self._curSum = np.zeros((self.nwalkers, self.ndim))
+        self._curSumsq = np.zeros((self.nwalkers, self.ndim))
+        self._curN = 0
+        # number of batches completed since the beginning, identifies the set of batches used by the diagnostics
+        self.nCompleted = 0
+        self.converged = False
+        self.history = {'step': [], 'batches': [], 'tau': [], 'rhat': [], 'converged': []}
+
+
+    def update(self, coords):
+        '''
+        Adds one step, with positions of the walkers of shape (nwalkers, ndim)
+        '''
+        self._curSum += coords
+        self._curSumsq += coords**2
+        self._curN += 1
+        self.n += 1
+        if self._curN==self.batch_size:
+            self._sums[self.nFull] = self._curSum
+            self._sumsq[self.nFull] = self._curSumsq
+            self.nFull += 1
+            self.nCompleted += 1
+            self._curSum = np.zeros((self.nwalkers, self.ndim))
+            self._curSumsq = np.zeros((self.nwalkers, self.ndim))
+            self._curN = 0
+            if self.nFull==self.nBatches:
+                # Merge adjacent batches
+                half = self.nBatches//2
+                self._sums[:half] = self._sums[0::2]+self._sums[1::2]
+                self._sumsq[:half] = self._sumsq[0::2]+self._sumsq[1::2]
+                self.nFull = half
+                self.batch_size *= 2
+
+
+    def _kept(self):
+        '''
+        Sums and sums of squares of the batches after burn-in. Uses an even number of batches
+        '''
+        i0 = int(np.ceil(self.discard*self.nFull))
+        i0 += (self.nFull-i0)%2
+        return self._sums[i0:self.nFull], self._sumsq[i0:self.nFull]
+
+
+    def tau(self):
+        '''
+        Integrated autocorrelation time for each parameter, in units of steps
+        '''
+        sums, sumsq = self._kept()
+        nb = sums.shape[0]
+        if nb<8:
+            return np.full(self.ndim, np.inf)
+        N = nb*self.batch_size
+        m = sums.sum(axis=0)/N
+        var = (sumsq.sum(axis=0)/N-m**2)*N/(N-1)
+        tau1 = self.batch_size*(sums/self.batch_size).var(axis=0, ddof=1).mean(axis=0)/var.mean(axis=0)
+        pairSums = sums[0::2]+sums[1::2]
+        tau2 = 2*self.batch_size*(pairSums/(2*self.batch_size)).var(axis=0, ddof=1).mean(axis=0)/var.mean(axis=0)
+        return np.maximum(2*tau2-tau1, tau1)
+
+
+    def rhat(self):
+        '''
+        Split R-hat for each parameter, with the two halves of each walker as chains
+        '''
+        sums, sumsq = self._kept()
+        nb = sums.shape[0]
+        if nb<4:
+            return np.full(self.ndim, np.inf)
+        half = nb//2
+        L = half*self.batch_size
+        chainSums = np.concatenate([sums[:half].sum(axis=0), sums[half:].sum(axis=0)])
+        chainSumsq = np.concatenate([sumsq[:half].sum(axis=0), sumsq[half:].sum(axis=0)])
+        mu = chainSums/L
+        s2 = (chainSumsq/L-mu**2)*L/(L-1)
+        W = s2.mean(axis=0)
+        BoverL = mu.var(axis=0, ddof=1)
+        return np.sqrt(((L-1)/L*W+BoverL)/W)
+
+
+    def _reference_tau(self, tau):
+        '''
+        Autocorrelation times of the latest check at least max(tau) steps before the current step 
+        and computed on a different set of batches. None if there is no such check
+        '''
+        if not np.all(np.isfinite(tau)):
+            return None
+        for step, batches, refTau in zip(self.history['step'][::-1], self.history['batches'][::-1], self.history['tau'][::-1]):
+            if step<=self.n-tau.max() and batches!=self.nCompleted:
+                return refTau
+        return None
+
+
+    def check(self, verbose=True):
+        '''
+        Computes the diagnostics and applies the stopping rule. Returns True if converged
+        '''
+        tau, rhat = self.tau(), self.rhat()
+        nKept = self._kept()[0].shape[0]*self.batch_size
+        refTau = self._reference_tau(tau)
+        converged = ( self.n>=self.min_steps and np.all(np.isfinite(tau))
+                      and nKept>self.ntau*tau.max()
+                      and refTau is not None and np.all(np.abs(tau-refTau)/tau<self.tau_rtol)
+                      and np.all(rhat<self.rhat_th) )
+        self.converged = bool(converged)
+        for key, val in zip(['step', 'batches', 'tau', 'rhat', 'converged'], [self.n, self.nCompleted, tau, rhat, self.converged]):
+            self.history[key].append(val)
+        if verbose:
+            print('Step %s. Autocorrelation times: %s. Max split R-hat: %.4f. Steps used: %s (%.1f tau). Converged: %s'
+                  %(self.n, str(dict(zip(self.params, np.round(tau, 1)))), rhat.max(), nKept, nKept/tau.max(), self.converged))
+        return self.converged
+
+
+    def summary(self):
+        return {key: np.array(val) for key, val in self.history.items()}
@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+#    Copyright (c) 2021 Michele Mancarella <michele.mancarella@unige.ch>
+#
+#    All rights reserved. Use of this source code is governed by a modified BSD
+#    license that can be found in the LICENSE file.
+
+import time
+import numpy as np
+import emcee
+import h5py
+
+from .pool import BatchedPosterior, get_pool, _init_worker, _log_prob
+from .backend import StreamingHDFBackend
+from .diagnostics import OnlineConvergence
+
+
+
+class EnsembleDriver(object):
+
+    '''
+    Runs emcee.EnsembleSampler on a Posterior, storing the components of the posterior as blobs
+    (see Posterior.blobs_dtype).
+
+    Walkers are evaluated according to mode:
+        - 'vectorize': the walkers of each half of the ensemble are evaluated with Posterior.logPosterior_batch,
+                       split between nCores processes (see BatchedPosterior)
+        - 'pool': one walker per task, through a multiprocessing pool with nCores processes,
+                  or through the pool passed as argument (e.g. schwimmbad.MPIPool from pool.get_pool).
+                  Workers are initialized once with the posterior, so only the points are sent to them.
+        - 'serial': one walker at a time in the main process
+    The throughput (evaluations of the posterior per second) is printed every print_every steps.
+
+    If fname is given, the chain is streamed to HDF5 every flush_every steps (see StreamingHDFBackend).
+    If fname already contains a chain, the run is resumed exactly from the last flush and continues up to nsteps in total.
+
+    If monitor is True, convergence diagnostics are updated at every step (see OnlineConvergence, whose options
+    are passed in monitor_args) and the run stops before nsteps as soon as the stopping rule is satisfied.
+
+    Usage:
+
+    myDriver = EnsembleDriver(myPost, nwalkers=32, mode='vectorize', nCores=8)
+    myDriver.run(p0, nsteps=5000)
+    myDriver.print_throughput()
+    myDriver.save('chains.h5') # if not streaming to HDF5
+
+    '''
+
+    modes = ('vectorize', 'pool', 'serial')
+
+    def __init__(self, posterior, nwalkers, mode='vectorize', nCores=1, pool=None, block_size=None, moves=None, print_every=100,
+                 fname=None, flush_every=100, seed=None, monitor=False, monitor_args=None):
+        '''
+
+        Parameters
+        ----------
+        posterior : obj of type Posterior
+        nwalkers : int
+        mode : str
+            'vectorize', 'pool' or 'serial'
+        nCores : int
+            number of processes (ignored in serial mode or if pool is given)
+        pool : optional
+            pool with a map method, used in 'pool' mode. The workers must have the posterior (see pool.get_pool)
+        block_size : int, optional
+            maximum number of walkers per call to Posterior.logPosterior_batch in vectorize mode
+        moves : optional
+            moves passed to emcee.EnsembleSampler
+        print_every : int
+            number of steps between throughput reports
+        fname : str, optional
+            HDF5 file where the chain is streamed. If it contains a chain, the run is resumed
+        flush_every : int
+            number of steps between writes to fname
+        seed : int, optional
+            seed of the random state of the sampler (ignored when resuming)
+        monitor : bool
+            if True, stops the run when converged according to OnlineConvergence
+        monitor_args : dict, optional
+            arguments of OnlineConvergence (e.g. check_every, ntau, rhat_th)
+
+        '''
+        if mode not in self.modes:
+            raise ValueError('Mode %s not supported. Supported modes are: %s' %(mode, str(self.modes)))
+        self.posterior = posterior
+        self.params_inference = posterior.hyperLikelihood.params_inference
+        self.ndim = len(self.params_inference)
+        self.nwalkers = nwalkers
+        self.mode = mode
+        self.nCores = nCores
+        self.pool = pool
+        self.block_size = block_size
+        self.moves = moves
+        self.print_every = print_every
+        self.fname = fname
+        self.flush_every = flush_every
+        self.seed = seed
+        self.diagnostics = None
+        if monitor:
+            self.diagnostics = OnlineConvergence(nwalkers, self.ndim, params=self.params_inference, **(monitor_args or {}))
+
+        self.sampler = None
+        self.nSteps = 0
+        self.runTime = 0.
+
+
+    def _vectorized_log_prob(self, coords):
+        logPosts, blobs = self.batchedPost(coords)
+        # emcee takes l[0] and l[1:] of the result of each walker, so the arrays are returned
+        # as one record per walker, (log posterior, *fields of blobs_dtype), built column-wise
+        return list(zip(logPosts, *[blobs[name] for name in blobs.dtype.names]))
+
+
+    def _setup(self):
+        '''
+        Returns log probability function and pool for emcee, and a function that releases the resources
+        '''
+        if self.mode=='vectorize':
+            self.batchedPost = BatchedPosterior(self.posterior, nCores=self.nCores, block_size=self.block_size)
+            return self._vectorized_log_prob, None, self.batchedPost.close
+        _init_worker(self.posterior)
+        if self.mode=='serial':
+            return _log_prob, None, lambda: None
+        if self.pool is not None:
+            return _log_prob, self.pool, lambda: None
+        pool = get_pool(self.posterior, mode='multiprocessing', nCores=self.nCores)
+
+        def close():
+            pool.close()
+            pool.join()
+
+        return _log_prob, pool, close
+
+
+    def run(self, p0, nsteps, progress=False):
+        '''
+        Runs the sampler starting from p0, of shape (nwalkers, len(params_inference)), up to nsteps steps.
+        If resuming from fname, p0 is ignored
+        '''
+        self.backend = None
+        nDone = 0
+        if self.fname is not None:
+            self.backend = StreamingHDFBackend(self.fname, flush_every=self.flush_every)
+            if self.backend.initialized and self.backend.iteration>0:
+                nDone = self.backend.iteration
+                print('Resuming from %s at step %s' %(self.fname, nDone))
+                # Last positions, log posterior, blobs and random state
+                p0 = self.backend.get_last_sample()
+                if self.diagnostics is not None:
+                    # Diagnostics are rebuilt from the stored chain, one block at a time
+                    self.diagnostics.reset()
+                    for block in self.backend.iter_chain():
+                        for coords in block:
+                            self.diagnostics.update(coords)
+        if nDone>=nsteps:
+            print('Chain in %s already has %s steps' %(self.fname, nDone))
+            return None
+
+        log_prob_fn, pool, close = self._setup()
+        try:
+            self.sampler = emcee.EnsembleSampler(self.nwalkers, self.ndim, log_prob_fn, pool=pool, moves=self.moves, backend=self.backend,
+                                                 vectorize=self.mode=='vectorize', blobs_dtype=self.posterior.blobs_dtype)
+            if self.seed is not None and nDone==0:
+                self.sampler.random_state = np.random.RandomState(self.seed).get_state()
+            print('Running %s walkers for %s steps in %s mode...' %(self.nwalkers, nsteps-nDone, self.mode))
+            t0 = time.perf_counter()
+            tLast, stepsLast = t0, 0
+            try:
+                for i, state in enumerate(self.sampler.sample(p0, iterations=nsteps-nDone, progress=progress)):
+                    self.nSteps = i+1
+                    if self.nSteps%self.print_every==0:
+                        t = time.perf_counter()
+                        print('Step %s/%s. Throughput: %.1f evaluations/s in the last %s steps, acceptance %.3f' %(nDone+self.nSteps, nsteps, self.nwalkers*(self.nSteps-stepsLast)/(t-tLast), self.nSteps-stepsLast, np.mean(self.sampler.acceptance_fraction)))
+                        tLast, stepsLast = t, self.nSteps
+                    if self.diagnostics is not None:
+                        self.diagnostics.update(state.coords)
+                        if self.diagnostics.n%self.diagnostics.check_every==0 and self.diagnostics.check():
+                            print('Chain converged at step %s' %(nDone+self.nSteps))
+                            break
+            finally:
+                self.runTime = time.perf_counter()-t0
+                if self.backend is not None:
+                    # Write the steps still in memory, also if the run is interrupted
+                    self.backend.flush()
+        finally:
+            close()
+        self.print_throughput()
+        if self.backend is not None:
+            self.backend.write_attrs(self.throughput())
+            if self.diagnostics is not None and len(self.diagnostics.history['step'])>0:
+                self.backend.write_attrs({'diagnostics_'+key: val for key, val in self.diagnostics.summary().items()})
+        return self.sampler
+
+
+    def throughput(self):
+        nEvals = self.nwalkers*self.nSteps
+        th = {}
+        if hasattr(self.moves, 'stats'):
+            # Delayed acceptance: only part of the proposals are evaluated with the full posterior
+            th = self.moves.stats()
+            nEvals = th['nFullEvals']
+        th.update({'mode': self.mode, 'nCores': self.nCores, 'nwalkers': self.nwalkers, 'nSteps': self.nSteps,
+                   'nEvals': nEvals, 'time': self.runTime,
+                   'evalsPerSec': nEvals/max(self.runTime, 1e-300),
+                   'stepsPerSec': self.nSteps/max(self.runTime, 1e-300)})
+        return th
+
+
+    def print_throughput(self):
+        th = self.throughput()
+        print('%s steps, %s evaluations of the posterior in %.1f s: %.1f evaluations/s, %.3f steps/s (%s mode, %s cores)' %(th['nSteps'], th['nEvals'], th['time'], th['evalsPerSec'], th['stepsPerSec'], th['mode'], th['nCores']))
+        if hasattr(self.moves, 'print_stats'):
+            self.moves.print_stats()
+
+
+    def save(self, fname):
+        '''
+        Writes chain, log posterior, blobs and throughput to HDF5
+        '''
+        with h5py.File(fname, 'w') as f:
+            f.attrs['params'] = np.array(self.params_inference, dtype='S')
+            for key, val in self.throughput().items():
+                f.attrs[key] = val
+            f.create_dataset('chain', data=self.sampler.get_chain())
+            f.create_dataset('log_prob', data=self.sampler.get_log_prob())
+            f.create_dataset('blobs', data=self.sampler.get_blobs())
+            f.create_dataset('acceptance_fraction', data=self.sampler.acceptance_fraction)
+        print('Saved chain to %s' %fname)
@@ -0,0 +1,274 @@
+#!/usr/bin/env python3
+#    Copyright (c) 2021 Michele Mancarella <michele.mancarella@unige.ch>
+#
+#    All rights reserved. Use of this source code is governed by a modified BSD
+#    license that can be found in the LICENSE file.
+
+import time
+import numpy as np
+import h5py
+from emcee import State
+from emcee.backends import Backend
+
+from .pool import BatchedPosterior
+from .backend import StreamingHDFBackend
+from .diagnostics import OnlineConvergence
+
+
+
+class EnsembleSliceSampler(object):
+
+    '''
+    Ensemble slice sampler with differential moves (Karamanis & Beutler 2021).
+    Each walker is updated with a one-dimensional slice sampling step along the direction
+    mu*(x_j-x_k), where x_j, x_k are two walkers of the complementary half of the ensemble.
+    Directions adapt to the shape of the posterior, so strongly correlated parameters (e.g. H0, R0, lambdaRedshift)
+    do not reduce the efficiency, and there is no rejection.
+
+    The walkers of each half of the ensemble are independent given the other half, so they are updated together:
+    at each iteration of the stepping-out and of the shrinking procedures, the points of all the walkers
+    that are not done are evaluated in one batched call to the posterior (see BatchedPosterior), split between nCores processes.
+    The two halves are updated one after the other, as required for the chain to have the posterior as stationary distribution.
+
+    The scale mu is tuned during the first tune_steps steps, so that the number of expansions and contractions
+    of the slices are equal; it is fixed afterwards.
+
+    The chain, log posterior and blobs (see Posterior.blobs_dtype) are stored in the same format as EnsembleDriver.
+    If fname is given, the chain is streamed to HDF5 every flush_every steps (see StreamingHDFBackend) and
+    a run in fname is resumed exactly from the last flush.
+    If monitor is True, the run stops when converged according to OnlineConvergence.
+
+    Usage:
+
+    mySampler = EnsembleSliceSampler(myPost, nwalkers=32, nCores=8, fname='chains.h5', seed=1)
+    mySampler.run(p0, nsteps=5000)
+    chain = mySampler.backend.get_chain()
+
+    '''
+
+    def __init__(self, posterior, nwalkers, nCores=1, block_size=None, mu=1., tune_steps=200, maxsteps=10000, maxiter=10000,
+                 print_every=100, fname=None, flush_every=100, seed=None, monitor=False, monitor_args=None):
+        '''
+
+        Parameters
+        ----------
+        posterior : obj of type Posterior
+        nwalkers : int
+            number of walkers. Must be even
+        nCores : int
+            number of processes used to evaluate the posterior
+        block_size : int, optional
+            maximum number of points per call to Posterior.logPosterior_batch
+        mu : float
+            initial scale of the directions
+        tune_steps : int
+            number of steps during which mu is tuned
+        maxsteps : int
+            maximum number of expansions of a slice
+        maxiter : int
+            maximum number of contractions of a slice. If exceeded, an error is raised
+        print_every : int
+            number of steps between progress reports
+        fname : str, optional
+            HDF5 file where the chain is streamed. If it contains a chain, the run is resumed
+        flush_every : int
+            number of steps between writes to fname
+        seed : int, optional
+            seed of the random state (ignored when resuming)
+        monitor : bool
+            if True, stops the run when converged according to OnlineConvergence
+        monitor_args : dict, optional
+            arguments of OnlineConvergence
+
+        '''
+        if nwalkers%2!=0 or nwalkers<4:
+            raise ValueError('The number of walkers must be even and at least 4')
+        self.posterior = posterior
+        self.params_inference = posterior.hyperLikelihood.params_inference
+        self.ndim = len(self.params_inference)
+        self.nwalkers = nwalkers
+        self.nCores = nCores
+        self.block_size = block_size
+        self.mu = mu
+        self.tune_steps = tune_steps
+        self.maxsteps = maxsteps
+        self.maxiter = maxiter
+        self.print_every = print_every
+        self.fname = fname
+        self.flush_every = flush_every
+        self.seed = seed
+        self.diagnostics = None
+        if monitor:
+            self.diagnostics = OnlineConvergence(nwalkers, self.ndim, params=self.params_inference, **(monitor_args or {}))
+
+        self.nSteps = 0
+        self.nEvals = 0
+        self.nExpansions = 0
+        self.nContractions = 0
+        self.runTime = 0.
+
+
+    def _slice_half(self, S, C):
+        '''
+        Slice sampling step for the walkers with indices S, with directions from the walkers with indices C.
+        Updates coords, log_prob and blobs in place. Returns number of expansions and contractions
+        '''
+        rng = self.rng
+        n = len(S)
+        x = self.coords[S]
+        # Two distinct walkers of the complementary half for each walker
+        jk = np.argsort(rng.random_sample((n, len(C))), axis=1)[:, :2]
+        d = self.mu*(self.coords[C][jk[:, 0]]-self.coords[C][jk[:, 1]])
+        logy = self.log_prob[S]-rng.exponential(size=n)
+
+        # Stepping out, with at most maxsteps expansions split randomly between the two sides
+        L = -rng.random_sample(n)
+        R = L+1.
+        J = np.floor(self.maxsteps*rng.random_sample(n)).astype(int)
+        K = self.maxsteps-1-J
+        activeL, activeR = J>0, K>0
+        nExp = 0
+        while activeL.any() or activeR.any():
+            iL, iR = np.where(activeL)[0], np.where(activeR)[0]
+            pts = np.concatenate([x[iL]+L[iL, None]*d[iL], x[iR]+R[iR, None]*d[iR]])
+            logPosts, _ = self.batchedPost(pts)
+            okL, okR = logPosts[:len(iL)]>logy[iL], logPosts[len(iL):]>logy[iR]
+            L[iL[okL]] -= 1.
+            R[iR[okR]] += 1.
+            J[iL[okL]] -= 1
+            K[iR[okR]] -= 1
+            nExp += okL.sum()+okR.sum()
+            activeL[iL] = okL & (J[iL]>0)
+            activeR[iR] = okR & (K[iR]>0)
+
+        # Shrinking
+        active = np.ones(n, dtype=bool)
+        nCon, it = 0, 0
+        while active.any():
+            if it>=self.maxiter:
+                raise RuntimeError('Number of contractions of the slice exceeded maxiter=%s. Check that the walkers are inside the support of the posterior' %self.maxiter)
+            i = np.where(active)[0]
+            u = L[i]+rng.random_sample(len(i))*(R[i]-L[i])
+            pts = x[i]+u[:, None]*d[i]
+            logPosts, blobs = self.batchedPost(pts)
+            ok = logPosts>logy[i]
+            idx = S[i[ok]]
+            self.coords[idx] = pts[ok]
+            self.log_prob[idx] = logPosts[ok]
+            self.blobs[idx] = blobs[ok]
+            active[i[ok]] = False
+            left = ~ok & (u<0)
+            right = ~ok & (u>=0)
+            L[i[left]] = u[left]
+            R[i[right]] = u[right]
+            nCon += (~ok).sum()
+            it += 1
+        return nExp, nCon
+
+
+    def _step(self):
+        '''
+        Updates the two halves of the ensemble in turn
+        '''
+        perm = self.rng.permutation(self.nwalkers)
+        halves = perm[:self.nwalkers//2], perm[self.nwalkers//2:]
+        nExp, nCon = 0, 0
+        for S, C in ((halves[0], halves[1]), (halves[1], halves[0])):
+            e, c = self._slice_half(S, C)
+            nExp += e
+            nCon += c
+        self.nExpansions += nExp
+        self.nContractions += nCon
+        if self.iteration<self.tune_steps:
+            self.mu *= 2.*max(nExp, 1)/(max(nExp, 1)+nCon)
+
+
+    def run(self, p0, nsteps):
+        '''
+        Runs the sampler starting from p0, of shape (nwalkers, len(params_inference)), up to nsteps steps.
+        If resuming from fname, p0 is ignored
+        '''
+        self.rng = np.random.RandomState(self.seed)
+        if self.fname is not None:
+            self.backend = StreamingHDFBackend(self.fname, flush_every=self.flush_every)
+        else:
+            self.backend = Backend()
+        nDone = 0
+        if self.backend.initialized and self.backend.iteration>0:
+            nDone = self.backend.iteration
+            print('Resuming from %s at step %s' %(self.fname, nDone))
+            state = self.backend.get_last_sample()
+            self.rng.set_state(state.random_state)
+            with h5py.File(self.fname, 'r') as f:
+                self.mu = float(f[self.backend.name].attrs['mu'])
+            if self.diagnostics is not None:
+                self.diagnostics.reset()
+                for block in self.backend.iter_chain():
+                    for coords in block:
+                        self.diagnostics.update(coords)
+        if nDone>=nsteps:
+            print('Chain already has %s steps' %nDone)
+            return None
+        self.iteration = nDone
+
+        self.batchedPost = BatchedPosterior(self.posterior, nCores=self.nCores, block_size=self.block_size)
+        try:
+            if nDone>0:
+                self.coords, self.log_prob, self.blobs = np.array(state.coords), np.array(state.log_prob), np.array(state.blobs)
+            else:
+                self.coords = np.array(p0, dtype=float)
+                self.log_prob, self.blobs = self.batchedPost(self.coords)
+                if not np.all(np.isfinite(self.log_prob)):
+                    raise ValueError('The posterior is not finite for some of the initial walkers')
+                self.backend.reset(self.nwalkers, self.ndim)
+            self.backend.grow(nsteps-nDone, self.blobs)
+            accepted = np.ones(self.nwalkers)
+
+            print('Running ensemble slice sampler with %s walkers for %s steps...' %(self.nwalkers, nsteps-nDone))
+            t0 = time.perf_counter()
+            nEvals0 = self.batchedPost.nEvals
+            try:
+                for i in range(nsteps-nDone):
+                    self._step()
+                    self.iteration += 1
+                    self.nSteps = i+1
+                    self.backend.save_step(State(self.coords, log_prob=self.log_prob, blobs=self.blobs, random_state=self.rng.get_state()), accepted)
+                    if self.fname is not None and self.backend._nBuf==0:
+                        # mu is needed to resume after the tuning phase
+                        self.backend.write_attrs({'mu': self.mu})
+                    if self.nSteps%self.print_every==0:
+                        print('Step %s/%s. mu=%.3f, %.1f evaluations per walker per step, %.1f evaluations/s' %(self.iteration, nsteps, self.mu, (self.batchedPost.nEvals-nEvals0)/self.nwalkers/self.nSteps, (self.batchedPost.nEvals-nEvals0)/(time.perf_counter()-t0)))
+                    if self.diagnostics is not None:
+                        self.diagnostics.update(self.coords)
+                        if self.diagnostics.n%self.diagnostics.check_every==0 and self.diagnostics.check():
+                            print('Chain converged at step %s' %self.iteration)
+                            break
+            finally:
+                self.runTime = time.perf_counter()-t0
+                self.nEvals = self.batchedPost.nEvals-nEvals0
+                if self.fname is not None:
+                    # Write the steps still in memory, also if the run is interrupted
+                    self.backend.flush()
+                    self.backend.write_attrs({'mu': self.mu})
+        finally:
+            self.batchedPost.close()
+        self.print_throughput()
+        if self.fname is not None:
+            self.backend.write_attrs(self.throughput())
+            if self.diagnostics is not None and len(self.diagnostics.history['step'])>0:
+                self.backend.write_attrs({'diagnostics_'+key: val for key, val in self.diagnostics.summary().items()})
+        return self.backend
+
+
+    def throughput(self):
+        return {'mode': 'slice', 'nCores': self.nCores, 'nwalkers': self.nwalkers, 'nSteps': self.nSteps,
+                'nEvals': self.nEvals, 'time': self.runTime,
+                'evalsPerSec': self.nEvals/max(self.runTime, 1e-300),
+                'stepsPerSec': self.nSteps/max(self.runTime, 1e-300),
+                'evalsPerWalkerStep': self.nEvals/max(self.nwalkers*self.nSteps, 1),
+                'mu': self.mu}
+
+
+    def print_throughput(self):
+        th = self.throughput()
+        print('%s steps, %s evaluations of the posterior (%.1f per walker per step) in %.1f s: %.1f evaluations/s, %.3f steps/s (%s cores)' %(th['nSteps'], th['nEvals'], th['evalsPerWalkerStep'], th['time'], th['evalsPerSec'], th['stepsPerSec'], th['nCores']))
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+#    Copyright (c) 2021 Michele Mancarella <michele.mancarella@unige.ch>
+#
+#    All rights reserved. Use of this source code is governed by a modified BSD
+#    license that can be found in the LICENSE file.
+
+import os
+import sys
+PACKAGE_PARENT = '..'
+SCRIPT_DIR = os.path.dirname(os.path.realpath(os.path.join(os.getcwd(), os.path.expanduser(__file__))))
+sys.path.append(os.path.normpath(os.path.join(SCRIPT_DIR, PACKAGE_PARENT)))
+
+import astropy.units as u
+
+from cosmology.cosmo import Cosmo
+from population.allPopulations import AllPopulations
+from population.astro.astroPopulation import AstroPopulation
+from population.astro.astroMassDistribution import AstroSmoothPowerLawMass, TruncPowerLawMass, BrokenPowerLawMass, AstroGaussMass
+from population.astro.astroSpinDistribution import DummySpinDist, GaussSpinDist
+from population.astro.rateEvolution import PowerLawRateEvolution, AstroPhRateEvolution, DummyRateEvolution
+
+
+
+# Names used in config files for the components of each population
+
+massFunctions = { 'smooth_pow_law': AstroSmoothPowerLawMass,
+                  'trunc_pow_law': TruncPowerLawMass,
+                  'broken_pow_law': BrokenPowerLawMass,
+                  'gauss': AstroGaussMass,
+                  }
+
+spinDists = { 'skip': DummySpinDist,
+              'gauss': GaussSpinDist,
+              }
+
+rateEvols = { 'simple_pow_law': PowerLawRateEvolution,
+              'astro-ph': AstroPhRateEvolution,
+              'dummy': DummyRateEvolution,
+              }
+
+# Rate evolutions that need the distance unit
+rateWithUnits = ('simple_pow_law', 'astro-ph')
+
+populationsBuilders = { 'astro': AstroPopulation,
+                        }
+
+
+
+def build_model( populations, cosmo_args={'dist_unit':u.Gpc}, mass_args={}, spin_args={}, rate_args={}):
+    '''
+
+    Parameters
+    ----------
+    populations : dict
+        {population name: {'mass_function': ..., 'spin_distribution': ..., 'rate': ...}}
+        Example: {'astro': {'mass_function': 'trunc_pow_law', 'spin_distribution': 'skip', 'rate': 'simple_pow_law'}}
+    cosmo_args : dict
+        arguments passed to Cosmo
+    mass_args, spin_args, rate_args : dict
+        extra arguments passed to the mass, spin distributions and rate evolution.
+        The units for the rate are passed automatically
+
+    Returns
+    -------
+    allPops : object of type AllPopulations
+
+    '''
+    cosmo = Cosmo(**cosmo_args)
+    allPops = AllPopulations(cosmo)
+
+    for popName, popSpecs in populations.items():
+        if popName not in populationsBuilders:
+            raise ValueError('Population %s not supported. Supported populations are: %s' %(popName, str(list(populationsBuilders.keys()))))
+        for key, builders in zip(['mass_function', 'spin_distribution', 'rate'], [massFunctions, spinDists, rateEvols]):
+            if popSpecs[key] not in builders:
+                raise ValueError('%s %s not supported. Supported values are: %s' %(key, popSpecs[key], str(list(builders.keys()))))
+
+        massFunction = massFunctions[popSpecs['mass_function']](**mass_args)
+        spinDist = spinDists[popSpecs['spin_distribution']](**spin_args)
+        if popSpecs['rate'] in rateWithUnits:
+            rateEvol = rateEvols[popSpecs['rate']](unit=cosmo.dist_unit, **rate_args)
+        else:
+            rateEvol = rateEvols[popSpecs['rate']](**rate_args)
+
+        allPops.add_pop(populationsBuilders[popName](rateEvol, massFunction, spinDist))
+
+    return allPops
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+#    Copyright (c) 2021 Michele Mancarella <michele.mancarella@unige.ch>
+#
+#    All rights reserved. Use of this source code is governed by a modified BSD
+#    license that can be found in the LICENSE file.
+
+import multiprocessing
+import numpy as np
+
+
+# Posterior used by the worker processes. It is set once by _init_worker,
+# so it is inherited by the workers and never pickled when the start method is fork
+_posterior = None
+
+
+def _init_worker(posterior):
+    global _posterior
+    _posterior = posterior
+
+
+def _eval_block(pts):
+    return _posterior.logPosterior_batch(pts, return_blob=True)
+
+
+def _log_prob(Lambda_test):
+    '''
+    Log posterior and blobs for one walker, in the format used by emcee with blobs_dtype=Posterior.blobs_dtype.
+    Used by pools: only the point is sent to the workers
+    '''
+    return _posterior.logPosterior(Lambda_test, return_blob=True)
+
+
+def get_pool(posterior, mode='multiprocessing', nCores=1):
+    '''
+    Returns a pool whose workers evaluate _log_prob with the posterior, initialized once.
+    mode : 'multiprocessing' (fork, nCores processes) or 'mpi' (schwimmbad.MPIPool).
+           With MPI, every process has to build the posterior and call this function; 
+           processes other than the master should then call pool.wait()
+    '''
+    if mode=='multiprocessing':
+        return multiprocessing.get_context('fork').Pool(nCores, initializer=_init_worker, initargs=(posterior,))
+    elif mode=='mpi':
+        try:
+            from schwimmbad import MPIPool
+        except ImportError:
+            raise ImportError('schwimmbad and mpi4py are required to run with MPI')
+        _init_worker(posterior)
+        return MPIPool()
+    else:
+        raise ValueError('Pool mode %s not supported. Use multiprocessing or mpi' %mode)
+
+
+
+class BatchedPosterior(object):
+
+    '''
+    Evaluates the posterior on blocks of points with Posterior.logPosterior_batch.
+    If nCores>1, the points are split in blocks evaluated by a pool of processes.
+    Workers are initialized once with the posterior (data and injections are not pickled).
+
+    Usage:
+
+    myBatchedPost = BatchedPosterior(myPost, nCores=8)
+    logPosts, blobs = myBatchedPost(points)
+    myBatchedPost.close()
+
+    '''
+
+    def __init__(self, posterior, nCores=1, block_size=None):
+        '''
+
+        Parameters
+        ----------
+        posterior : obj of type Posterior
+        nCores : int
+            number of processes. If 1, points are evaluated in the main process
+        block_size : int, optional
+            maximum number of points per block. If None, points are split evenly between processes
+
+        '''
+        self.posterior = posterior
+        self.nCores = nCores
+        self.block_size = block_size
+        self.nEvals = 0
+        self.pool = None
+        if nCores>1:
+            self.pool = multiprocessing.get_context('fork').Pool(nCores, initializer=_init_worker, initargs=(posterior,))
+        else:
+            _init_worker(posterior)
+
+
+    def _split(self, pts):
+        nBlocks = self.nCores
+        if self.block_size is not None:
+            nBlocks = max(nBlocks, int(np.ceil(pts.shape[0]/self.block_size)))
+        return [b for b in np.array_split(pts, min(nBlocks, pts.shape[0])) if b.shape[0]>0]
+
+
+    def __call__(self, pts):
+        '''
+        Returns log posterior and blobs (see Posterior.blobs_dtype) for an array of points
+        of shape (nPoints, len(params_inference))
+        '''
+        pts = np.atleast_2d(pts)
+        self.nEvals += pts.shape[0]
+        if self.pool is None:
+            blocks = [_eval_block(b) for b in self._split(pts)]
+        else:
+            blocks = self.pool.map(_eval_block, self._split(pts))
+        return np.concatenate([b[0] for b in blocks]), np.concatenate([b[1] for b in blocks])
+
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
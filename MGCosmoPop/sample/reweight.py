@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+#    Copyright (c) 2021 Michele Mancarella <michele.mancarella@unige.ch>
+#
+#    All rights reserved. Use of this source code is governed by a modified BSD
+#    license that can be found in the LICENSE file.
+
+import time
+import multiprocessing
+import numpy as np
+from scipy.stats import genpareto
+import h5py
+
+from .backend import StreamingHDFBackend
+
+
+# Posterior and terms to recompute, used by the worker processes. They are set by _init_worker,
+# so they are inherited by the workers and never pickled when the start method is fork
+_posterior = None
+_terms = None
+
+
+def _init_worker(posterior, terms):
+    global _posterior, _terms
+    _posterior = posterior
+    _terms = terms
+
+
+def _recompute_block(args):
+    '''
+    Recomputes the components of the posterior that changed for a block of samples
+    '''
+    iBlock, pts, blobs = args
+    blobs = blobs.copy()
+    if _terms['prior']:
+        blobs['lp'] = _posterior.prior.logPrior(pts)
+    if _terms['selection']:
+        if hasattr(_posterior.selectionBias, 'Ndet_batch'):
+            blobs['mus'], blobs['errs'], blobs['Neffs'] = _posterior.selectionBias.Ndet_batch(pts)
+        else:
+            for k in range(pts.shape[0]):
+                blobs['mus'][k], blobs['errs'][k], blobs['Neffs'][k] = _posterior.selectionBias.Ndet(pts[k])
+    hyperLik = _posterior.hyperLikelihood
+    for k in range(pts.shape[0]):
+        for i in _terms['datasets']:
+            blobs['lls'][k, i] = hyperLik._logLik(pts[k], hyperLik.data[i], iData=i)
+        for i, oldData, newData in _terms['events']:
+            if oldData is not None:
+                blobs['lls'][k, i] -= hyperLik._logLik(pts[k], oldData)
+            if newData is not None:
+                blobs['lls'][k, i] += hyperLik._logLik(pts[k], newData)
+    return iBlock, _posterior.logPosterior_from_blobs(blobs), blobs
+
+
+def load_chain(fname, name='mcmc', discard=0, thin=1):
+    '''
+    Flat samples, log posterior and blobs from a chain written by StreamingHDFBackend (group name)
+    or by EnsembleDriver.save
+    '''
+    with h5py.File(fname, 'r') as f:
+        streamed = name in f
+        if not streamed:
+            samples = np.array(f['chain'][discard+thin-1::thin])
+            logPosts = np.array(f['log_prob'][discard+thin-1::thin])
+            blobs = np.array(f['blobs'][discard+thin-1::thin]) if 'blobs' in f else None
+    if streamed:
+        backend = StreamingHDFBackend(fname, name=name, read_only=True)
+        samples = backend.get_chain(discard=discard, thin=thin)
+        logPosts = backend.get_log_prob(discard=discard, thin=thin)
+        blobs = backend.get_blobs(discard=discard, thin=thin)
+    flatten = lambda x: x.reshape((-1,)+x.shape[2:])
+    return flatten(samples), flatten(logPosts), None if blobs is None else flatten(blobs)
+
+
+
+class ChainReweighter(object):
+
+    '''
+    Importance reweighting of an existing chain to a modified posterior,
+    recomputing only the components of the posterior that changed (see Posterior.blobs_dtype):
+        - prior: log prior with the prior of the new posterior
+        - selection: mu, error and Neff of all datasets with the selection bias of the new posterior
+          (e.g. with an updated injection set)
+        - datasets: log likelihood of whole datasets, with the data of the new posterior
+        - events: change of the log likelihood of dataset i when the events in oldData are replaced by those in newData
+          (Data objects with only the events that changed; either can be None, to add or remove events).
+          They can be built from the full datasets with Data.subset, e.g. oldData=oldCatalog.subset([3, 7]).
+          Only the likelihood of these events is computed
+    The other components are taken from the blobs stored with the chain.
+
+    Samples are split in blocks evaluated in parallel by nCores processes; the selection bias of each block
+    is computed with one pass over the injections (SelectionBiasInjections.Ndet_batch).
+
+    The importance weights are w = p_new/p_old. The report gives the effective sample size
+    ESS = (sum w)^2/sum w^2 and the Pareto shape k of the tail of the weights (Vehtari et al. 2015).
+    If ESS/nSamples<ess_min or k>k_max, the weights are unreliable and a new run is recommended.
+    The ESS does not account for the autocorrelation of the chain, so the chain should be thinned.
+
+    Usage:
+
+    myReweighter = ChainReweighter(myNewPost, 'chains.h5', discard=1000, thin=20, nCores=8)
+    myReweighter.reweight(selection=True)
+    myReweighter.print_report()
+    samples = myReweighter.resample(5000)
+
+    '''
+
+    def __init__(self, posterior, fname, name='mcmc', discard=0, thin=1, nCores=1, block_size=256, ess_min=0.1, k_max=0.7):
+        '''
+
+        Parameters
+        ----------
+        posterior : obj of type Posterior
+            the new posterior. Parameters of the inference and datasets must be the same as for the chain
+        fname : str
+            HDF5 file with the chain and blobs (see load_chain)
+        name : str
+            group of the chain in fname, if written by StreamingHDFBackend
+        discard, thin : int
+            burn-in and thinning of the chain
+        nCores : int
+            number of processes
+        block_size : int
+            number of samples per block
+        ess_min : float
+            minimum ESS, as a fraction of the number of samples, for the weights to be reliable
+        k_max : float
+            maximum Pareto shape of the tail of the weights for the weights to be reliable
+
+        '''
+        self.posterior = posterior
+        self.params_inference = posterior.hyperLikelihood.params_inference
+        self.fname = fname
+        self.nCores = nCores
+        self.block_size = block_size
+        self.ess_min = ess_min
+        self.k_max = k_max
+
+        self.samples, self.logPostsOld, self.blobsOld = load_chain(fname, name=name, discard=discard, thin=thin)
+        if self.blobsOld is None:
+            raise ValueError('The chain in %s has no blobs. The components of the posterior are needed for reweighting' %fname)
+        if self.samples.shape[1]!=len(self.params_inference):
+            raise ValueError('The chain has %s parameters, but the posterior has %s: %s' %(self.samples.shape[1], len(self.params_inference), str(self.params_inference)))
+        if self.blobsOld.dtype!=posterior.blobs_dtype:
+            raise ValueError('Blobs of the chain have dtype %s, but the posterior has %s. The number of datasets should be the same' %(str(self.blobsOld.dtype), str(posterior.blobs_dtype)))
+        self.nSamples = self.samples.shape[0]
+        print('Loaded %s samples from %s' %(self.nSamples, fname))
+
+        self.logPostsNew = None
+        self.blobsNew = None
+        self.logw = None
+        self.runTime = 0.
+
+
+    def reweight(self, prior=False, selection=False, datasets=None, events=None):
+        '''
+        Recomputes the components that changed and the importance weights.
+
+        Parameters
+        ----------
+        prior : bool
+        selection : bool
+        datasets : list, optional
+            indices of the datasets whose likelihood is recomputed
+        events : list, optional
+            list of (index of dataset, oldData, newData), see Data.subset
+
+        Returns
+        -------
+        weights normalized to sum to one
+
+        '''
+        terms = {'prior': prior, 'selection': selection, 'datasets': list(datasets or []), 'events': list(events or [])}
+        if not (prior or selection or terms['datasets'] or terms['events']):
+            raise ValueError('Nothing to recompute')
+        if selection and self.posterior.selectionBias is None:
+            raise ValueError('The new posterior has no selection bias')
+
+        blocks = [(i, self.samples[i0:i0+self.block_size], self.blobsOld[i0:i0+self.block_size]) for i, i0 in enumerate(range(0, self.nSamples, self.block_size))]
+        print('Recomputing %s for %s samples in %s blocks with %s cores...' %(', '.join([key for key in ('prior', 'selection') if terms[key]]+['likelihood of dataset %s' %i for i in terms['datasets']]+['events of dataset %s' %e[0] for e in terms['events']]), self.nSamples, len(blocks), self.nCores))
+        logPosts = np.empty(self.nSamples)
+        blobs = np.empty(self.nSamples, dtype=self.blobsOld.dtype)
+        t0 = time.perf_counter()
+        pool = None
+        try:
+            if self.nCores>1:
+                pool = multiprocessing.get_context('fork').Pool(self.nCores, initializer=_init_worker, initargs=(self.posterior, terms))
+                results = pool.imap_unordered(_recompute_block, blocks)
+            else:
+                _init_worker(self.posterior, terms)
+                results = map(_recompute_block, blocks)
+            for nDone, (i, logPostsBlock, blobsBlock) in enumerate(results):
+                i0 = i*self.block_size
+                logPosts[i0:i0+logPostsBlock.shape[0]] = logPostsBlock
+                blobs[i0:i0+logPostsBlock.shape[0]] = blobsBlock
+                if (nDone+1)%max(len(blocks)//10, 1)==0:
+                    print('%s/%s blocks done in %.1f s' %(nDone+1, len(blocks), time.perf_counter()-t0))
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+        self.runTime = time.perf_counter()-t0
+
+        self.logPostsNew, self.blobsNew = logPosts, blobs
+        self.logw = np.where(np.isfinite(logPosts), logPosts-self.logPostsOld, -np.inf)
+        return self.weights()
+
+
+    def weights(self):
+        if self.logw is None:
+            raise ValueError('Run reweight first')
+        if not np.any(np.isfinite(self.logw)):
+            return np.zeros(self.nSamples)
+        return np.exp(self.logw-np.logaddexp.reduce(self.logw))
+
+
+    def pareto_k(self):
+        '''
+        Shape of the generalized Pareto distribution fitted to the largest weights
+        '''
+        w = self.weights()
+        w = np.sort(w[w>0])
+        M = int(min(w.shape[0]/5, 3*np.sqrt(w.shape[0])))
+        if M<5:
+            return np.inf
+        tail = w[-M:]-w[-M-1]
+        if tail.max()<=1e-10*w[-1]:
+            # Equal weights: no tail
+            return -np.inf
+        k, _, _ = genpareto.fit(tail, floc=0)
+        return k
+
+
+    def report(self):
+        w = self.weights()
+        ess = 1./np.sum(w**2) if np.any(w>0) else 0.
+        k = self.pareto_k()
+        return {'nSamples': self.nSamples,
+                'ESS': ess,
+                'ESS_fraction': ess/self.nSamples,
+                'max_weight': w.max(),
+                'nRejected': int(np.sum(~np.isfinite(self.logw))),
+                'pareto_k': k,
+                'log_mean_weight': np.logaddexp.reduce(self.logw)-np.log(self.nSamples),
+                'time': self.runTime,
+                'rerun_recommended': bool(ess/self.nSamples<self.ess_min or not k<=self.k_max)}
+
+
+    def print_report(self):
+        rep = self.report()
+        print('Importance reweighting of %s samples in %.1f s: ESS = %.1f (%.1f%%), max weight %.3g, %s samples rejected by the new posterior, Pareto k = %.2f'
+              %(rep['nSamples'], rep['time'], rep['ESS'], 100*rep['ESS_fraction'], rep['max_weight'], rep['nRejected'], rep['pareto_k']))
+        if rep['rerun_recommended']:
+            print('Weights are unreliable (ESS fraction<%s or Pareto k>%s): the new posterior is too different from the old one. A new run is recommended' %(self.ess_min, self.k_max))
+
+
+    def resample(self, nSamples, seed=None):
+        '''
+        Equally weighted samples drawn with replacement according to the weights
+        '''
+        rng = np.random.default_rng(seed)
+        return self.samples[rng.choice(self.nSamples, size=nSamples, p=self.weights())]
+
+
+    def save(self, fname):
+        '''
+        Writes samples, weights, new components of the posterior and report to HDF5
+        '''
+        with h5py.File(fname, 'w') as f:
+            f.attrs['params'] = np.array(self.params_inference, dtype='S')
+            f.attrs['chain'] = self.fname
+            for key, val in self.report().items():
+                f.attrs[key] = val
+            f.create_dataset('samples', data=self.samples)
+            f.create_dataset('log_weights', data=self.logw)
+            f.create_dataset('weights', data=self.weights())
+            f.create_dataset('log_prob', data=self.logPostsNew)
+            f.create_dataset('blobs', data=self.blobsNew)
+        print('Saved weights to %s' %fname)
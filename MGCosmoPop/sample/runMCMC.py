@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+#    Copyright (c) 2021 Michele Mancarella <michele.mancarella@unige.ch>
+#
+#    All rights reserved. Use of this source code is governed by a modified BSD
+#    license that can be found in the LICENSE file.
+
+import os
+import sys
+import argparse
+import importlib
+import json
+import time
+import signal
+
+PACKAGE_PARENT = '..'
+SCRIPT_DIR = os.path.dirname(os.path.realpath(os.path.join(os.getcwd(), os.path.expanduser(__file__))))
+sys.path.append(os.path.normpath(os.path.join(SCRIPT_DIR, PACKAGE_PARENT)))
+
+import Globals
+import utils
+from sample.setupRun import build_posterior, build_surrogate_posterior, initial_walkers
+from sample.ensembleDriver import EnsembleDriver
+from sample.ensembleSlice import EnsembleSliceSampler
+from sample.pool import get_pool
+from sample.delayedAcceptance import DelayedAcceptanceMove, QuadraticSurrogate
+from posteriors.forecast import LaplaceForecast
+
+
+
+##########################################################################
+##########################################################################
+
+
+def check_config(config):
+    '''
+    Raises ValueError for combinations of options of the sampler that are not supported,
+    before the posterior is built
+    '''
+    if config.sampler=='slice' and config.delayed_acceptance is not None:
+        raise ValueError('Delayed acceptance is only supported with the emcee sampler. Set delayed_acceptance = None to use the slice sampler')
+
+
+
+def main():
+
+    in_time=time.time()
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", default='', type=str, required=True) # config file
+    parser.add_argument("--fout", default='', type=str, required=True) # output folder
+    FLAGS = parser.parse_args()
+
+    config = importlib.import_module(FLAGS.config.replace('.py', ''), package=None)
+    fout = FLAGS.fout
+
+    check_config(config)
+
+    # With MPI, all processes build the posterior. Only the master runs the sampler and writes output
+    pool = None
+    is_master = True
+    if config.mode=='mpi':
+        from mpi4py import MPI
+        is_master = MPI.COMM_WORLD.Get_rank()==0
+
+    out_path=os.path.join(Globals.dirName, 'results', fout)
+    if is_master:
+        try:
+            print('Creating directory %s' %out_path)
+            os.makedirs(out_path)
+        except FileExistsError:
+            print('Using directory %s for output' %out_path)
+
+        logfile = os.path.join(out_path, 'logfile.txt')
+        myLog = utils.Logger(logfile)
+        sys.stdout = myLog
+        sys.stderr = myLog
+
+
+    #########################################################################
+    # Build posterior
+
+    myPost, allPops = build_posterior(config)
+
+    if config.mode=='mpi':
+        pool = get_pool(myPost, mode='mpi')
+        if not pool.is_master():
+            pool.wait()
+            sys.exit(0)
+
+
+    #########################################################################
+    # Run
+
+    Lambda_ini = allPops.get_base_values(config.params_inference)
+    print('Starting walkers around %s' %str(dict(zip(config.params_inference, Lambda_ini))))
+    p0 = initial_walkers(myPost, Lambda_ini, config.nwalkers, eps=config.eps, seed=config.seed)
+
+    moves = None
+    if config.delayed_acceptance=='quadratic':
+        myForecast = LaplaceForecast(myPost)
+        myForecast.find_MAP(Lambda_ini)
+        myForecast.compute_covariance()
+        myForecast.print_summary()
+        moves = DelayedAcceptanceMove(QuadraticSurrogate.from_forecast(myForecast, inflate=config.da_inflate))
+    elif config.delayed_acceptance=='subset':
+        moves = DelayedAcceptanceMove(build_surrogate_posterior(config, config.surrogate_data_args, config.surrogate_injections_args))
+    elif config.delayed_acceptance is not None:
+        raise ValueError('Delayed acceptance %s not supported. Use None, quadratic or subset' %config.delayed_acceptance)
+
+    # The chain is streamed to chains.h5. If the file already exists, the run is resumed from it
+    if config.sampler=='slice':
+        myDriver = EnsembleSliceSampler(myPost, config.nwalkers, nCores=config.nCores, block_size=config.block_size,
+                                        mu=config.slice_mu, tune_steps=config.slice_tune_steps, print_every=config.print_every,
+                                        fname=os.path.join(out_path, 'chains.h5'), flush_every=config.flush_every, seed=config.seed,
+                                        monitor=config.monitor, monitor_args=config.monitor_args)
+    else:
+        myDriver = EnsembleDriver(myPost, config.nwalkers, mode='pool' if config.mode=='mpi' else config.mode,
+                                  nCores=config.nCores, pool=pool, block_size=config.block_size, moves=moves, print_every=config.print_every,
+                                  fname=os.path.join(out_path, 'chains.h5'), flush_every=config.flush_every, seed=config.seed,
+                                  monitor=config.monitor, monitor_args=config.monitor_args)
+    # Pre-emption on clusters usually sends SIGTERM: exit cleanly so that the steps in memory are written
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit('Received SIGTERM. Exiting.'))
+    try:
+        myDriver.run(p0, config.nsteps)
+    finally:
+        if pool is not None:
+            pool.close()
+
+    with open(os.path.join(out_path, 'throughput.json'), 'w') as f:
+        json.dump(myDriver.throughput(), f, indent=2)
+
+
+    ##########################################################################
+
+    print('\nDone. Total execution time: %.2fs' %(time.time() - in_time))
+
+    sys.stdout = sys.__stdout__
+    sys.stderr = sys.__stderr__
+    myLog.close()
+
+
+
+
+if __name__=='__main__':
+    main()
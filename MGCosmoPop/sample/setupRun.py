@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+#    Copyright (c) 2021 Michele Mancarella <michele.mancarella@unige.ch>
+#
+#    All rights reserved. Use of this source code is governed by a modified BSD
+#    license that can be found in the LICENSE file.
+
+import os
+import sys
+PACKAGE_PARENT = '..'
+SCRIPT_DIR = os.path.dirname(os.path.realpath(os.path.join(os.getcwd(), os.path.expanduser(__file__))))
+sys.path.append(os.path.normpath(os.path.join(SCRIPT_DIR, PACKAGE_PARENT)))
+
+import types
+import numpy as np
+import astropy.units as u
+
+import Globals
+from dataStructures.mockData import GWMockData, GWMockInjectionsData
+from dataStructures.O1O2data import O1O2Data, O1O2InjectionsData
+from dataStructures import O3adata, O3bdata
+from posteriors.prior import Prior
+from posteriors.likelihood import HyperLikelihood
+from posteriors.selectionBias import SelectionBiasInjections
+from posteriors.posterior import Posterior
+
+from .models import build_model
+
+
+
+# Names used in config files for the datasets
+
+dataBuilders = { 'mock': GWMockData,
+                 'O1O2': O1O2Data,
+                 'O3a': O3adata.O3aData,
+                 'O3b': O3bdata.O3bData,
+                 }
+
+injectionsBuilders = { 'mock': GWMockInjectionsData,
+                       'O1O2': O1O2InjectionsData,
+                       'O3a': O3adata.O3InjectionsData,
+                       'O3b': O3bdata.O3InjectionsData,
+                       }
+
+
+
+def load_data(datasets, dist_unit=u.Gpc):
+    '''
+    datasets : dict
+        {dataset name: {'fname': path relative to Globals.dataPath, 'args': dict of arguments of the Data class}}
+        The type of data is the part of the name before the first underscore
+        (e.g. 'mock', 'O3a', 'mock_2' )
+    '''
+    allData = []
+    for name, specs in datasets.items():
+        dataType = name.split('_')[0]
+        if dataType not in dataBuilders:
+            raise ValueError('Data type %s not supported. Supported types are: %s' %(dataType, str(list(dataBuilders.keys()))))
+        print('\nLoading data %s from %s...' %(name, specs['fname']))
+        allData.append(dataBuilders[dataType](os.path.join(Globals.dataPath, specs['fname']), dist_unit=dist_unit, **specs.get('args', {})))
+    return allData
+
+
+
+def load_injections(injections, dist_unit=u.Gpc):
+    '''
+    injections : dict
+        same format as the argument of load_data, one entry for each dataset
+    '''
+    allInjData = []
+    for name, specs in injections.items():
+        dataType = name.split('_')[0]
+        if dataType not in injectionsBuilders:
+            raise ValueError('Injections type %s not supported. Supported types are: %s' %(dataType, str(list(injectionsBuilders.keys()))))
+        print('\nLoading injections %s from %s...' %(name, specs['fname']))
+        allInjData.append(injectionsBuilders[dataType](os.path.join(Globals.dataPath, specs['fname']), dist_unit=dist_unit, **specs.get('args', {})))
+    return allInjData
+
+
+
+def build_posterior(config):
+    '''
+    Builds the population model, data, injections, prior, likelihood, selection bias and posterior
+    from a config module (see sample/config.py).
+    Returns the posterior and the AllPopulations object
+    '''
+    allPops = build_model( config.populations,
+                           cosmo_args ={'dist_unit':u.Gpc},
+                           mass_args=config.mass_args,
+                           spin_args=config.spin_args,
+                           rate_args=config.rate_args)
+    if config.lambdaBase is not None:
+        # Fix values of the parameters to the fiducials chosen
+        allPops.set_values( config.lambdaBase)
+
+    if list(config.data.keys())!=list(config.injections.keys()):
+        raise ValueError('There should be one injection set for each dataset. Got data %s and injections %s' %(str(list(config.data.keys())), str(list(config.injections.keys()))))
+    allData = load_data(config.data)
+    allInjData = load_injections(config.injections)
+
+    myPrior = Prior(config.priorLimits, config.params_inference, config.priorNames, config.priorParams)
+    myLik = HyperLikelihood(allPops, allData, config.params_inference, safety_factor=config.safety_factor)
+    selBias = SelectionBiasInjections(allPops, allInjData, config.params_inference,
+                                      get_uncertainty=config.get_uncertainty, mem_budget_MB=config.mem_budget_MB)
+    myPost = Posterior(myLik, myPrior, selBias, bias_safety_factor=config.bias_safety_factor,
+                       marginalize_R0=config.marginalize_R0, R0_prior=config.R0_prior, R0_limits=config.R0_limits)
+    return myPost, allPops
+
+
+
+def build_surrogate_posterior(config, data_args=None, injections_args=None):
+    '''
+    Builds a cheap version of the posterior from a config module, with extra arguments for all the datasets
+    and injection sets (e.g. {'nSamplesUse': 200} and {'nInjUse': 100000}) to use a subset of the samples and injections.
+    Cuts on the effective number of samples are removed, so that the surrogate is finite wherever the posterior is.
+    Used as surrogate for delayed acceptance (see DelayedAcceptanceMove)
+    '''
+    surrConfig = types.SimpleNamespace(**{key: getattr(config, key) for key in dir(config) if not key.startswith('__')})
+    surrConfig.data = {name: {'fname': specs['fname'], 'args': {**specs.get('args', {}), **(data_args or {})}} for name, specs in config.data.items()}
+    surrConfig.injections = {name: {'fname': specs['fname'], 'args': {**specs.get('args', {}), **(injections_args or {})}} for name, specs in config.injections.items()}
+    surrConfig.safety_factor = 0
+    surrConfig.bias_safety_factor = 0.
+    surrConfig.get_uncertainty = False
+    print('\nBuilding surrogate posterior...')
+    return build_posterior(surrConfig)[0]
+
+
+
+def initial_walkers(posterior, Lambda_ini, nwalkers, eps=1e-02, seed=None, max_tries=1000):
+    '''
+    Starting points of the walkers in a ball of relative size eps around Lambda_ini,
+    redrawing those where the posterior is not finite
+    '''
+    rng = np.random.default_rng(seed)
+    Lambda_ini = np.asarray(Lambda_ini, dtype=float)
+    p0 = Lambda_ini*(1+eps*rng.standard_normal((nwalkers, Lambda_ini.shape[0])))
+    logPosts = posterior.logPosterior_batch(p0)
+    for _ in range(max_tries):
+        bad = ~np.isfinite(logPosts)
+        if not np.any(bad):
+            return p0
+        p0[bad] = Lambda_ini*(1+eps*rng.standard_normal((bad.sum(), Lambda_ini.shape[0])))
+        logPosts[bad] = posterior.logPosterior_batch(p0[bad])
+    raise ValueError('Could not find %s starting points with finite posterior around %s' %(nwalkers, str(Lambda_ini)))
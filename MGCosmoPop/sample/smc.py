@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+#    Copyright (c) 2021 Michele Mancarella <michele.mancarella@unige.ch>
+#
+#    All rights reserved. Use of this source code is governed by a modified BSD
+#    license that can be found in the LICENSE file.
+
+import time
+import numpy as np
+from scipy.optimize import brentq
+import h5py
+
+from .pool import BatchedPosterior
+
+
+
+def _logmeanexp(x):
+    return np.logaddexp.reduce(x)-np.log(x.shape[0])
+
+
+def _log_ess(logw):
+    '''
+    log of the effective sample size of the weights exp(logw)
+    '''
+    return 2*np.logaddexp.reduce(logw)-np.logaddexp.reduce(2*logw)
+
+
+
+class SMCSampler(object):
+
+    '''
+    Sequential Monte Carlo sampler with adaptive tempering, for the evidence of the model and posterior samples.
+    The particles are moved from the prior to the posterior through the tempered targets
+        pi_beta(Lambda) = prior(Lambda) L(Lambda)^beta ,
+    choosing each beta so that the effective sample size of the incremental weights is ess_target times the number of particles with finite likelihood.
+    After each reweighting, particles are resampled and moved with random walk Metropolis steps
+    whose covariance is that of the particles.
+
+    At each step, all the particles are evaluated in one batched call to the posterior
+    (see BatchedPosterior), split between nCores processes.
+
+    The evidence is the product of the mean incremental weights of each stage. It is normalized to the prior,
+    i.e. Z = int L(Lambda) prior(Lambda) dLambda with prior normalized to one,
+    so that evidences of models with different parameters and prior ranges can be compared.
+    The error is estimated as sum_t ( <w_t^2>/<w_t>^2 - 1 )/nParticles, summed over stages
+    (it neglects the correlations introduced by resampling and moves; run independent samplers for a robust estimate).
+
+    Usage:
+
+    mySMC = SMCSampler(myPost, nParticles=2000, nCores=8, seed=1)
+    res = mySMC.run()
+    print(res['logZ'], res['logZ_err'])
+    mySMC.save('smc.h5')
+
+    '''
+
+    def __init__(self, posterior, nParticles=1000, ess_target=0.5, min_moves=2, max_moves=20, move_fraction=0.99,
+                 nCores=1, block_size=None, seed=None):
+        '''
+
+        Parameters
+        ----------
+        posterior : obj of type Posterior
+        nParticles : int
+        ess_target : float
+            target effective sample size at each stage, as a fraction of the number of particles
+            with finite likelihood (nParticles after the first stage)
+        min_moves, max_moves : int
+            minimum and maximum number of Metropolis steps after each resampling
+        move_fraction : float
+            the number of Metropolis steps is chosen so that this fraction of particles
+            is expected to move at least once, given the acceptance rate of the first step
+        nCores : int
+            number of processes used to evaluate the posterior
+        block_size : int, optional
+            maximum number of points per call to Posterior.logPosterior_batch
+        seed : int, optional
+
+        '''
+        self.posterior = posterior
+        self.params_inference = posterior.hyperLikelihood.params_inference
+        self.nParams = len(self.params_inference)
+        self.nParticles = nParticles
+        self.ess_target = ess_target
+        self.min_moves = min_moves
+        self.max_moves = max_moves
+        self.move_fraction = move_fraction
+        self.nCores = nCores
+        self.block_size = block_size
+        self.rng = np.random.default_rng(seed)
+        self.seed = seed
+        self.scale = 2.38/np.sqrt(self.nParams)
+
+
+    def _evaluate(self, pts):
+        '''
+        Returns log prior, log likelihood and blobs
+        '''
+        logPosts, blobs = self.batchedPost(pts)
+        lp = blobs['lp']
+        logL = np.full(lp.shape, -np.inf)
+        inside = np.isfinite(lp)
+        logL[inside] = logPosts[inside]-lp[inside]
+        return lp, logL, blobs
+
+
+    @staticmethod
+    def _logTarget(lp, logL, beta):
+        return lp+np.where(np.isneginf(logL), -np.inf if beta>0 else 0., beta*logL)
+
+
+    def _next_beta(self, logL, beta):
+        '''
+        Finds the next temperature by bisection on the effective sample size of the incremental weights.
+        Particles drawn from the prior outside the support of the likelihood have zero weight at any temperature,
+        so the target is a fraction of the number of particles with finite likelihood
+        (otherwise no temperature reaches it when they are less than ess_target*nParticles)
+        '''
+        finite = np.isfinite(logL)
+        logEssTarget = np.log(self.ess_target*finite.sum())
+        f = lambda dbeta: _log_ess(np.where(finite, dbeta*logL, -np.inf))-logEssTarget
+        if f(1.-beta)>=0:
+            return 1.
+        return beta+brentq(f, 0., 1.-beta, xtol=1e-10)
+
+
+    def _resample(self, logw):
+        '''
+        Systematic resampling. Returns indices of the resampled particles
+        '''
+        w = np.exp(logw-np.logaddexp.reduce(logw))
+        u = (self.rng.uniform()+np.arange(self.nParticles))/self.nParticles
+        return np.minimum(np.searchsorted(np.cumsum(w), u), self.nParticles-1)
+
+
+    def _move(self, x, lp, logL, blobs, beta):
+        '''
+        Random walk Metropolis steps for all the particles at temperature beta
+        '''
+        cov = np.atleast_2d(np.cov(x, rowvar=False))
+        chol = np.linalg.cholesky(cov+1e-12*np.diag(np.diag(cov))+1e-300*np.eye(self.nParams))
+        logTarget = self._logTarget(lp, logL, beta)
+        nMoves, iMove, accs = self.min_moves, 0, []
+        while iMove<nMoves:
+            y = x+self.scale*self.rng.standard_normal(x.shape)@chol.T
+            lpy, logLy, blobsy = self._evaluate(y)
+            logTargety = self._logTarget(lpy, logLy, beta)
+            accept = np.log(self.rng.uniform(size=self.nParticles))<logTargety-logTarget
+            x[accept], lp[accept], logL[accept], blobs[accept], logTarget[accept] = y[accept], lpy[accept], logLy[accept], blobsy[accept], logTargety[accept]
+            acc = accept.mean()
+            accs.append(acc)
+            self.scale *= np.exp(acc-0.234)
+            if iMove==0:
+                nMoves = int(np.clip(np.ceil(np.log(1-self.move_fraction)/np.log(max(1-acc, 1e-300))), self.min_moves, self.max_moves)) if acc<1 else self.min_moves
+            iMove += 1
+        return np.mean(accs), nMoves
+
+
+    def run(self, verbose=True):
+        '''
+        Runs the sampler from the prior to the posterior. Returns the result (see results())
+        '''
+        t0 = time.perf_counter()
+        self.batchedPost = BatchedPosterior(self.posterior, nCores=self.nCores, block_size=self.block_size)
+        try:
+            x = self.posterior.prior.sample(self.nParticles, seed=self.rng.integers(2**32))
+            lp, logL, blobs = self._evaluate(x)
+            if not np.any(np.isfinite(logL)):
+                raise ValueError('Log likelihood is -inf for all the particles drawn from the prior')
+
+            beta, logZ, varLogZ = 0., 0., 0.
+            self.history = {'beta': [], 'ess': [], 'acceptance': [], 'nMoves': [], 'logZ': []}
+            while beta<1.:
+                newBeta = self._next_beta(logL, beta)
+                logw = np.where(np.isfinite(logL), (newBeta-beta)*logL, -np.inf)
+                logZ += _logmeanexp(logw)
+                ess = np.exp(_log_ess(logw))
+                varLogZ += (self.nParticles/ess-1)/self.nParticles
+                beta = newBeta
+
+                idx = self._resample(logw)
+                x, lp, logL, blobs = x[idx], lp[idx], logL[idx], blobs[idx]
+                acc, nMoves = self._move(x, lp, logL, blobs, beta)
+
+                for key, val in zip(['beta', 'ess', 'acceptance', 'nMoves', 'logZ'], [beta, ess, acc, nMoves, logZ]):
+                    self.history[key].append(val)
+                if verbose:
+                    print('Stage %s: beta=%.4e, ESS=%.1f, acceptance=%.3f, moves=%s, logZ=%.4f. Elapsed time %.1f s' %(len(self.history['beta']), beta, ess, acc, nMoves, logZ, time.perf_counter()-t0))
+        finally:
+            self.nEvals = self.batchedPost.nEvals
+            self.batchedPost.close()
+
+        self.samples, self.lp, self.logL, self.blobs = x, lp, logL, blobs
+        self.logZ, self.logZ_err = logZ, np.sqrt(varLogZ)
+        self.runTime = time.perf_counter()-t0
+        if verbose:
+            print('log Z = %.4f +- %.4f. %s stages, %s evaluations of the posterior in %.1f s' %(self.logZ, self.logZ_err, len(self.history['beta']), self.nEvals, self.runTime))
+        return self.results()
+
+
+    def results(self):
+        return {'logZ': self.logZ, 'logZ_err': self.logZ_err,
+                'samples': self.samples, 'logL': self.logL, 'lp': self.lp, 'blobs': self.blobs,
+                'history': {key: np.array(val) for key, val in self.history.items()},
+                'nEvals': self.nEvals}
+
+
+    def save(self, fname):
+        with h5py.File(fname, 'w') as f:
+            f.attrs['params'] = np.array(self.params_inference, dtype='S')
+            f.attrs['logZ'] = self.logZ
+            f.attrs['logZ_err'] = self.logZ_err
+            f.attrs['nEvals'] = self.nEvals
+            f.create_dataset('samples', data=self.samples)
+            f.create_dataset('logL', data=self.logL)
+            f.create_dataset('lp', data=self.lp)
+            f.create_dataset('blobs', data=self.blobs)
+            for key, val in self.history.items():
+                f.create_dataset('history/%s' %key, data=np.array(val))
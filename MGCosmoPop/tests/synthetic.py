@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+#    Copyright (c) 2021 Michele Mancarella <michele.mancarella@unige.ch>
+#
+#    All rights reserved. Use of this source code is governed by a modified BSD
+#    license that can be found in the LICENSE file.
+
+'''
+Small synthetic catalogs and injection sets, used to build posteriors for the tests
+without reading data from disk, and a gaussian posterior to test the samplers.
+'''
+
+import io
+import contextlib
+import numpy as np
+import astropy.units as u
+
+with contextlib.redirect_stdout(io.StringIO()):
+    from population.astro.astroMassDistribution import TruncPowerLawMass, BrokenPowerLawMass
+    from population.astro.rateEvolution import PowerLawRateEvolution, AstroPhRateEvolution
+    from population.astro.astroSpinDistribution import DummySpinDist, GaussSpinDist
+    from population.astro.astroPopulation import AstroPopulation
+    from population.allPopulations import AllPopulations
+    from cosmology.cosmo import Cosmo
+    from posteriors.selectionBias import SelectionBiasInjections
+    from posteriors.likelihood import HyperLikelihood
+    from posteriors.prior import Prior
+    from posteriors.posterior import Posterior
+    from dataStructures.ABSdata import Data
+
+
+priorLimits = { 'H0': (20, 140), 'Om': (0.05, 1), 'w0': (-2, -0.5), 'Xi0': (0.1, 10), 'n': (0, 10),
+                'R0': (1e-03, 1e03), 'lambdaRedshift': (-10, 10), 'alphaRedshift': (-15, 15), 'betaRedshift': (0, 15), 'zp': (0, 4),
+                'alpha': (-4, 12), 'beta': (-4, 12), 'ml': (2, 10), 'mh': (30, 150),
+                'alpha1': (-4, 12), 'alpha2': (-4, 12), 'deltam': (0, 10), 'b': (0, 1),
+                'muEff': (-1, 1), 'sigmaEff': (0.01, 1), 'muP': (0.01, 1), 'sigmaP': (0.01, 1) }
+
+
+
+class Interrupted(Exception):
+    pass
+
+
+
+class GaussPosterior(object):
+
+    '''
+    Gaussian posterior with the interface of Posterior used by the samplers.
+    If nMax is given, Interrupted is raised when more than nMax points have been evaluated,
+    to simulate an interrupted run
+    '''
+
+    blobs_dtype = np.dtype([('lp', np.float64)])
+
+    def __init__(self, mean, cov, nMax=None):
+        self.mean = np.asarray(mean, dtype=float)
+        self.cov = np.atleast_2d(cov)
+        self.icov = np.linalg.inv(self.cov)
+        names = ['x%s' %i for i in range(self.mean.shape[0])]
+        self.hyperLikelihood = type('Lik', (object,), {'params_inference': names})()
+        self.nMax = nMax
+        self.nCalls = 0
+
+    def logPosterior_batch(self, Lambdas, return_blob=False):
+        Lambdas = np.atleast_2d(Lambdas)
+        self.nCalls += Lambdas.shape[0]
+        if self.nMax is not None and self.nCalls>self.nMax:
+            raise Interrupted
+        dx = Lambdas-self.mean
+        logPosts = -0.5*np.einsum('ij,jk,ik->i', dx, self.icov, dx)
+        if not return_blob:
+            return logPosts
+        blobs = np.empty(Lambdas.shape[0], dtype=self.blobs_dtype)
+        blobs['lp'] = 0.1*logPosts
+        return logPosts, blobs
+
+    def logPosterior(self, Lambda_test, return_blob=False):
+        logPosts, blobs = self.logPosterior_batch(Lambda_test, return_blob=True)
+        if return_blob:
+            return logPosts[0], blobs['lp'][0]
+        return logPosts[0]
+
+
+
+class SyntheticData(Data):
+
+    '''
+    Catalog of Nobs events with Ns posterior samples each. The first event has 20 samples less (filled with nan)
+    '''
+
+    def _load_data(self):
+        pass
+
+    def get_theta(self):
+        return np.array([self.m1z, self.m2z, self.dL])
+
+    def __init__(self, rng, Nobs=5, Ns=400, spins=False):
+        self.Nobs = Nobs
+        self.m1z = rng.uniform(15, 60, (Nobs, 1))*(1+0.02*rng.standard_normal((Nobs, Ns)))
+        self.m2z = self.m1z*rng.uniform(0.4, 0.95, (Nobs, Ns))
+        self.dL = rng.uniform(0.3, 2.5, (Nobs, 1))*(1+0.1*rng.standard_normal((Nobs, Ns)))
+        self.m1z[0, -20:], self.m2z[0, -20:], self.dL[0, -20:] = np.nan, np.nan, np.nan
+        self.Nsamples = np.array([Ns-20]+[Ns]*(Nobs-1))
+        self.logNsamples = np.log(self.Nsamples)
+        self.spins = []
+        if spins:
+            self.spins = [rng.uniform(-0.3, 0.5, (Nobs, Ns)), rng.uniform(0.05, 0.6, (Nobs, Ns))]
+            for s in self.spins:
+                s[0, -20:] = np.nan
+        self.Tobs = 1.
+
+    def logOrMassPrior(self):
+        return np.zeros(self.m1z.shape)
+
+    def logOrDistPrior(self):
+        return np.where(~np.isnan(self.dL), 2*np.log(self.dL), 0)
+
+
+
+class SyntheticInjections(Data):
+
+    '''
+    Injections drawn uniformly in detector-frame masses and distance, detected if a rough SNR is above 8
+    '''
+
+    def _load_data(self):
+        pass
+
+    def get_theta(self):
+        pass
+
+    def __init__(self, rng, N=20000, spins=False):
+        self.m1z = rng.uniform(5, 150, N)
+        self.m2z = self.m1z*rng.uniform(0.1, 0.99, N)
+        self.dL = rng.uniform(0.05, 4, N)
+        self.log_weights_sel = np.full(N, -np.log(145*0.89*3.95))
+        self.N_gen = N*3
+        self.logN_gen = np.log(self.N_gen)
+        self.snr = 30*(self.m1z/30)**0.8/self.dL
+        self.condition = self.snr>8
+        self.spins = [rng.uniform(-0.5, 0.5, N), np.full(N, np.nan)] if spins else []
+        self.Tobs = 1.
+        self.dist_unit = u.Gpc
+
+
+
+def build_posterior(params=('H0', 'Xi0', 'R0', 'lambdaRedshift'), mass='trunc', rate='pl', spins=False, seed=0,
+                    safety_factor=1., bias_safety_factor=0., **kwargs):
+    '''
+    Posterior on two synthetic catalogs with one injection set each.
+    mass: 'trunc' or 'bpl'; rate: 'pl' or 'md'.
+    Returns posterior and AllPopulations object
+    '''
+    rng = np.random.default_rng(seed)
+    params = list(params)
+    with contextlib.redirect_stdout(io.StringIO()):
+        massDist = TruncPowerLawMass() if mass=='trunc' else BrokenPowerLawMass()
+        rateEvol = PowerLawRateEvolution() if rate=='pl' else AstroPhRateEvolution()
+        spinDist = GaussSpinDist() if spins else DummySpinDist()
+        allPops = AllPopulations(Cosmo(dist_unit=u.Gpc))
+        allPops.add_pop(AstroPopulation(rateEvol, massDist, spinDist))
+        if mass=='trunc':
+            allPops.set_values({'ml': 3., 'mh': 90., 'alpha': 1.5, 'beta': 0.8})
+        data = [SyntheticData(rng, spins=spins), SyntheticData(rng, Nobs=3, spins=spins)]
+        injData = [SyntheticInjections(rng, spins=spins), SyntheticInjections(rng, N=15000, spins=spins)]
+        priorNames = {p: 'flat' for p in priorLimits}
+        priorNames['R0'], priorNames['Xi0'] = 'flatLog', 'flatLog'
+        prior = Prior(priorLimits, params, priorNames, {})
+        lik = HyperLikelihood(allPops, data, params, safety_factor=safety_factor)
+        selBias = SelectionBiasInjections(allPops, injData, params)
+        post = Posterior(lik, prior, selBias, bias_safety_factor=bias_safety_factor, **kwargs)
+    return post, allPops
@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+#    Copyright (c) 2021 Michele Mancarella <michele.mancarella@unige.ch>
+#
+#    All rights reserved. Use of this source code is governed by a modified BSD
+#    license that can be found in the LICENSE file.
+
+import numpy as np
+import pytest
+
+from sample.backend import StreamingHDFBackend
+from sample.ensembleDriver import EnsembleDriver
+from synthetic import GaussPosterior, Interrupted
+
+
+def _run(fname, nsteps, nMax=None):
+    driver = EnsembleDriver(GaussPosterior(np.zeros(2), np.eye(2), nMax=nMax), nwalkers=8, mode='serial', fname=fname, flush_every=4, seed=3, print_every=1000)
+    driver.run(np.random.RandomState(1).normal(size=(8, 2)), nsteps)
+    return StreamingHDFBackend(fname, read_only=True)
+
+
+def test_resume_across_flush(tmp_path):
+    nsteps = 15
+    ref = _run(str(tmp_path/'ref.h5'), nsteps)
+
+    fname = str(tmp_path/'resumed.h5')
+    # Interrupted in the middle of step 7, after the flush of the first 4 steps
+    with pytest.raises(Interrupted):
+        _run(fname, nsteps, nMax=8*(1+6)+3)
+    assert StreamingHDFBackend(fname, read_only=True).iteration==6
+    res = _run(fname, nsteps)
+
+    assert res.iteration==ref.iteration==nsteps
+    assert np.array_equal(res.get_chain(), ref.get_chain())
+    assert np.array_equal(res.get_log_prob(), ref.get_log_prob())
+    assert np.array_equal(res.get_blobs(), ref.get_blobs())
+    assert np.array_equal(res.accepted, ref.accepted)
+
+
+def test_discard_all_steps(tmp_path):
+    backend = _run(str(tmp_path/'chain.h5'), 8)
+    nw, nd = 8, 2
+    assert backend.get_chain(discard=8).shape==(0, nw, nd)
+    assert backend.get_chain(discard=10, flat=True).shape==(0, nd)
+    assert backend.get_log_prob(discard=8).shape==(0, nw)
+    blobs = backend.get_blobs(discard=8)
+    assert blobs.shape==(0, nw) and blobs.dtype==GaussPosterior.blobs_dtype
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+#    Copyright (c) 2021 Michele Mancarella <michele.mancarella@unige.ch>
+#
+#    All rights reserved. Use of this source code is governed by a modified BSD
+#    license that can be found in the LICENSE file.
+
+import numpy as np
+
+from synthetic import build_posterior
+from posteriors.posteriorCache import CachedPosterior
+
+
+x = np.array([70., 1.3, 20., 2.])
+
+
+def _fill_cache(fname):
+    post, _ = build_posterior()
+    cachedPost = CachedPosterior(post, fname=fname)
+    logPost = cachedPost.logPosterior(x)
+    cachedPost.save()
+    return logPost
+
+
+def test_cache_reloaded(tmp_path):
+    fname = str(tmp_path/'cache.h5')
+    logPost = _fill_cache(fname)
+    post, _ = build_posterior()
+    cachedPost = CachedPosterior(post, fname=fname)
+    assert cachedPost.stats()['size']==1
+    assert cachedPost.logPosterior(x)==logPost
+    assert cachedPost.stats()['nHits']==1
+
+
+def test_cache_invalidated_by_data(tmp_path):
+    fname = str(tmp_path/'cache.h5')
+    _fill_cache(fname)
+
+    # Catalog with the same number of events and samples, different samples
+    post, _ = build_posterior()
+    post.hyperLikelihood.data[1].dL *= 1.01
+    assert CachedPosterior(post, fname=fname).stats()['size']==0
+
+    # Injection set with the same length, different weights
+    post, _ = build_posterior()
+    post.selectionBias.injData[0].log_weights_sel = post.selectionBias.injData[0].log_weights_sel+0.1
+    assert CachedPosterior(post, fname=fname).stats()['size']==0
+
+    # Different snr threshold
+    post, _ = build_posterior()
+    post.selectionBias.injData[1].snr_th = 10.
+    assert CachedPosterior(post, fname=fname).stats()['size']==0
+
+
+def test_cache_key_semianalytic():
+    import io, contextlib
+    from posteriors.selectionBias import SelectionBiasSemiAnalytic
+    from test_selection import ToyNetwork, ToyDetector
+    post, allPops = build_posterior(('H0', 'R0', 'lambdaRedshift'))
+
+    def key(network=None, snr_th=12., zmax=1.5, nMasses=20):
+        if network is None:
+            network = ToyNetwork({'A': ToyDetector(0., 0.), 'B': ToyDetector(1.5, 1.3, duty_cycle=0.8)})
+        with contextlib.redirect_stdout(io.StringIO()):
+            post.selectionBias = SelectionBiasSemiAnalytic(allPops, [network], post.hyperLikelihood.params_inference, [1.], snr_th=snr_th,
+                                                           mmin=3., mmax=90., zmax=zmax, nMasses=nMasses, nz=20, nAngles=2000, seed=1)
+        return CachedPosterior(post).configKey
+
+    ref = key()
+    assert key()==ref
+    assert key(snr_th=10.)!=ref
+    assert key(zmax=2.)!=ref
+    assert key(nMasses=21)!=ref
+    # same detector names, different sensitivity, orientation or duty cycle
+    assert key(ToyNetwork({'A': ToyDetector(0., 0.), 'B': ToyDetector(1., 1.3, duty_cycle=0.8)}))!=ref
+    assert key(ToyNetwork({'A': ToyDetector(0., 0.), 'B': ToyDetector(1.5, 0.7, duty_cycle=0.8)}))!=ref
+    assert key(ToyNetwork({'A': ToyDetector(0., 0.), 'B': ToyDetector(1.5, 1.3, duty_cycle=0.6)}))!=ref
+    assert key(ToyNetwork({'A': ToyDetector(0., 0.), 'C': ToyDetector(1.5, 1.3, duty_cycle=0.8)}))!=ref
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+#    Copyright (c) 2021 Michele Mancarella <michele.mancarella@unige.ch>
+#
+#    All rights reserved. Use of this source code is governed by a modified BSD
+#    license that can be found in the LICENSE file.
+
+import numpy as np
+
+from sample.delayedAcceptance import DelayedAcceptanceMove, QuadraticSurrogate
+from sample.ensembleDriver import EnsembleDriver
+from synthetic import GaussPosterior
+
+
+mean = np.array([1., -2.])
+cov = np.array([[1., 0.95*2.], [0.95*2., 4.]])
+
+
+def _run(surrogate, nwalkers, nsteps, p0):
+    post = GaussPosterior(mean, cov)
+    move = DelayedAcceptanceMove(surrogate)
+    driver = EnsembleDriver(post, nwalkers=nwalkers, mode='vectorize', moves=move, seed=6, print_every=100000)
+    sampler = driver.run(p0, nsteps)
+    return post, move, driver, sampler
+
+
+def test_delayed_acceptance_exact():
+    # Shifted, uncorrelated and wider surrogate: without the second stage the chain would follow it
+    surrogate = QuadraticSurrogate(mean+np.array([0.5, -1.]), np.diag(np.diag(cov)), inflate=2.)
+    p0 = mean+0.1*np.random.RandomState(0).normal(size=(32, 2))
+    post, move, driver, sampler = _run(surrogate, 32, 4000, p0)
+    samples = sampler.get_chain(discard=500, flat=True)
+    assert np.allclose(samples.mean(axis=0), mean, atol=0.15*np.sqrt(np.diag(cov)).max())
+    assert np.allclose(np.cov(samples.T), cov, rtol=0.15)
+
+
+def test_delayed_acceptance_stats():
+    surrogate = QuadraticSurrogate(mean, cov, inflate=2.)
+    p0 = mean+0.1*np.random.RandomState(0).normal(size=(16, 2))
+    post, move, driver, sampler = _run(surrogate, 16, 200, p0)
+    st = move.stats()
+    assert st['nProposals']==16*200
+    # the full posterior is evaluated at the initial points and at the proposals passing the first stage
+    assert st['nFullEvals']==post.nCalls-16
+    assert 0<st['nFullEvals']<st['nProposals']
+    assert np.isclose(st['savedFraction'], 1-st['firstStageAcceptance'])
+    assert np.isclose(st['acceptance'], st['firstStageAcceptance']*st['secondStageAcceptance'])
+    assert np.isclose(st['acceptance']*st['nProposals'], (sampler.acceptance_fraction*200).sum())
+    assert driver.throughput()['nEvals']==st['nFullEvals']
+
+
+class HalfPlaneSurrogate(object):
+
+    def logPosterior_batch(self, Lambdas, return_blob=False):
+        Lambdas = np.atleast_2d(Lambdas)
+        return np.where(Lambdas[:, 0]<5., 0., -np.inf)
+
+
+def test_delayed_acceptance_warns_once(capsys):
+    p0 = mean+0.1*np.random.RandomState(0).normal(size=(8, 2))
+    # the posterior is finite there, the surrogate is not
+    p0[0, 0] = 6.
+    post, move, driver, sampler = _run(HalfPlaneSurrogate(), 8, 20, p0)
+    assert capsys.readouterr().out.count('the surrogate is not finite')==1
+    assert np.all(sampler.get_chain()[:, 0, 0]==6.)
@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+#    Copyright (c) 2021 Michele Mancarella <michele.mancarella@unige.ch>
+#
+#    All rights reserved. Use of this source code is governed by a modified BSD
+#    license that can be found in the LICENSE file.
+
+import numpy as np
+
+from sample.diagnostics import OnlineConvergence
+
+
+def ar1(rng, nwalkers, nsteps, phi):
+    '''Stationary AR(1) chains with unit variance. The integrated autocorrelation time is (1+phi)/(1-phi)'''
+    x = rng.standard_normal((nwalkers, 1))
+    for _ in range(nsteps):
+        x = phi*x+np.sqrt(1-phi**2)*rng.standard_normal((nwalkers, 1))
+        yield x
+
+
+def test_tau_ar1():
+    phi = 0.99
+    tauTrue = (1+phi)/(1-phi)
+    taus = []
+    for seed in range(3):
+        diagnostics = OnlineConvergence(32, 1)
+        for x in ar1(np.random.default_rng(seed), 32, 100000, phi):
+            diagnostics.update(x)
+        assert diagnostics.batch_size>2*tauTrue
+        taus.append(diagnostics.tau()[0])
+    assert abs(np.mean(taus)/tauTrue-1)<0.05
+    assert diagnostics.rhat()[0]<1.01
+
+
+def test_stopping_rule_needs_new_batches():
+    # tau_rtol is so small that only identical estimates are stable
+    diagnostics = OnlineConvergence(8, 1, ntau=1, tau_rtol=1e-12, rhat_th=10., min_steps=0, check_every=100)
+    for x in ar1(np.random.default_rng(0), 8, 20000, 0.9):
+        diagnostics.update(x)
+    assert not diagnostics.check(verbose=False)
+    # no batch completed since the last check: the estimate is the same and must not be used as a reference
+    assert not diagnostics.check(verbose=False)
+    assert diagnostics.history['batches'][-1]==diagnostics.history['batches'][-2]
+
+
+def test_stopping_rule_ar1():
+    phi = 0.95
+    diagnostics = OnlineConvergence(16, 1, ntau=50, tau_rtol=0.05, rhat_th=1.02, min_steps=1000, check_every=100)
+    for x in ar1(np.random.default_rng(1), 16, 100000, phi):
+        diagnostics.update(x)
+        if diagnostics.n%diagnostics.check_every==0 and diagnostics.check(verbose=False):
+            break
+    assert diagnostics.converged
+    history = diagnostics.summary()
+    # the reference estimate was computed on different batches, at least one tau before
+    tau = history['tau'][-1].max()
+    ref = [i for i in range(len(history['step'])-1) if history['step'][i]<=history['step'][-1]-tau and history['batches'][i]!=history['batches'][-1]]
+    assert len(ref)>0
+    assert diagnostics.n>=50*tau
@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+#    Copyright (c) 2021 Michele Mancarella <michele.mancarella@unige.ch>
+#
+#    All rights reserved. Use of this source code is governed by a modified BSD
+#    license that can be found in the LICENSE file.
+
+import numpy as np
+from scipy.optimize import approx_fprime
+
+from synthetic import build_posterior
+from posteriors.selectionEmulator import GPEmulator, EmulatedSelectionBias
+
+
+def test_gp_gradient():
+    rng = np.random.default_rng(0)
+    X = rng.standard_normal((40, 3))
+    y = np.sin(X[:, 0])+X[:, 1]**2
+    noise = np.full(40, 1e-03)
+    gp = GPEmulator()
+    logHyp = np.array([0.2, -0.3, 0.5, 0.1])
+    _, grad = gp._neg_log_marg_lik(logHyp, X, y, noise)
+    fd = approx_fprime(logHyp, lambda h: gp._neg_log_marg_lik(h, X, y, noise)[0], 1e-06)
+    assert np.allclose(grad, fd, rtol=1e-04, atol=1e-03)
+
+
+def test_emulator_vs_MC():
+    post, _ = build_posterior()
+    selBias = post.selectionBias
+    emuBias = EmulatedSelectionBias(selBias, max_std=0.01, min_points=50)
+    rng = np.random.default_rng(1)
+    x0, scale = np.array([70., 1.3, 20., 2.]), np.array([5., 0.1, 3., 0.3])
+    for _ in range(200):
+        emuBias.Ndet(x0+scale*rng.standard_normal(4))
+    assert np.all(emuBias.usage_summary()['fracEmulated']>0.3)
+
+    emuBias.reset_usage()
+    for _ in range(50):
+        x = x0+scale*rng.standard_normal(4)
+        muEmu, _, _ = emuBias.Ndet(x)
+        muMC, _, NeffMC = selBias.Ndet(x)
+        # Emulated mu within the MC uncertainty sigma_mu/mu = Neff^(-1/2)
+        assert np.all(np.abs(np.array(muEmu)/np.array(muMC)-1)<2/np.sqrt(np.array(NeffMC)))
+    assert np.all(emuBias.usage_summary()['nEmulated']>0)
@@ -0,0 +1,40 @@
+#!/usr/bin/env python3
+#    Copyright (c) 2021 Michele Mancarella <michele.mancarella@unige.ch>
+#
+#    All rights reserved. Use of this source code is governed by a modified BSD
+#    license that can be found in the LICENSE file.
+
+import numpy as np
+
+from posteriors.prior import Prior
+from posteriors.forecast import LaplaceForecast
+
+
+class NarrowPosterior(object):
+
+    '''
+    Posterior much narrower than the prior range, with a quartic term:
+    finite differences over a fraction of the prior width overestimate the curvature
+    '''
+
+    def __init__(self):
+        params = ['a', 'b']
+        self.prior = Prior({'a': (0., 1000.), 'b': (-5., 5.)}, params, {'a': 'flat', 'b': 'flat'}, {})
+        self.hyperLikelihood = type('Lik', (object,), {'params_inference': params})()
+        self.mu, self.sigma = np.array([500., 0.]), np.array([0.2, 1.])
+        self.rho = 0.5
+
+    def logPosterior_batch(self, Lambdas):
+        d = (Lambdas-self.mu)/self.sigma
+        return -(d[:, 0]**2-2*self.rho*d[:, 0]*d[:, 1]+d[:, 1]**2)/(2*(1-self.rho**2))-d[:, 0]**4
+
+
+def test_hessian_step():
+    post = NarrowPosterior()
+    forecast = LaplaceForecast(post)
+    forecast.xMAP = post.mu
+    cov = forecast.compute_covariance()
+    expected = np.array([[1., post.rho], [post.rho, 1.]])*np.outer(post.sigma, post.sigma)
+    assert np.allclose(cov, expected, rtol=0.05)
+    # Steps follow the width of the posterior, not the value of the parameters
+    assert np.all(forecast.step<0.2*post.sigma)
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+#    Copyright (c) 2021 Michele Mancarella <michele.mancarella@unige.ch>
+#
+#    All rights reserved. Use of this source code is governed by a modified BSD
+#    license that can be found in the LICENSE file.
+
+import warnings
+import numpy as np
+import pytest
+
+from synthetic import build_posterior
+
+
+# Smooth models. With hard edges in the mass function (e.g. TruncPowerLawMass) the MC sums are discontinuous
+# in the parameters that move the edges, so finite differences are not a reference there
+cases = [ (dict(params=['H0', 'Om', 'w0', 'Xi0', 'n', 'R0', 'alphaRedshift', 'betaRedshift', 'zp', 'alpha1', 'beta', 'deltam'], mass='bpl', rate='md'),
+           [70., 0.3, -0.9, 1.3, 2., 20., 1.1, 2.6, 2.4, 1.6, 1.4, 4.8]),
+          (dict(params=['R0', 'muEff', 'sigmaEff', 'muP', 'sigmaP'], spins=True), [20., 0.05, 0.2, 0.2, 0.1]),
+        ]
+
+
+def finite_difference(post, x, eps=1e-05):
+    grad = np.empty(len(x))
+    for i in range(len(x)):
+        h = eps*max(abs(x[i]), 1.)
+        xp, xm = np.array(x, dtype=float), np.array(x, dtype=float)
+        xp[i] += h
+        xm[i] -= h
+        grad[i] = (post.logPosterior(list(xp))-post.logPosterior(list(xm)))/(2*h)
+    return grad
+
+
+@pytest.mark.parametrize('kwargs, x', cases)
+def test_gradient_vs_finite_difference(kwargs, x):
+    post, _ = build_posterior(**kwargs)
+    with warnings.catch_warnings():
+        warnings.simplefilter('error', RuntimeWarning)
+        logPost, grad = post.logPosterior(x, return_grad=True)
+    assert np.isfinite(logPost)
+    assert logPost==pytest.approx(post.logPosterior(x))
+    np.testing.assert_allclose(grad, finite_difference(post, x), rtol=1e-03, atol=1e-03)
+
+
+def test_gradient_outside_support():
+    # mh below some of the source-frame masses: part of the samples and injections are outside the support
+    params = ['H0', 'Xi0', 'R0', 'lambdaRedshift', 'alpha', 'beta', 'ml', 'mh']
+    x = [70., 1.3, 20., 2., 1.5, 0.8, 3., 45.]
+    post, _ = build_posterior(params=params)
+    with warnings.catch_warnings():
+        warnings.simplefilter('error', RuntimeWarning)
+        logPost, grad = post.logPosterior(x, return_grad=True)
+    assert np.isfinite(logPost) and np.all(np.isfinite(grad))
+    smooth = [params.index(p) for p in ('R0', 'lambdaRedshift', 'alpha', 'beta')]
+    np.testing.assert_allclose(grad[smooth], finite_difference(post, x)[smooth], rtol=1e-03, atol=1e-03)
+
+
+def five_point(f, x, i, h):
+    '''Fourth-order central finite difference of f wrt the i-th entry of x'''
+    def at(d):
+        y = np.array(x, dtype=float)
+        y[i] += d
+        return f(y)
+    return (-at(2*h)+8*at(h)-8*at(-h)+at(-2*h))/(12*h)
+
+
+def test_broken_power_law_gradients():
+    from population.astro.astroMassDistribution import BrokenPowerLawMass
+    massDist = BrokenPowerLawMass()
+    lam = [1.6, 5.6, 1.4, 4.8, 4., 87., 0.43]
+    rng = np.random.default_rng(1)
+    m1 = rng.uniform(4.5, 80, 200)
+    m2 = rng.uniform(4.1, m1)
+    grad = massDist.grad_logpdf([m1, m2], lam)
+    for i in range(len(lam)):
+        num = five_point(lambda l: massDist.logpdf([m1, m2], list(l)), lam, i, 1e-03*max(abs(lam[i]), 1.))
+        np.testing.assert_allclose(grad[i], num, rtol=1e-04, atol=1e-04)
+    grad = massDist.grad_logpdf_theta([m1, m2], lam)
+    for i in range(2):
+        num = five_point(lambda th: massDist.logpdf(list(th), lam), [m1, m2], i, 1e-04)
+        np.testing.assert_allclose(grad[i], num, rtol=1e-04, atol=1e-03)
+
+
+def test_mass_derivatives():
+    from population.astro.astroMassDistribution import TruncPowerLawMass, AstroSmoothPowerLawMass
+    rng = np.random.default_rng(2)
+    m1 = rng.uniform(6., 40., 100)
+    m2 = rng.uniform(5.5, m1)
+    # TruncPowerLawMass is analytic, AstroSmoothPowerLawMass uses the finite difference of the base class
+    for massDist, lam in ( (TruncPowerLawMass(), [0.75, 0.5, 4., 78.5]), 
+                           (AstroSmoothPowerLawMass(), [0.75, 0.5, 5., 0.1, 45., 0.1]) ):
+        grad = massDist.grad_logpdf_theta([m1, m2], lam)
+        for i in range(2):
+            num = five_point(lambda th: massDist.logpdf(list(th), lam), [m1, m2], i, 1e-03)
+            np.testing.assert_allclose(grad[i], num, rtol=1e-05, atol=1e-06)
+
+
+def test_cosmology_gradients():
+    import astropy.units as u
+    from scipy.optimize import brentq
+    from cosmology.cosmo import Cosmo
+    cosmo = Cosmo(dist_unit=u.Gpc)
+    z = np.array([0.05, 0.3, 1., 2.5])
+    lam = [68., 0.32, -0.9, 1.4, 1.7]
+    dL = cosmo.dLGW(z, *lam)
+    for i,param in enumerate(cosmo.params):
+        h = 1e-03*max(abs(lam[i]), 1.)
+        num = five_point(lambda l: cosmo.log_dV_dz(z, *l[:3]), lam, i, h)
+        np.testing.assert_allclose(cosmo.grad_log_dV_dz(z, *lam[:3], params=[param])[0], num, rtol=1e-05, atol=1e-08)
+        num = five_point(lambda l: cosmo.log_ddL_dz(z, *l, dL=dL), lam, i, h)
+        np.testing.assert_allclose(cosmo.grad_log_ddL_dz(z, dL, *lam, params=[param])[0], num, rtol=1e-05, atol=1e-08)
+        zinv = lambda l: np.array([brentq(lambda zz: cosmo.dLGW(zz, *l)-d, 1e-06, 20, xtol=1e-14) for d in dL])
+        np.testing.assert_allclose(cosmo.grad_z_from_dLGW(z, dL, *lam, params=[param])[0], five_point(zinv, lam, i, h), rtol=1e-05, atol=1e-08)
+    # derivatives wrt z at fixed parameters
+    num = five_point(lambda zz: cosmo.log_dV_dz(zz, *lam[:3]), z, slice(None), 1e-04)
+    np.testing.assert_allclose(cosmo.grad_log_dV_dz(z, *lam[:3], params=['z'])[0], num, rtol=1e-05)
+    num = five_point(lambda zz: cosmo.log_ddL_dz(zz, *lam, dL=dL), z, slice(None), 1e-04)
+    np.testing.assert_allclose(cosmo.grad_log_ddL_dz(z, dL, *lam, params=['z'])[0], num, rtol=1e-05)
+
+
+@pytest.mark.parametrize('mass, rate', [('trunc', 'pl'), ('bpl', 'md')])
+def test_population_redshift_derivative(mass, rate):
+    from population.ABSpopulation import Population
+    _, allPops = build_posterior(mass=mass, rate=rate)
+    pop = allPops._pops[0]
+    LambdaPop = [pop.baseValues[p] for p in pop.params]
+    rng = np.random.default_rng(3)
+    z = rng.uniform(0.1, 1., 50)
+    m1z = rng.uniform(12., 50., 50)
+    m2z = rng.uniform(10., m1z)
+    f = lambda zz: pop.log_dR_dm1dm2(m1z/(1+zz), m2z/(1+zz), zz, [], LambdaPop)
+    num = five_point(f, z, slice(None), 1e-04)
+    np.testing.assert_allclose(pop.dlog_dR_dm1dm2_dz(m1z/(1+z), m2z/(1+z), z, [], LambdaPop), num, rtol=1e-04, atol=1e-05)
+    # finite-difference fallback of the base class
+    np.testing.assert_allclose(Population.dlog_dR_dm1dm2_dz(pop, m1z/(1+z), m2z/(1+z), z, [], LambdaPop), num, rtol=1e-04, atol=1e-05)
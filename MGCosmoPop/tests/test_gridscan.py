@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+#    Copyright (c) 2021 Michele Mancarella <michele.mancarella@unige.ch>
+#
+#    All rights reserved. Use of this source code is governed by a modified BSD
+#    license that can be found in the LICENSE file.
+
+import numpy as np
+from scipy.optimize import minimize
+
+from synthetic import build_posterior
+from posteriors.gridScan import GridScan, _init_worker
+
+
+def test_profile_scan(tmp_path):
+    post, _ = build_posterior()
+    x0 = np.array([70., 1.3, 20., 2.])
+    grid = {'H0': np.array([55., 70., 85.])}
+    fixed = GridScan(post, grid, x0).run()['logPost']
+    # Blocks of two points: the last point starts from the optimum of the previous block
+    scan = GridScan(post, grid, x0, profile=True, block_size=2, fname=str(tmp_path/'scan.h5'))
+    res = scan.run()
+    assert np.all(res['logPost']>=fixed)
+    nbr, starts = scan._neighbours(np.array([2]))
+    assert nbr[0]==-1 and np.array_equal(starts[0], res['best'][1])
+
+    # At least as good as a derivative-free optimization of logPosterior started from x0
+    x = x0.copy()
+    def negLogPost(y):
+        x[1:] = y
+        return -post.logPosterior(x)
+    x[0] = grid['H0'][1]
+    ref = minimize(negLogPost, x0[1:], method='Nelder-Mead', options={'xatol': 1e-06, 'fatol': 1e-08, 'maxiter': 5000})
+    assert res['logPost'][1]>=-ref.fun-1e-04
+
+
+class RecordingPool(object):
+    '''
+    Runs the tasks in the main process, recording the blocks of each call to imap_unordered and their starting points
+    '''
+    def __init__(self, posterior):
+        _init_worker(posterior)
+        self.waves, self.starts = [], {}
+
+    def imap_unordered(self, worker, tasks):
+        self.waves.append([task[0] for task in tasks])
+        for task in tasks:
+            self.starts[task[0]] = task[4]
+        return map(worker, tasks)
+
+
+def test_profile_scan_waves(tmp_path):
+    post, _ = build_posterior()
+    x0 = np.array([70., 1.3, 20., 2.])
+    grid = {'H0': np.array([55., 65., 75.]), 'Xi0': np.array([0.8, 1.3])}
+    scan = GridScan(post, grid, x0, profile=True, block_size=2, nCores=2)
+    # Blocks are rows of H0: the point at Xi0=0.8 starts from the optimum at the previous H0, the one at Xi0=1.3 from the point before it
+    assert np.array_equal(scan._dependencies(0), []) and np.array_equal(scan._dependencies(1), [0]) and np.array_equal(scan._dependencies(2), [1])
+
+    pool = RecordingPool(post)
+    res = {}
+    for iBlock, logPosts, best in scan._waves(pool, np.arange(scan.nBlocks)):
+        flat = scan._points(iBlock)[0]
+        scan.logPost[flat], scan.best[flat] = logPosts, best
+        scan.done[iBlock] = True
+        res[iBlock] = best
+    # The first wave is completed with block 1; block 2 waits for it
+    assert pool.waves==[[0, 1], [2]]
+    assert np.all(np.isnan(pool.starts[1]))
+    assert np.array_equal(pool.starts[2][0], res[1][0]) and np.all(np.isnan(pool.starts[2][1]))
+
+    # Same scan with a pool of processes
+    serial = GridScan(post, grid, x0, profile=True, block_size=2).run()
+    parallel = GridScan(post, grid, x0, profile=True, block_size=2, nCores=2, fname=str(tmp_path/'scan.h5')).run()
+    assert np.allclose(parallel['logPost'], serial['logPost'], rtol=0, atol=1e-04)
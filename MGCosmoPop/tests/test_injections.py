@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+#    Copyright (c) 2021 Michele Mancarella <michele.mancarella@unige.ch>
+#
+#    All rights reserved. Use of this source code is governed by a modified BSD
+#    license that can be found in the LICENSE file.
+
+import numpy as np
+import pytest
+
+from synthetic import SyntheticInjections, build_posterior
+from dataStructures.mockData import GWMockInjectionsData
+from dataStructures.O3adata import O3InjectionsData
+from dataStructures.O3bdata import O3InjectionsData as O3bInjectionsData
+from dataStructures.O1O2data import O1O2InjectionsData
+from dataStructures.multiRunInjections import MultiRunInjectionsData
+from dataStructures.pooledInjections import PooledInjectionsData
+from posteriors.selectionBias import SelectionBiasInjections
+
+
+def _injections(seed, N=5000, snr=True):
+    injData = SyntheticInjections(np.random.default_rng(seed), N=N)
+    if snr:
+        # Sorted by decreasing snr, as GWMockInjectionsData does
+        injData.snr_sel = injData.snr
+        injData.snr_th = 8.
+        injData._apply_condition(np.argsort(-injData.snr_sel, kind='stable'), verbose=False)
+        injData.condition = injData.snr_sel>8
+    return injData
+
+
+def test_snr_threshold_does_not_copy_store(tmp_path):
+    injData = _injections(0)
+    injData.save_compact(str(tmp_path))
+    mock = GWMockInjectionsData(str(tmp_path), snr_th=12.)
+    assert isinstance(mock.m1z, np.memmap) and isinstance(mock.log_weights_sel, np.memmap)
+    assert mock.m1z.shape[0]==np.sum(injData.snr_sel>12.)
+    assert np.all(mock.snr_sel>12.)
+
+
+def test_snr_threshold_without_snr(tmp_path):
+    _injections(0, snr=False).save_compact(str(tmp_path))
+    with pytest.raises(ValueError):
+        GWMockInjectionsData(str(tmp_path), snr_th=12.)
+
+
+def _ifar_store(path):
+    injData = _injections(0, snr=False)
+    injData.ifar_th = 1.
+    injData.save_compact(path)
+
+
+def test_which_spins_checked(tmp_path):
+    _ifar_store(str(tmp_path))
+    assert O3InjectionsData(str(tmp_path), which_spins='skip').spins==[]
+    with pytest.raises(ValueError):
+        O3InjectionsData(str(tmp_path), which_spins='chiEff')
+    with pytest.raises(ValueError):
+        O1O2InjectionsData(str(tmp_path), which_spins='chiEff')
+
+
+def test_compact_store_options_checked(tmp_path):
+    _ifar_store(str(tmp_path))
+    assert O3InjectionsData(str(tmp_path), ifar_th=1.).ifar_th==1.
+    # the threshold and the number of injections used cannot be changed on the stored injections
+    for kwargs in (dict(ifar_th=2.), dict(nInjUse=1000)):
+        for InjClass in (O3InjectionsData, O3bInjectionsData, O1O2InjectionsData):
+            with pytest.raises(ValueError):
+                InjClass(str(tmp_path), **kwargs)
+    # injections selected with a snr threshold have no ifar threshold
+    path = str(tmp_path/'snr')
+    _injections(0).save_compact(path)
+    with pytest.raises(ValueError):
+        O3InjectionsData(path)
+    with pytest.raises(ValueError):
+        GWMockInjectionsData(path, nInjUse=1000)
+
+
+def test_merged_store(tmp_path):
+    path = str(tmp_path/'merged')
+    injData = [_injections(0), _injections(1, N=3000)]
+    merged = MultiRunInjectionsData(injData, path=path)
+    assert isinstance(merged.m1z, np.memmap) and isinstance(injData[1].m1z, np.memmap)
+    m1z = np.array(merged.m1z)
+
+    # The store is re-used for the same runs, and rejected for different ones
+    injData = [_injections(0), _injections(1, N=3000)]
+    merged = MultiRunInjectionsData(injData, path=path)
+    assert np.array_equal(merged.m1z, m1z)
+    assert np.array_equal(injData[1].m1z, m1z[merged.offsets[1]:])
+    with pytest.raises(ValueError):
+        MultiRunInjectionsData([_injections(0), _injections(1, N=2000)], path=path)
+    # same counts and N_gen, different content
+    injData = [_injections(0), _injections(1, N=3000)]
+    injData[1].dL = injData[1].dL*1.01
+    with pytest.raises(ValueError):
+        MultiRunInjectionsData(injData, path=path)
+
+
+_logp_masses = -np.log(145*0.89)
+
+
+def _log_p_draw_uniform(m1z, m2z, dL, spins):
+    return np.full(dL.shape, _logp_masses-np.log(3.95))
+
+
+def _log_p_draw_dL2(m1z, m2z, dL, spins):
+    return _logp_masses+np.log(3*dL**2/(4**3-0.05**3))
+
+
+def _injections_dL2(seed, N=20000):
+    # Same masses as SyntheticInjections, distances drawn from p(dL) ~ dL^2
+    injData = SyntheticInjections(np.random.default_rng(seed), N=N)
+    injData.dL = (0.05**3+np.random.default_rng(seed+100).uniform(size=N)*(4**3-0.05**3))**(1/3)
+    injData.log_weights_sel = _log_p_draw_dL2(injData.m1z, injData.m2z, injData.dL, [])
+    injData.snr = 30*(injData.m1z/30)**0.8/injData.dL
+    injData.condition = injData.snr>8
+    return injData
+
+
+def test_pooled_mu():
+    post, allPops = build_posterior()
+    params, Lambda = post.hyperLikelihood.params_inference, [70., 1., 20., 1.]
+
+    def Ndet(injData):
+        mu, _, Neff = SelectionBiasInjections(allPops, [injData], params, get_uncertainty=False).Ndet(Lambda)
+        return mu[0], mu[0]/np.sqrt(Neff[0])
+
+    (muA, errA), (muB, errB) = Ndet(_injections(0, N=20000, snr=False)), Ndet(_injections_dL2(1))
+    assert abs(muA-muB)<4*np.hypot(errA, errB)
+
+    injData = [_injections(0, N=20000, snr=False), _injections_dL2(1)]
+    NA, NB = injData[0].N_gen, injData[1].N_gen
+    # Without draw probabilities, weighted average of the single-set estimates
+    muPooled, _ = Ndet(PooledInjectionsData(injData))
+    assert np.isclose(muPooled, (NA*muA+NB*muB)/(NA+NB), rtol=1e-10)
+    # Mixture: same selection function, estimated from a single set of N_gen injections
+    injData = [_injections(0, N=20000, snr=False), _injections_dL2(1)]
+    muMix, errMix = Ndet(PooledInjectionsData(injData, log_p_draw_funcs=[_log_p_draw_uniform, _log_p_draw_dL2]))
+    for mu, err in ((muA, errA), (muB, errB)):
+        assert abs(muMix-mu)<4*np.hypot(errMix, err)
+    assert errMix<min(errA, errB)
+
+
+def test_pooled_criteria_checked():
+    injSNR, injIFAR = _injections(0), _injections(1, snr=False)
+    injIFAR.ifar_th = 1.
+    with pytest.raises(ValueError):
+        PooledInjectionsData([injSNR, injIFAR])
+    injOther = _injections(2)
+    injOther.snr_th = 12.
+    with pytest.raises(ValueError):
+        PooledInjectionsData([_injections(0), injOther])
+    assert PooledInjectionsData([_injections(0), _injections(3)]).snr_th==8.
+
+
+def test_condition_applied_once():
+    _, allPops = build_posterior()
+    params, Lambda = ['H0', 'R0', 'lambdaRedshift'], [70., 20., 2.]
+    injData = SyntheticInjections(np.random.default_rng(0))
+    condition = injData.condition.copy()
+    # Baseline: all the injections, with zero weight for the ones not detected
+    masked = SyntheticInjections(np.random.default_rng(0))
+    masked.log_weights_sel = np.where(condition, masked.log_weights_sel, np.inf)
+    masked.condition = True
+
+    selBias = SelectionBiasInjections(allPops, [injData], params)
+    assert injData.condition is True
+    for arr in (injData.m1z, injData.m2z, injData.dL, injData.log_weights_sel):
+        assert arr.shape==(condition.sum(), ) and arr.flags['C_CONTIGUOUS']
+    arrays = (injData.m1z, injData.dL, injData.log_weights_sel)
+    with np.errstate(invalid='ignore'):
+        ref = SelectionBiasInjections(allPops, [masked], params).Ndet(Lambda)
+    for res, r in zip(selBias.Ndet(Lambda), ref):
+        assert np.allclose(res, r, rtol=1e-10)
+    # Neither the evaluation nor a new selection bias object filter the injections again
+    SelectionBiasInjections(allPops, [injData], params).Ndet(Lambda)
+    assert all(a is b for a, b in zip(arrays, (injData.m1z, injData.dL, injData.log_weights_sel)))
+
+
+def test_snr_sweep_equals_Ndet(tmp_path):
+    _, allPops = build_posterior()
+    params, Lambda = ['H0', 'R0', 'lambdaRedshift'], [70., 20., 2.]
+    _injections(0, N=20000).save_compact(str(tmp_path))
+    injData = GWMockInjectionsData(str(tmp_path))
+    # One threshold equal to the snr of an injection, which is not detected
+    snr_ths = np.array([6., 8., injData.snr_sel[500], 12., 20.])
+    selBias = SelectionBiasInjections(allPops, [injData], params)
+    mus, errs, Neffs = selBias.Ndet_snr_sweep(Lambda, snr_ths)
+    assert np.all(np.isnan([mus[0][0], errs[0][0], Neffs[0][0]]))
+    for k, snr_th in enumerate(snr_ths[1:], start=1):
+        # Baseline: injections loaded with the threshold, one evaluation per threshold
+        mock = GWMockInjectionsData(str(tmp_path), snr_th=snr_th)
+        assert mock.m1z.shape[0]==np.sum(injData.snr_sel>snr_th)
+        mu, err, Neff = SelectionBiasInjections(allPops, [mock], params).Ndet(Lambda)
+        assert np.allclose([mus[0][k], errs[0][k], Neffs[0][k]], [mu[0], err[0], Neff[0]], rtol=1e-10)
+
+    # Injections not sorted by snr give the same result
+    perm = np.random.default_rng(1).permutation(injData.m1z.shape[0])
+    injData._apply_condition(perm, verbose=False)
+    for res, ref in zip(selBias.Ndet_snr_sweep(Lambda, snr_ths), (mus, errs, Neffs)):
+        assert np.allclose(res[0][1:], ref[0][1:], rtol=1e-10)
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+#    Copyright (c) 2021 Michele Mancarella <michele.mancarella@unige.ch>
+#
+#    All rights reserved. Use of this source code is governed by a modified BSD
+#    license that can be found in the LICENSE file.
+
+import numpy as np
+import pytest
+from scipy.integrate import simpson
+
+from synthetic import build_posterior, priorLimits
+
+
+def _marginal_and_numerical(get_uncertainty):
+    Lambda = [70., 1., 2.]
+    with pytest.warns(UserWarning, match='fiducial value'):
+        marg, _ = build_posterior(params=('H0', 'Xi0', 'lambdaRedshift'), marginalize_R0=True, R0_prior='flatLog', R0_limits=priorLimits['R0'])
+    full, _ = build_posterior(params=('H0', 'Xi0', 'R0', 'lambdaRedshift'))
+    marg.selectionBias.get_uncertainty = full.selectionBias.get_uncertainty = get_uncertainty
+    logPost, _, lls, mus, errs, Neffs = marg.logPosterior(Lambda, return_blob=True)
+
+    # Integral over R0 of the posterior with R0 among the parameters (flatLog prior on R0), 
+    # on a grid in log R0 covering the gamma distribution of R0
+    M = mus.sum()/marg.R0_fid
+    k = marg._Nobs_tot-1
+    logR0 = np.linspace(np.log(0.05*(k+1)/M), np.log(5*(k+1)/M), 101)
+    logPosts = full.logPosterior_batch(np.array([[Lambda[0], Lambda[1], np.exp(x), Lambda[2]] for x in logR0]))
+    c = logPosts.max()
+    logPostNum = c+np.log(simpson(np.exp(logPosts-c+logR0), x=logR0))
+    correction = (k+1)*(k+2)/2*((mus/marg.R0_fid)**2/Neffs).sum()/M**2
+    return logPost, logPostNum, correction
+
+
+def test_marginal_R0_exact():
+    logPost, logPostNum, _ = _marginal_and_numerical(False)
+    assert abs(logPost-logPostNum)<1e-06
+
+
+def test_marginal_R0_uncertainty():
+    # The correction (k+1)(k+2)/(2 Neff_tot) is the first order in 1/Neff of the integral 
+    # of the likelihood with the error term of each dataset
+    logPost, logPostNum, correction = _marginal_and_numerical(True)
+    assert correction>0.01
+    assert abs(logPost-logPostNum)<0.02*correction
+    assert abs(logPost-correction-logPostNum)>0.5*correction
+
+
+def test_marginal_R0_checks():
+    with pytest.raises(ValueError):
+        build_posterior(params=('H0', 'Xi0', 'R0', 'lambdaRedshift'), marginalize_R0=True)
+    with pytest.raises(ValueError):
+        build_posterior(params=('H0', 'Xi0', 'lambdaRedshift'), marginalize_R0=True, R0_limits=(10., 1.))
+    with pytest.raises(ValueError):
+        build_posterior(params=('H0', 'Xi0', 'lambdaRedshift'), marginalize_R0=True, R0_prior='gauss')
+
+
+def test_blobs():
+    post, _ = build_posterior()
+    nData = len(post.hyperLikelihood.data)
+    dtype = post.blobs_dtype
+    assert dtype.names==('lp', 'lls', 'mus', 'errs', 'Neffs')
+    assert dtype['lp'].shape==() and all(dtype[name].shape==(nData, ) for name in dtype.names[1:])
+    assert all(dtype[name].base==np.float64 for name in dtype.names)
+
+    x, xOut = np.array([70., 1.3, 20., 2.]), np.array([500., 1.3, 20., 2.])
+    res = post.logPosterior(x, return_blob=True)
+    logPost, lp, lls, mus, errs = post.logPosterior(x, return_all=True)
+    assert res[0]==logPost and res[1]==lp
+    for comp, ref in zip(res[2:], (lls, mus, errs, post.selectionBias.Ndet(x)[2])):
+        assert comp.dtype==np.float64 and np.array_equal(comp, ref)
+    blob = np.array([res[1:]], dtype=dtype)
+    assert np.allclose(post.logPosterior_from_blobs(blob), logPost, rtol=1e-12)
+
+    # Outside the prior: same record layout, with NaN components
+    resOut = post.logPosterior(xOut, return_blob=True)
+    assert resOut[0]==resOut[1]==-np.inf
+    rejected = post._rejected_blob(-np.inf)
+    assert len(rejected)==len(dtype.names)
+    for comp, ref in zip(resOut[1:], rejected):
+        assert np.shape(comp)==np.shape(ref) and np.array_equal(comp, ref, equal_nan=True)
+    blobOut = np.array([resOut[1:]], dtype=dtype)
+    assert np.all(np.isnan(blobOut['Neffs'])) and post.logPosterior_from_blobs(blobOut)[0]==-np.inf
+
+    # The batched posterior returns the same records
+    logPosts, blobs = post.logPosterior_batch(np.array([x, xOut]), return_blob=True)
+    assert blobs.dtype==dtype and logPosts[1]==-np.inf
+    assert np.allclose(logPosts[0], logPost, rtol=1e-8)
+    for name in dtype.names:
+        assert np.allclose(blobs[name], np.concatenate([blob, blobOut])[name], rtol=1e-8, equal_nan=True)
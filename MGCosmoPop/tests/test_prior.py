@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+#    Copyright (c) 2021 Michele Mancarella <michele.mancarella@unige.ch>
+#
+#    All rights reserved. Use of this source code is governed by a modified BSD
+#    license that can be found in the LICENSE file.
+
+import numpy as np
+from scipy.stats import truncnorm
+
+from posteriors.prior import Prior
+
+
+params = ['H0', 'Xi0', 'R0', 'lambdaRedshift']
+priorLimits = {'H0': (20, 140), 'Xi0': (0.1, 10), 'R0': (1e-03, 1e03), 'lambdaRedshift': (-10, 10)}
+priorNames = {'H0': 'gauss', 'Xi0': 'flatLog', 'R0': 'flatLog', 'lambdaRedshift': 'flat'}
+priorParams = {'H0': {'mu': 67.9, 'sigma': 30.}}
+
+
+def _logPrior_scalar(prior, Lambda_test):
+    '''
+    Loop over parameters, as in the original implementation of Prior.logPrior
+    '''
+    for i, param in enumerate(prior.params_inference):
+        limInf, limSup = prior.priorLimits[param]
+        if not limInf<Lambda_test[i]<limSup:
+            return -np.inf
+    lp = 0
+    for i, param in enumerate(prior.params_inference):
+        x = Lambda_test[i]
+        if prior.priorNames[param]=='flatLog':
+            lp += -np.log(x)
+        elif prior.priorNames[param]=='gauss':
+            mu, sigma = prior.priorParams[param]['mu'], prior.priorParams[param]['sigma']
+            lp += -np.inf if np.abs(x-mu)>7*sigma else -np.log(sigma)-(x-mu)**2/(2*sigma**2)
+    return lp
+
+
+def test_logPrior_vectorized():
+    prior = Prior(priorLimits, params, priorNames, priorParams)
+    rng = np.random.default_rng(0)
+    lo, hi = prior._limInf, prior._limSup
+    # points inside and outside the range, and on the limits
+    x = lo-0.1*(hi-lo)+1.2*(hi-lo)*rng.uniform(size=(2000, len(params)))
+    x[:10] = lo
+    x[10:20] = hi
+    x[20:30] = rng.uniform(lo, hi, size=(10, len(params)))
+    x[20:25, 2] = lo[2]
+    lp = prior.logPrior(x)
+    lpScalar = np.array([_logPrior_scalar(prior, xi) for xi in x])
+    assert np.any(np.isfinite(lp)) and np.any(~np.isfinite(lp))
+    assert np.array_equal(np.isfinite(lp), np.isfinite(lpScalar))
+    assert np.allclose(lp[np.isfinite(lp)], lpScalar[np.isfinite(lp)], rtol=1e-14)
+    # single point
+    lpSingle = np.array([prior.logPrior(list(xi)) for xi in x[:50]])
+    assert np.allclose(lpSingle, lpScalar[:50], rtol=1e-14)
+    # single parameter, scalar argument
+    prior1 = Prior(priorLimits, ['R0'], priorNames, priorParams)
+    assert np.isclose(prior1.logPrior(20.), -np.log(20.))
+    assert np.isneginf(prior1.logPrior(priorLimits['R0'][0]))
+
+
+class LowerLimitPrior(Prior):
+    '''
+    The first draw of the flat parameter is exactly at the lower limit, which logPrior excludes
+    '''
+    nDraws = 0
+
+    def _draw(self, nSamples, rng):
+        x = Prior._draw(self, nSamples, rng)
+        if self.nDraws==0:
+            x[0, 3] = self._limInf[3]
+        self.nDraws += 1
+        return x
+
+
+def test_sample():
+    narrow = {'H0': {'mu': 67.9, 'sigma': 60.}}
+    prior = LowerLimitPrior(priorLimits, params, priorNames, narrow)
+    x = prior.sample(20000, seed=1)
+    assert x.shape==(20000, len(params))
+    assert np.all(np.isfinite(prior.logPrior(x)))
+    assert prior.nDraws>1
+    # gaussian truncated to the prior range
+    a, b = [(lim-narrow['H0']['mu'])/narrow['H0']['sigma'] for lim in priorLimits['H0']]
+    H0 = truncnorm(a, b, loc=narrow['H0']['mu'], scale=narrow['H0']['sigma'])
+    assert abs(x[:, 0].mean()-H0.mean())<5*H0.std()/np.sqrt(x.shape[0])
+    # flat in log
+    logR0 = np.log(x[:, 2])
+    assert abs(logR0.mean()-np.log(np.sqrt(1e-03*1e03)))<5*np.log(1e06)/np.sqrt(12*x.shape[0])
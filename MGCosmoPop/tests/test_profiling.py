@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+#    Copyright (c) 2021 Michele Mancarella <michele.mancarella@unige.ch>
+#
+#    All rights reserved. Use of this source code is governed by a modified BSD
+#    license that can be found in the LICENSE file.
+
+import json
+import pickle
+import numpy as np
+
+from synthetic import build_posterior
+from posteriors.profiling import StageProfiler
+
+
+x = np.array([70., 1.3, 20., 2.])
+
+
+def test_profiler_table_and_json(tmp_path):
+    post, _ = build_posterior()
+    profiler = StageProfiler()
+    # Off by default
+    post.logPosterior(x)
+    assert profiler.stats=={}
+
+    with profiler:
+        for _ in range(3):
+            post.logPosterior(x)
+        post.logPosterior_batch(np.array([x, x]))
+    post.logPosterior(x)
+
+    st = profiler.summary()
+    assert st['Posterior.logPosterior']['nCalls']==3
+    assert st['Posterior.logPosterior_batch']['nCalls']==1
+    assert st['Prior.logPrior']['nCalls']==4
+    # Two datasets, two injection sets
+    assert st['HyperLikelihood._logLik']['nCalls']==3*2+2*2
+    assert st['SelectionBiasInjections._Ndet']['nCalls']==3*2
+    assert st['SelectionBiasInjections._Ndet_batch']['nCalls']==2
+    assert st['SelectionBiasInjections.Ndet_batch']['maxSize']==2*len(x)
+    assert st['AllPopulations.log_dN_dm1zdm2zddL']['nCalls']==3*2+2*2+3*2
+    assert 'Cosmo.z_from_dLGW_fast' in st
+    for s in st.values():
+        assert 0<=s['selfTime']<=s['totTime']
+    assert np.isclose(sum(s['selfTime'] for s in st.values()), st['Posterior.logPosterior']['totTime']+st['Posterior.logPosterior_batch']['totTime'])
+
+    table = profiler.table().split('\n')
+    assert table[0].split()[:2]==['Stage', 'Calls']
+    assert len(table)==len(st)+1
+    row = [line.split() for line in table if line.startswith('Posterior.logPosterior ')][0]
+    assert int(row[1])==3
+
+    fname = str(tmp_path/'profile.json')
+    profiler.save(fname)
+    with open(fname) as f:
+        saved = json.load(f)
+    assert list(saved.keys())==list(st.keys())
+    assert saved['Posterior.logPosterior']==st['Posterior.logPosterior']
+
+    # Nothing is attached to the objects, so the posterior can still be sent to worker processes
+    assert pickle.loads(pickle.dumps(post)).logPosterior(x)==post.logPosterior(x)
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+#    Copyright (c) 2021 Michele Mancarella <michele.mancarella@unige.ch>
+#
+#    All rights reserved. Use of this source code is governed by a modified BSD
+#    license that can be found in the LICENSE file.
+
+import numpy as np
+import h5py
+import pytest
+
+from synthetic import build_posterior
+from sample.reweight import ChainReweighter
+
+
+def _write_chain(post, fname, nSteps=6, nWalkers=8, seed=0):
+    '''
+    Chain in the format of EnsembleDriver.save, with points around a fixed value of the parameters
+    '''
+    rng = np.random.default_rng(seed)
+    x0 = np.array([70., 1.3, 20., 2.])
+    chain = x0*(1+0.05*rng.standard_normal((nSteps, nWalkers, len(x0))))
+    logPosts, blobs = post.logPosterior_batch(chain.reshape(-1, len(x0)), return_blob=True)
+    with h5py.File(fname, 'w') as f:
+        f.create_dataset('chain', data=chain)
+        f.create_dataset('log_prob', data=logPosts.reshape(nSteps, nWalkers))
+        f.create_dataset('blobs', data=blobs.reshape(nSteps, nWalkers))
+
+
+@pytest.mark.parametrize('terms', [dict(prior=True), dict(selection=True), dict(datasets=[0, 1]), 'events'])
+def test_reweighting_identity(tmp_path, terms):
+    post, _ = build_posterior()
+    fname = str(tmp_path/'chains.h5')
+    _write_chain(post, fname)
+    reweighter = ChainReweighter(post, fname, block_size=10)
+    if terms=='events':
+        # Same events removed and added back
+        data = post.hyperLikelihood.data[1]
+        terms = dict(events=[(1, data.subset([0, 2]), data.subset([0, 2]))])
+    w = reweighter.reweight(**terms)
+    assert np.allclose(w, 1/reweighter.nSamples, rtol=1e-08, atol=0)
+    assert np.allclose(reweighter.logw, 0., atol=1e-08)
+    rep = reweighter.report()
+    assert np.isclose(rep['ESS'], reweighter.nSamples)
+    assert rep['nRejected']==0
+    assert not rep['rerun_recommended']
+
+
+def test_reweighting_removed_event(tmp_path):
+    post, _ = build_posterior()
+    fname = str(tmp_path/'chains.h5')
+    _write_chain(post, fname)
+    # New posterior without the first event of the second dataset
+    newPost, _ = build_posterior()
+    data = newPost.hyperLikelihood.data[1]
+    newPost.hyperLikelihood.data[1] = data.subset([1, 2])
+    reweighter = ChainReweighter(newPost, fname, block_size=10)
+    reweighter.reweight(events=[(1, data.subset([0]), None)])
+    logPosts = newPost.logPosterior_batch(reweighter.samples)
+    assert np.allclose(reweighter.logPostsNew, logPosts, rtol=1e-10)
+
+
+def test_subset():
+    post, _ = build_posterior(spins=True)
+    data = post.hyperLikelihood.data[0]
+    # Nsamples is a list for LVC data
+    data.Nsamples = list(data.Nsamples)
+    sub = data.subset([3, 0])
+    assert sub.Nobs==2 and type(sub) is type(data)
+    for name in ('m1z', 'm2z', 'dL'):
+        assert np.array_equal(getattr(sub, name), getattr(data, name)[[3, 0]], equal_nan=True)
+    assert all(np.array_equal(s, s0[[3, 0]], equal_nan=True) for s, s0 in zip(sub.spins, data.spins))
+    assert np.array_equal(sub.Nsamples, [data.Nsamples[3], data.Nsamples[0]])
+    assert np.array_equal(sub.logNsamples, np.log(sub.Nsamples))
+    assert data.Nobs==5 and data.m1z.shape[0]==5
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+#    Copyright (c) 2021 Michele Mancarella <michele.mancarella@unige.ch>
+#
+#    All rights reserved. Use of this source code is governed by a modified BSD
+#    license that can be found in the LICENSE file.
+
+import os
+import sys
+import json
+import signal
+import types
+import numpy as np
+import pytest
+
+from synthetic import build_posterior
+from sample.setupRun import initial_walkers
+from sample.pool import BatchedPosterior
+from sample.ensembleDriver import EnsembleDriver
+from sample.backend import StreamingHDFBackend
+import sample.runMCMC as runMCMC
+
+
+Lambda_ini = [70., 1., 20., 1.]
+
+
+def test_batched_posterior():
+    post, _ = build_posterior()
+    pts = initial_walkers(post, Lambda_ini, 6, eps=0.05, seed=1)
+    # one point outside the prior
+    pts[2, 0] = 500.
+    ref = [post.logPosterior(p, return_blob=True) for p in pts]
+    for nCores, block_size in ((1, None), (1, 4), (2, None), (2, 1)):
+        batchedPost = BatchedPosterior(post, nCores=nCores, block_size=block_size)
+        try:
+            logPosts, blobs = batchedPost(pts)
+        finally:
+            batchedPost.close()
+        assert logPosts.shape==(6, ) and blobs.dtype==post.blobs_dtype
+        assert batchedPost.nEvals==6
+        assert np.allclose(logPosts, [r[0] for r in ref], rtol=1e-8)
+        assert logPosts[2]==-np.inf
+        assert np.array_equal(blobs['lp'], [r[1] for r in ref])
+        inside = [0, 1, 3, 4, 5]
+        for i, name in enumerate(('lls', 'mus', 'errs', 'Neffs')):
+            assert np.allclose(blobs[name][inside], np.array([r[2+i] for r in ref])[inside], rtol=1e-8)
+
+
+def _run_driver(post, mode, nCores=1):
+    p0 = initial_walkers(post, Lambda_ini, 8, eps=0.05, seed=1)
+    driver = EnsembleDriver(post, nwalkers=8, mode=mode, nCores=nCores, seed=2, print_every=1000)
+    sampler = driver.run(p0, 4)
+    assert driver.nSteps==4 and driver.throughput()['nEvals']==32
+    return sampler.get_chain(), sampler.get_log_prob(), sampler.get_blobs()
+
+
+def test_driver_modes():
+    post, _ = build_posterior()
+    chain, logProb, blobs = _run_driver(post, 'serial')
+    assert blobs.dtype==post.blobs_dtype and blobs.shape==(4, 8)
+    assert np.allclose(post.logPosterior_from_blobs(blobs.ravel()), logProb.ravel())
+    # pool evaluates the same function in other processes
+    for res, ref in zip(_run_driver(post, 'pool', nCores=2), (chain, logProb, blobs)):
+        assert np.array_equal(res, ref)
+    # batched and scalar posterior agree to rounding
+    chainV, logProbV, blobsV = _run_driver(post, 'vectorize', nCores=2)
+    assert np.allclose(chainV, chain, rtol=1e-10) and np.allclose(logProbV, logProb, rtol=1e-8)
+    for name in post.blobs_dtype.names:
+        assert np.allclose(blobsV[name], blobs[name], rtol=1e-8)
+
+
+def test_driver_rejects_mode():
+    post, _ = build_posterior()
+    with pytest.raises(ValueError):
+        EnsembleDriver(post, nwalkers=8, mode='threads')
+
+
+CONFIG = '''
+params_inference = ['H0', 'Xi0', 'R0', 'lambdaRedshift']
+sampler = %r
+nwalkers = 8
+nsteps = %s
+mode = 'serial'
+nCores = 1
+block_size = None
+eps = 1e-02
+seed = 1312
+print_every = 100
+slice_mu = 1.
+slice_tune_steps = 200
+delayed_acceptance = %r
+flush_every = 2
+monitor = False
+monitor_args = {}
+'''
+
+
+def _run_main(monkeypatch, tmp_path, nsteps, sampler='emcee', delayed_acceptance=None):
+    monkeypatch.setattr(runMCMC, 'build_posterior', lambda config: build_posterior(config.params_inference))
+    monkeypatch.setattr(runMCMC.Globals, 'dirName', str(tmp_path))
+    monkeypatch.syspath_prepend(str(tmp_path))
+    monkeypatch.delitem(sys.modules, 'config_test', raising=False)
+    with open(os.path.join(tmp_path, 'config_test.py'), 'w') as f:
+        f.write(CONFIG %(sampler, nsteps, delayed_acceptance))
+    monkeypatch.setattr(sys, 'argv', ['runMCMC.py', '--config', 'config_test', '--fout', 'run'])
+    # main redirects the output to the log file and sets a handler for SIGTERM
+    stdout, stderr, handler = sys.stdout, sys.stderr, signal.getsignal(signal.SIGTERM)
+    try:
+        runMCMC.main()
+    finally:
+        sys.stdout, sys.stderr = stdout, stderr
+        signal.signal(signal.SIGTERM, handler)
+    return os.path.join(tmp_path, 'results', 'run')
+
+
+def test_runMCMC(monkeypatch, tmp_path):
+    out_path = _run_main(monkeypatch, tmp_path, 3)
+    with open(os.path.join(out_path, 'throughput.json')) as f:
+        assert json.load(f)['nSteps']==3
+    assert os.path.exists(os.path.join(out_path, 'logfile.txt'))
+    chain = StreamingHDFBackend(os.path.join(out_path, 'chains.h5'), read_only=True).get_chain()
+    assert chain.shape==(3, 8, 4)
+    # running again with more steps resumes the chain
+    _run_main(monkeypatch, tmp_path, 5)
+    backend = StreamingHDFBackend(os.path.join(out_path, 'chains.h5'), read_only=True)
+    assert backend.iteration==5
+    assert np.array_equal(backend.get_chain()[:3], chain)
+
+
+def test_runMCMC_rejects_delayed_acceptance_with_slice(monkeypatch, tmp_path):
+    runMCMC.check_config(types.SimpleNamespace(sampler='emcee', delayed_acceptance='quadratic'))
+    runMCMC.check_config(types.SimpleNamespace(sampler='slice', delayed_acceptance=None))
+    with pytest.raises(ValueError):
+        runMCMC.check_config(types.SimpleNamespace(sampler='slice', delayed_acceptance='subset'))
+    # the check is done before the output folder is created and the posterior is built
+    with pytest.raises(ValueError):
+        _run_main(monkeypatch, tmp_path, 3, sampler='slice', delayed_acceptance='quadratic')
+    assert not os.path.exists(os.path.join(tmp_path, 'results'))
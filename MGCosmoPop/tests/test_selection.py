@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+#    Copyright (c) 2021 Michele Mancarella <michele.mancarella@unige.ch>
+#
+#    All rights reserved. Use of this source code is governed by a modified BSD
+#    license that can be found in the LICENSE file.
+
+import numpy as np
+import pytest
+
+from synthetic import build_posterior
+from posteriors.selectionBias import AdaptiveSelectionBiasInjections
+
+
+cases = { 'trunc': (dict(params=['H0', 'Om', 'w0', 'Xi0', 'n', 'R0', 'lambdaRedshift', 'alpha', 'beta', 'ml', 'mh']),
+                    [70., 0.3, -1., 1.3, 1.91, 20., 2., 1.5, 0.8, 3., 90.]),
+          'bpl_md': (dict(params=['H0', 'Om', 'Xi0', 'R0', 'alphaRedshift', 'betaRedshift', 'zp', 'alpha1', 'alpha2', 'beta', 'deltam', 'ml', 'mh', 'b'], mass='bpl', rate='md'),
+                     [70., 0.3, 1., 20., 1.1, 2.6, 2.4, 1.6, 4.8, 1.4, 4.8, 4., 87., 0.43]),
+          'spins': (dict(params=['H0', 'Xi0', 'R0', 'muEff', 'sigmaEff', 'muP', 'sigmaP'], spins=True),
+                    [70., 1.5, 20., 0.05, 0.2, 0.2, 0.1]),
+        }
+
+
+@pytest.mark.parametrize('case', sorted(cases))
+@pytest.mark.parametrize('chunk_size', [None, 4000])
+def test_Ndet_batch_equals_Ndet(case, chunk_size):
+    kwargs, x0 = cases[case]
+    post, _ = build_posterior(**kwargs)
+    rng = np.random.default_rng(1)
+    x0 = np.array(x0)
+    Lambdas = x0*(1+0.02*rng.standard_normal((6, len(x0))))
+    mus, errs, Neffs = post.selectionBias.Ndet_batch(Lambdas, chunk_size=chunk_size)
+    assert mus.shape==(6, 2)
+    for k, Lambda in enumerate(Lambdas):
+        mu, err, Neff = post.selectionBias.Ndet(Lambda)
+        assert np.allclose(mus[k], mu, rtol=1e-6, atol=0)
+        assert np.allclose(errs[k], err, rtol=1e-5, atol=1e-12)
+        assert np.allclose(Neffs[k], Neff, rtol=1e-5, atol=0)
+
+
+def test_logPosterior_batch_equals_logPosterior():
+    post, _ = build_posterior()
+    Lambdas = np.array([[70., 1.3, 20., 2.], [60., 0.8, 40., 1.], [80., 2., 10., 3.]])
+    logPosts, blobs = post.logPosterior_batch(Lambdas, return_blob=True)
+    for k, Lambda in enumerate(Lambdas):
+        logPost, lp, lls, mus, errs, Neffs = post.logPosterior(Lambda, return_blob=True)
+        assert np.isclose(logPosts[k], logPost, rtol=1e-8)
+        assert np.allclose(blobs['mus'][k], mus, rtol=1e-6)
+
+
+def test_adaptive_Ndet_batch_equals_Ndet():
+    post, allPops = build_posterior()
+    adaptive = AdaptiveSelectionBiasInjections(allPops, post.selectionBias.injData, post.selectionBias.params_inference, Neff_target=150., min_fraction=0.1, seed=3)
+    Lambdas = np.array([[70., 1.3, 20., 2.], [60., 0.8, 40., 1.], [80., 2., 10., 3.], [70., 1., 20., -2.]])
+    mus, errs, Neffs = adaptive.Ndet_batch(Lambdas, chunk_size=1000)
+    batchUsage = adaptive.usage_summary()
+    adaptive.reset_usage()
+    for k, Lambda in enumerate(Lambdas):
+        mu, err, Neff = adaptive.Ndet(Lambda)
+        assert np.allclose(mus[k], mu, rtol=1e-6, atol=0)
+        assert np.allclose(Neffs[k], Neff, rtol=1e-5, atol=0)
+    usage = adaptive.usage_summary()
+    assert batchUsage['nCalls']==usage['nCalls']==len(Lambdas)
+    for i in range(2):
+        assert np.array_equal(batchUsage['levelCounts'][i], usage['levelCounts'][i])
+        assert batchUsage['nNotConverged'][i]==usage['nNotConverged'][i]
+    # Not all the values of Lambda need all the injections
+    assert np.all(usage['meanFraction']<1)
+
+
+class ToyInterpolator(object):
+    
+    def __init__(self, power):
+        self.power = power
+    
+    def ev(self, m1z, m2z):
+        Mc = (m1z*m2z)**(3/5)/(m1z+m2z)**(1/5)
+        return 8*(Mc/10)**(5/6)*((m1z+m2z)/60)**self.power
+
+
+class ToyDetector(object):
+    '''
+    L-shaped detector with an analytic oSNR at 1 Gpc. The sky rotation is a shift in phi, 
+    enough to decorrelate the antenna patterns of different detectors
+    '''
+    def __init__(self, power, offset, duty_cycle=1.):
+        self.interpolator = ToyInterpolator(power)
+        self.dL_pivot_Gpc = 1.
+        self.mmin, self.mmax = 1., 1000.
+        self.offset = offset
+        self.duty_cycle = duty_cycle
+    
+    def _equat2detector(self, costheta, phi, t):
+        return costheta, (phi+2*np.pi*t+self.offset)%(2*np.pi)
+    
+    def _Qsq(self, costh, phi, cosiota):
+        Fp = 0.5*(1.+costh**2)*np.cos(2*phi)
+        Fc = costh*np.sin(2*phi)
+        return (Fp*0.5*(1.+cosiota**2))**2 + (Fc*cosiota)**2
+
+
+class ToyNetwork(object):
+    
+    def __init__(self, detectors):
+        self.detectors = detectors
+    
+    def get_detectors(self):
+        return self.detectors
+
+
+def test_semianalytic_Ndet_vs_monte_carlo():
+    import io, contextlib
+    from posteriors.selectionBias import SelectionBiasSemiAnalytic
+    _, allPops = build_posterior()
+    # the oSNR ratio of the two detectors changes by a factor ~30 over the mass range
+    network = ToyNetwork({'A': ToyDetector(0., 0.), 'B': ToyDetector(1.5, 1.3, duty_cycle=0.8)})
+    params, Lambda = ['H0', 'R0', 'lambdaRedshift'], [70., 20., 2.]
+    with contextlib.redirect_stdout(io.StringIO()):
+        selBias = SelectionBiasSemiAnalytic(allPops, [network], params, [1.], snr_th=12., mmin=3., mmax=90., zmax=1.5, 
+                                            nMasses=60, nz=60, nAngles=50000, seed=1)
+    mu = selBias.Ndet(Lambda)[0][0]
+    
+    # Monte Carlo with injections drawn uniformly in m1>m2 and z, detected with the full network SNR
+    rng = np.random.default_rng(2)
+    N = 400000
+    m1 = rng.uniform(3., 90., N)
+    m2 = rng.uniform(3., m1)
+    z = rng.uniform(0., 1.5, N)
+    logpDraw = -np.log(m1-3.)-np.log(87.)-np.log(1.5)
+    LambdaAll = allPops.get_Lambda(Lambda, params)
+    H0, Om0, w0, Xi0, n = allPops.cosmo._get_values(allPops._split_params(LambdaAll)[0], ['H0', 'Om', 'w0', 'Xi0', 'n'])
+    dL = allPops.cosmo.dLGW(z, H0, Om0, w0, Xi0, n)
+    costheta, phi, cosiota, t = rng.uniform(-1, 1, N), rng.uniform(0, 2*np.pi, N), rng.uniform(-1, 1, N), rng.uniform(0, 1, N)
+    SNRsq = np.zeros(N)
+    for det in network.get_detectors().values():
+        costhetaD, phiD = det._equat2detector(costheta, phi, t)
+        keep = rng.uniform(0, 1, N)<det.duty_cycle
+        SNRsq += keep*(det.interpolator.ev(m1*(1+z), m2*(1+z))/dL)**2*det._Qsq(costhetaD, phiD, cosiota)
+    w = np.where(SNRsq>12.**2, np.exp(allPops.log_dN_dm1dm2dz(m1, m2, z, [], 1., LambdaAll)-logpDraw), 0.)
+    muMC, errMC = w.mean(), w.std()/np.sqrt(N)
+    
+    assert abs(mu-muMC) < 4*errMC+0.01*muMC
+
+
+def test_logsumexp_segments():
+    from posteriors.selectionBias import logsumexp_segments
+    rng = np.random.default_rng(0)
+    x = rng.normal(size=(3, 20))*10
+    x[1, 5:9] = -np.inf
+    offsets = np.array([0, 5, 9, 16])
+    res = logsumexp_segments(x, offsets)
+    for k, (a, b) in enumerate(zip(offsets, list(offsets[1:])+[20])):
+        np.testing.assert_allclose(res[:, k], np.logaddexp.reduce(x[:, a:b], axis=-1))
+    np.testing.assert_allclose(logsumexp_segments(x[0], offsets), res[0])
+
+
+@pytest.mark.parametrize('chunk_size', [None, 7000])
+def test_merged_runs_equal_per_run(chunk_size):
+    from posteriors.selectionBias import SelectionBiasInjections
+    kwargs, x0 = cases['trunc']
+    post, _ = build_posterior(**kwargs)
+    postMerged, allPops = build_posterior(**kwargs)
+    merged = SelectionBiasInjections(allPops, postMerged.selectionBias.injData, kwargs['params'], merge_runs=True)
+    # Different observation times, so that the runs are not interchangeable
+    for selBias in (post.selectionBias, merged):
+        selBias.injData[1].Tobs = 0.5
+    merged.injStore.Tobs[1] = 0.5
+    merged.injStore.logTobs = np.log(merged.injStore.Tobs)
+    
+    rng = np.random.default_rng(2)
+    Lambdas = np.array(x0)*(1+0.02*rng.standard_normal((4, len(x0))))
+    mus, errs, Neffs = merged.Ndet_batch(Lambdas, chunk_size=chunk_size)
+    for k, Lambda in enumerate(Lambdas):
+        for res, resMerged in zip(post.selectionBias.Ndet(Lambda), merged.Ndet(Lambda)):
+            np.testing.assert_allclose(resMerged, res, rtol=1e-10)
+        for res, resBatch in zip(post.selectionBias.Ndet(Lambda), (mus[k], errs[k], Neffs[k])):
+            np.testing.assert_allclose(resBatch, res, rtol=1e-6)
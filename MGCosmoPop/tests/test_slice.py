@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+#    Copyright (c) 2021 Michele Mancarella <michele.mancarella@unige.ch>
+#
+#    All rights reserved. Use of this source code is governed by a modified BSD
+#    license that can be found in the LICENSE file.
+
+import numpy as np
+import pytest
+
+from sample.ensembleSlice import EnsembleSliceSampler
+from sample.backend import StreamingHDFBackend
+from synthetic import GaussPosterior, Interrupted
+
+
+mean = np.array([1., -2.])
+cov = np.array([[1., 0.95*2.], [0.95*2., 4.]])
+
+
+def test_slice_correlated_gauss():
+    post = GaussPosterior(mean, cov)
+    sampler = EnsembleSliceSampler(post, nwalkers=32, tune_steps=100, seed=4, print_every=10000)
+    p0 = mean+0.1*np.random.RandomState(0).normal(size=(32, 2))
+    backend = sampler.run(p0, 1500)
+    samples = backend.get_chain(discard=300, flat=True)
+    assert np.allclose(samples.mean(axis=0), mean, atol=0.1*np.sqrt(np.diag(cov)).max())
+    assert np.allclose(np.cov(samples.T), cov, rtol=0.1)
+    assert np.allclose(backend.get_log_prob(), post.logPosterior_batch(backend.get_chain(flat=True)).reshape(1500, 32))
+
+
+def _run(fname, nsteps, nMax=None):
+    sampler = EnsembleSliceSampler(GaussPosterior(mean, cov, nMax=nMax), nwalkers=8, tune_steps=15, fname=fname, flush_every=4, seed=5, print_every=10000)
+    sampler.run(mean+0.1*np.random.RandomState(1).normal(size=(8, 2)), nsteps)
+    return sampler
+
+
+def test_slice_resume_across_flush(tmp_path):
+    nsteps = 25
+    ref = _run(str(tmp_path/'ref.h5'), nsteps)
+    nEvals = ref.posterior.nCalls
+
+    fname = str(tmp_path/'resumed.h5')
+    # Interrupted during the tuning of mu, after some flushes
+    with pytest.raises(Interrupted):
+        _run(fname, nsteps, nMax=nEvals//2)
+    nDone = StreamingHDFBackend(fname, read_only=True).iteration
+    assert 4<nDone<15
+    res = _run(fname, nsteps)
+
+    assert res.mu==ref.mu
+    refBackend, resBackend = StreamingHDFBackend(str(tmp_path/'ref.h5'), read_only=True), StreamingHDFBackend(fname, read_only=True)
+    assert resBackend.iteration==nsteps
+    assert np.array_equal(resBackend.get_chain(), refBackend.get_chain())
+    assert np.array_equal(resBackend.get_log_prob(), refBackend.get_log_prob())
+    assert np.array_equal(resBackend.get_blobs(), refBackend.get_blobs())
@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+#    Copyright (c) 2021 Michele Mancarella <michele.mancarella@unige.ch>
+#
+#    All rights reserved. Use of this source code is governed by a modified BSD
+#    license that can be found in the LICENSE file.
+
+import numpy as np
+
+from posteriors.prior import Prior
+from sample.smc import SMCSampler
+
+
+class TruncatedGaussPosterior(object):
+
+    '''
+    Flat prior on [0,1]^2 and gaussian likelihood with support a<0.2,
+    so that 80% of the prior volume is outside the support of the likelihood
+    '''
+
+    blobs_dtype = np.dtype([('lp', np.float64)])
+
+    def __init__(self):
+        params = ['a', 'b']
+        self.prior = Prior({'a': (0., 1.), 'b': (0., 1.)}, params, {'a': 'flat', 'b': 'flat'}, {})
+        self.hyperLikelihood = type('Lik', (object,), {'params_inference': params})()
+        self.mu, self.sigma = np.array([0.1, 0.5]), np.array([0.02, 0.1])
+        self.logZ = np.log(2*np.pi*self.sigma.prod())
+
+    def logPosterior_batch(self, Lambdas, return_blob=False):
+        lp = self.prior.logPrior(Lambdas)
+        logL = np.where(Lambdas[:, 0]<0.2, -0.5*(((Lambdas-self.mu)/self.sigma)**2).sum(axis=1), -np.inf)
+        blobs = np.empty(Lambdas.shape[0], dtype=self.blobs_dtype)
+        blobs['lp'] = lp
+        return lp+logL, blobs
+
+
+def test_smc_particles_outside_support():
+    post = TruncatedGaussPosterior()
+    smc = SMCSampler(post, nParticles=2000, ess_target=0.5, seed=2)
+    res = smc.run(verbose=False)
+    assert np.all(np.isfinite(res['logL']))
+    assert np.all(res['samples'][:, 0]<0.2)
+    assert abs(res['logZ']-post.logZ)<4*max(res['logZ_err'], 0.02)
+    assert np.allclose(res['samples'].mean(axis=0), post.mu, atol=4*post.sigma/np.sqrt(200))
@@ -0,0 +1,24 @@
+#!/usr/bin/env python3
+#    Copyright (c) 2021 Michele Mancarella <michele.mancarella@unige.ch>
+#
+#    All rights reserved. Use of this source code is governed by a modified BSD
+#    license that can be found in the LICENSE file.
+
+import numpy as np
+
+from synthetic import build_posterior
+from posteriors.telemetry import NeffTelemetry
+
+
+def test_telemetry_with_event_subsets():
+    myTelemetry = NeffTelemetry()
+    post, _ = build_posterior(telemetry=myTelemetry)
+    post.hyperLikelihood.telemetry = myTelemetry
+    x = [70., 1.3, 20., 2.]
+    post.logPosterior(x)
+    assert myTelemetry.stats['events_0'].nCalls==1 and myTelemetry.stats['events_1'].nCalls==1
+    # Data with a subset of the events (as used by ChainReweighter) are evaluated without recording telemetry
+    data = post.hyperLikelihood.data[1]
+    ll = post.hyperLikelihood._logLik(x, data.subset([0]))+post.hyperLikelihood._logLik(x, data.subset([1, 2]))
+    assert np.isclose(ll, post.hyperLikelihood.logLik(x)[1])
+    assert myTelemetry.stats['events_1'].nCalls==2